@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Benchmark of the SPID flows: throughput and p50/p99 latency of the login,
+ACS, logout and metadata views, offline with the IdPs of tests/metadata.
+
+    python benchmarks/flows.py [-n NUMBER] [--backend xmlsec1|python-xmlsec]
+        [--cases login acs logout metadata metadata_uncached]
+        [--save FILE] [--compare FILE]
+
+The responses to the ACS are minted by the synthetic IdP of spid_idp.py,
+that signs with the test certificate of the SP. A run saved with --save
+can be compared with the next ones by --compare.
+"""
+import argparse
+import base64
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import django
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+CASES = ("login", "acs", "logout", "metadata", "metadata_uncached")
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "number": len(latencies),
+        "throughput": len(latencies) / sum(latencies),
+        "mean": sum(latencies) / len(latencies) * 1000,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "max": latencies[-1] * 1000,
+    }
+
+
+def measure(prepare, view, number, warmup, expected_status):
+    """
+    Calls the view with the requests built by prepare(i), timing only the
+    view. Fails if a response has not the status code of the success path.
+    """
+    latencies = []
+    for i in range(warmup + number):
+        request = prepare(i)
+        start = time.perf_counter()
+        response = view(request)
+        elapsed = time.perf_counter() - start
+        if response.status_code not in expected_status:
+            raise RuntimeError(
+                f"unexpected status {response.status_code} from {request.path}"
+            )
+        if i >= warmup:
+            latencies.append(elapsed)
+    return summarize(latencies)
+
+
+def environment(args):
+    import saml2
+
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": revision,
+        "backend": args.backend,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "pysaml2": saml2.__version__,
+        "platform": platform.platform(),
+    }
+
+
+def print_results(results, baseline=None):
+    header = f"  {'case':<18} {'req/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}"
+    if baseline:
+        header += f" {'p50 diff':>9} {'p99 diff':>9}"
+    print(header)
+
+    for case, res in results.items():
+        line = (
+            f"  {case:<18} {res['throughput']:9.1f} {res['mean']:9.2f}"
+            f" {res['p50']:9.2f} {res['p99']:9.2f}"
+        )
+        base = (baseline or {}).get(case)
+        if base:
+            for key in ("p50", "p99"):
+                line += f" {(res[key] - base[key]) / base[key] * 100:+8.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--backend", default="python-xmlsec")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--save", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a saved run")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.test_settings")
+    django.setup()
+    logging.disable(logging.WARNING)
+
+    from django.conf import settings
+    from django.contrib.auth.models import AnonymousUser
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.db import connection
+    from django.test import RequestFactory, override_settings
+    from django.test.utils import setup_test_environment
+    from djangosaml2.cache import OutstandingQueriesCache
+    from djangosaml2.conf import get_config
+
+    from djangosaml2_spid import views
+    from djangosaml2_spid.spid_metadata import clear_metadata_cache
+    from spid_idp import SyntheticIdP
+
+    idp = SyntheticIdP()
+    metadata_dir = tempfile.mkdtemp(prefix="spid-benchmark-")
+    idp.write_metadata(metadata_dir)
+    override = override_settings(
+        SPID_CRYPTO_BACKEND=args.backend,
+        SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir,
+        SAML_ATTRIBUTE_MAPPING={"spidCode": ("username",)},
+        SAML_CREATE_UNKNOWN_USER=True,
+    )
+    override.enable()
+    setup_test_environment()
+    old_db_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+
+    factory = RequestFactory()
+    acs_url = "/" + settings.SPID_ACS_URL_PATH.lstrip("/")
+    conf = get_config(request=factory.get(acs_url))
+
+    def get_request(path, method="get", **kwargs):
+        request = getattr(factory, method)(path, **kwargs)
+        request.session = SessionStore()
+        request.saml_session = SessionStore()
+        request.user = AnonymousUser()
+        return request
+
+    def signed_response(i):
+        """A response to the AuthnRequest "_request-{i}" for the user SPID-{i}."""
+        authn_request = {
+            "id": f"_request-{i}",
+            "issuer": conf.entityid,
+            "acs_url": conf._sp_endpoints["assertion_consumer_service"][0][0],
+            "level": 2,
+        }
+        return base64.b64encode(idp.mint_response(authn_request, user=i))
+
+    def acs_request(i, responses):
+        request = get_request(
+            acs_url,
+            method="post",
+            data=urlencode({"SAMLResponse": responses[i]}),
+            content_type="application/x-www-form-urlencoded",
+        )
+        OutstandingQueriesCache(request.saml_session).set(f"_request-{i}", "/")
+        return request
+
+    def logout_request(i, responses, acs_view):
+        """A logout request of a user logged in by the ACS, that is not timed."""
+        request = acs_request(i, responses)
+        acs_view(request)
+        logout = factory.get("/spid/logout/")
+        logout.session = request.session
+        logout.saml_session = request.saml_session
+        logout.user = request.user
+        return logout
+
+    total = args.warmup + args.number
+    results = {}
+    try:
+        for case in args.cases:
+            if case == "login":
+                results[case] = measure(
+                    lambda i: get_request(f"/spid/login/?idp={idp.entity_id}"),
+                    # HTTP-POST or HTTP-Redirect, the SAML2_DEFAULT_BINDING
+                    views.spid_login, args.number, args.warmup, (200, 302),
+                )
+            elif case == "acs":
+                # Each response creates a new user, the signing is not timed
+                responses = [signed_response(i) for i in range(total)]
+                results[case] = measure(
+                    lambda i: acs_request(i, responses),
+                    views.AssertionConsumerServiceView.as_view(),
+                    args.number, args.warmup, (302,),
+                )
+            elif case == "logout":
+                responses = [signed_response(i) for i in range(total)]
+                acs_view = views.AssertionConsumerServiceView.as_view()
+                results[case] = measure(
+                    lambda i: logout_request(i, responses, acs_view),
+                    views.spid_logout, args.number, args.warmup, (200, 302),
+                )
+            elif case == "metadata":
+                results[case] = measure(
+                    lambda i: get_request("/spid/metadata/"),
+                    views.MetadataSpidView.as_view(), args.number, args.warmup, (200,),
+                )
+            elif case == "metadata_uncached":
+                def prepare(i):
+                    clear_metadata_cache()
+                    return get_request("/spid/metadata/")
+
+                results[case] = measure(
+                    prepare, views.MetadataSpidView.as_view(),
+                    args.number, args.warmup, (200,),
+                )
+    finally:
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        override.disable()
+        shutil.rmtree(metadata_dir)
+
+    env = environment(args)
+    print(f"SPID flows, backend {args.backend!r}, {args.number} requests per case")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            saved = json.load(fp)
+        baseline = saved["results"]
+        print(f"compared with {args.compare} ({saved['environment']['date']}, "
+              f"backend {saved['environment']['backend']!r})")
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump({"environment": env, "results": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Load driver of the SPID login round trips against a running Django server,
+with the synthetic IdP of spid_idp.py answering the AuthnRequests in-process.
+
+    python benchmarks/load.py [URL] [-n NUMBER] [-c CONCURRENCY] [--users USERS]
+        [--level 1|2|3] [--error-rate RATE] [--error-codes CODE ...] [--logout]
+
+Each round trip gets the login page of the SP (/spid/login/?idp=...), mints
+the Response to its AuthnRequest and posts it to the ACS, as a browser with
+its own cookies. A fraction of the round trips, given by --error-rate, gets
+a SPID error status instead. The IdP metadata written by
+
+    python benchmarks/spid_idp.py metadata DIR
+
+must be in SPID_IDENTITY_PROVIDERS_METADATA_DIR of the server under test.
+"""
+import argparse
+import base64
+import html
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlencode, urljoin, urlsplit
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from flows import print_results, summarize  # noqa: E402
+from spid_idp import SyntheticIdP  # noqa: E402
+
+STEPS = ("login", "idp", "acs", "logout", "round_trip")
+
+
+class NoRedirectHandler(HTTPRedirectHandler):
+    """The redirects are responses of the SP to check, not to follow."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def form_value(content, name):
+    match = re.search(rf'name="{name}" value="([^"]*)"', content)
+    return html.unescape(match.group(1)) if match else ""
+
+
+class LoadDriver:
+    def __init__(self, args):
+        self.args = args
+        self.idp = SyntheticIdP()
+        self.base_url = args.url.rstrip("/") + "/"
+        self.latencies = {step: [] for step in STEPS}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def request(self, opener, url, data=None):
+        """Returns the status, the headers and the content of a request."""
+        if data is not None:
+            data = urlencode(data).encode()
+        try:
+            with opener.open(url, data=data, timeout=self.args.timeout) as res:
+                return res.status, res.headers, res.read().decode()
+        except HTTPError as err:
+            with err:
+                return err.code, err.headers, err.read().decode(errors="replace")
+
+    def timed_request(self, step, times, opener, url, data=None, expected=(200,)):
+        start = time.perf_counter()
+        status, headers, content = self.request(opener, url, data)
+        times[step] = time.perf_counter() - start
+        if status not in expected:
+            raise RuntimeError(f"{step}: HTTP {status}")
+        return headers, content
+
+    def round_trip(self, i):
+        """A login (and logout) of a user, with its own cookies."""
+        opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirectHandler)
+        error_code = None
+        if random.random() < self.args.error_rate:
+            error_code = random.choice(self.args.error_codes)
+        times = {}
+
+        start = time.perf_counter()
+        headers, content = self.timed_request(
+            "login",
+            times,
+            opener,
+            urljoin(self.base_url, f"spid/login/?idp={self.idp.entity_id}&next=/"),
+            expected=(200, 302),
+        )
+        if "Location" in headers:
+            # HTTP-Redirect binding
+            params = parse_qs(urlsplit(headers["Location"]).query)
+            saml_request, deflated = params["SAMLRequest"][0], True
+            relay_state = params.get("RelayState", [""])[0]
+        else:
+            saml_request, deflated = form_value(content, "SAMLRequest"), False
+            relay_state = form_value(content, "RelayState")
+
+        idp_start = time.perf_counter()
+        authn_request = self.idp.parse_authn_request(saml_request, deflated)
+        saml_response = self.idp.mint_response(
+            authn_request,
+            level=self.args.level,
+            error_code=error_code,
+            user=i % self.args.users,
+        )
+        times["idp"] = time.perf_counter() - idp_start
+
+        self.timed_request(
+            "acs",
+            times,
+            opener,
+            authn_request["acs_url"],
+            {
+                "SAMLResponse": base64.b64encode(saml_response).decode(),
+                "RelayState": relay_state,
+            },
+            expected=(302,) if error_code is None else (403,),
+        )
+        if self.args.logout and error_code is None:
+            self.timed_request(
+                "logout",
+                times,
+                opener,
+                urljoin(self.base_url, "spid/logout/"),
+                expected=(200, 302),
+            )
+        times["round_trip"] = time.perf_counter() - start
+        return times
+
+    def run_one(self, i):
+        try:
+            times = self.round_trip(i)
+        except Exception as err:
+            with self.lock:
+                key = str(err) if isinstance(err, RuntimeError) else type(err).__name__
+                self.failures[key] = self.failures.get(key, 0) + 1
+            return
+
+        with self.lock:
+            for step, elapsed in times.items():
+                self.latencies[step].append(elapsed)
+
+    def run(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(self.run_one, range(self.args.number)))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("url", nargs="?", default="http://localhost:8000/")
+    parser.add_argument("-n", "--number", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--users", type=int, default=100, help="number of distinct users"
+    )
+    parser.add_argument("--level", type=int, choices=(1, 2, 3))
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--error-codes", type=int, nargs="+", default=[19, 20, 21, 22, 23, 25]
+    )
+    parser.add_argument("--logout", action="store_true")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    driver = LoadDriver(args)
+    elapsed = driver.run()
+    completed = len(driver.latencies["round_trip"])
+
+    print(
+        f"SPID login round trips to {args.url}: {completed}/{args.number} completed "
+        f"in {elapsed:.1f}s ({completed / elapsed:.1f}/s), "
+        f"concurrency {args.concurrency}"
+    )
+    print_results(
+        {step: summarize(values) for step, values in driver.latencies.items() if values}
+    )
+    for failure, count in sorted(driver.failures.items()):
+        print(f"  failed: {failure} ({count})")
+    sys.exit(bool(driver.failures))
+
+
+if __name__ == "__main__":
+    main()
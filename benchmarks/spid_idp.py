@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+Synthetic SPID IdP for load tests: mints signed SPID Responses, with the
+SpidL1/L2/L3 levels, attribute statements and SPID error status codes.
+
+    python benchmarks/spid_idp.py metadata DIR [--base-url URL]
+    python benchmarks/spid_idp.py serve [--address HOST:PORT] [--level 1|2|3]
+        [--error-code CODE]
+
+The IdP is the one of tests/metadata (https://localhost:8080), with the
+signing certificate replaced by the SP test certificate, so the Responses
+are signed with tests/certificates/private.key. The IdP metadata written
+by the 'metadata' command must be in SPID_IDENTITY_PROVIDERS_METADATA_DIR
+of the SP under test. The 'serve' command runs the IdP as a standalone
+HTTP server, that answers each AuthnRequest with the auto-submit form of
+a Response to the ACS. The IdP can be used in-process by the load driver
+(benchmarks/load.py) and by the flows benchmark (benchmarks/flows.py).
+
+Requires lxml and python-xmlsec.
+"""
+import argparse
+import base64
+import datetime
+import glob
+import os
+import re
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape, quoteattr
+
+import xmlsec
+from lxml import etree
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CERT_FILE = os.path.join(BASE_DIR, "tests", "certificates", "public.cert")
+KEY_FILE = os.path.join(BASE_DIR, "tests", "certificates", "private.key")
+METADATA_DIR = os.path.join(BASE_DIR, "tests", "metadata")
+
+SAMLP_NS = "urn:oasis:names:tc:SAML:2.0:protocol"
+SAML_NS = "urn:oasis:names:tc:SAML:2.0:assertion"
+NSMAP = {"samlp": SAMLP_NS, "saml": SAML_NS}
+
+SPID_LEVELS = {level: f"https://www.spid.gov.it/SpidL{level}" for level in (1, 2, 3)}
+
+DEFAULT_ATTRIBUTES = {
+    "spidCode": "SPID-{user:06d}",
+    "name": "Mario",
+    "familyName": "Rossi",
+    "fiscalNumber": "TINIT-RSSMRA80A01H{user:03d}X",
+    "email": "user{user}@example.org",
+}
+
+STATUS_TEMPLATE = """<samlp:Status>
+    <samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:status:{status}"{sub_status}
+  </samlp:Status>"""
+
+RESPONSE_TEMPLATE = """<samlp:Response xmlns:samlp="{samlp_ns}" xmlns:saml="{saml_ns}"
+    ID="{response_id}" Version="2.0" IssueInstant="{issue_instant}"
+    Destination={destination} InResponseTo={in_response_to}>
+  <saml:Issuer Format="urn:oasis:names:tc:SAML:2.0:nameid-format:entity">{issuer}</saml:Issuer>
+  {status}{assertion}
+</samlp:Response>"""
+
+ASSERTION_TEMPLATE = """
+  <saml:Assertion ID="{assertion_id}" Version="2.0" IssueInstant="{issue_instant}">
+    <saml:Issuer Format="urn:oasis:names:tc:SAML:2.0:nameid-format:entity">{issuer}</saml:Issuer>
+    <saml:Subject>
+      <saml:NameID Format="urn:oasis:names:tc:SAML:2.0:nameid-format:transient"
+          NameQualifier="{issuer}">{name_id}</saml:NameID>
+      <saml:SubjectConfirmation Method="urn:oasis:names:tc:SAML:2.0:cm:bearer">
+        <saml:SubjectConfirmationData InResponseTo={in_response_to}
+            NotOnOrAfter="{not_on_or_after}" Recipient={destination}/>
+      </saml:SubjectConfirmation>
+    </saml:Subject>
+    <saml:Conditions NotBefore="{not_before}" NotOnOrAfter="{not_on_or_after}">
+      <saml:AudienceRestriction>
+        <saml:Audience>{audience}</saml:Audience>
+      </saml:AudienceRestriction>
+    </saml:Conditions>
+    <saml:AuthnStatement AuthnInstant="{issue_instant}" SessionIndex="{session_index}">
+      <saml:AuthnContext>
+        <saml:AuthnContextClassRef>{authn_context_class_ref}</saml:AuthnContextClassRef>
+      </saml:AuthnContext>
+    </saml:AuthnStatement>
+    <saml:AttributeStatement>{attributes}
+    </saml:AttributeStatement>
+  </saml:Assertion>"""
+
+ATTRIBUTE_TEMPLATE = """
+      <saml:Attribute Name={name}
+          NameFormat="urn:oasis:names:tc:SAML:2.0:attrname-format:basic">
+        <saml:AttributeValue xmlns:xs="http://www.w3.org/2001/XMLSchema"
+            xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+            xsi:type="xs:string">{value}</saml:AttributeValue>
+      </saml:Attribute>"""
+
+FORM_TEMPLATE = """<!DOCTYPE html>
+<html><body onload="document.forms[0].submit()">
+<form method="post" action={action}>
+<input type="hidden" name="SAMLResponse" value="{saml_response}"/>
+<input type="hidden" name="RelayState" value={relay_state}/>
+<noscript><input type="submit" value="Continue"/></noscript>
+</form></body></html>"""
+
+
+def saml_instant(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SyntheticIdP:
+    """An IdP of tests/metadata that signs with the SP test key."""
+
+    def __init__(self, metadata_file=None, key_file=KEY_FILE, cert_file=CERT_FILE):
+        if metadata_file is None:
+            metadata_file = sorted(glob.glob(os.path.join(METADATA_DIR, "*.xml")))[0]
+        with open(metadata_file) as fp:
+            self.source_metadata = fp.read()
+        self.entity_id = re.search(r'entityID="([^"]+)"', self.source_metadata).group(1)
+
+        with open(cert_file) as fp:
+            self.cert = "".join(
+                line.strip() for line in fp if not line.startswith("-----")
+            )
+        self.key = xmlsec.Key.from_file(key_file, xmlsec.constants.KeyDataFormatPem)
+        self.key.load_cert_from_file(cert_file, xmlsec.constants.KeyDataFormatPem)
+
+    def metadata(self, base_url=None):
+        """
+        The IdP metadata with the test certificate (unsigned), and with
+        the endpoints on *base_url* if provided.
+        """
+        xml = re.sub(
+            r"<ds:Signature .*?</ds:Signature>", "", self.source_metadata, flags=re.S
+        )
+        xml = re.sub(
+            r"<ds:X509Certificate>[^<]*</ds:X509Certificate>",
+            f"<ds:X509Certificate>{self.cert}</ds:X509Certificate>",
+            xml,
+        )
+        if base_url:
+            xml = re.sub(
+                r'(Location|ResponseLocation)="[^"]*/([^/"]*)"',
+                rf'\1="{base_url.rstrip("/")}/\2"',
+                xml,
+            )
+        return xml
+
+    def write_metadata(self, directory, base_url=None):
+        path = os.path.join(directory, "synthetic-idp.xml")
+        with open(path, "w") as fp:
+            fp.write(self.metadata(base_url))
+        return path
+
+    @staticmethod
+    def parse_authn_request(saml_request, deflated=False):
+        """
+        Returns the ID, the SP entityID, the ACS URL and the requested level of
+        a base64 encoded AuthnRequest, deflated for the HTTP-Redirect binding.
+        """
+        xml = base64.b64decode(saml_request)
+        if deflated:
+            xml = zlib.decompress(xml, -15)
+        root = etree.fromstring(xml)
+        class_ref = root.findtext(
+            "samlp:RequestedAuthnContext/saml:AuthnContextClassRef", namespaces=NSMAP
+        )
+        return {
+            "id": root.get("ID"),
+            "issuer": root.findtext("saml:Issuer", namespaces=NSMAP).strip(),
+            "acs_url": root.get("AssertionConsumerServiceURL"),
+            "level": int(class_ref.strip()[-1]) if class_ref else 2,
+        }
+
+    def sign(self, root, node):
+        """Adds an enveloped signature to node, after its Issuer."""
+        signature = xmlsec.template.create(
+            root,
+            xmlsec.constants.TransformExclC14N,
+            xmlsec.constants.TransformRsaSha256,
+            ns="ds",
+        )
+        node.find("saml:Issuer", namespaces=NSMAP).addnext(signature)
+        ref = xmlsec.template.add_reference(
+            signature, xmlsec.constants.TransformSha256, uri=f"#{node.get('ID')}"
+        )
+        xmlsec.template.add_transform(ref, xmlsec.constants.TransformEnveloped)
+        xmlsec.template.add_transform(ref, xmlsec.constants.TransformExclC14N)
+        key_info = xmlsec.template.ensure_key_info(signature)
+        xmlsec.template.add_x509_data(key_info)
+
+        ctx = xmlsec.SignatureContext()
+        ctx.key = self.key
+        ctx.register_id(node, "ID")
+        ctx.sign(signature)
+
+    def mint_response(
+        self, authn_request, level=None, attributes=None, error_code=None, user=0
+    ):
+        """
+        Returns a signed Response to a parsed AuthnRequest. The Response is of
+        the requested level, unless *level* is given, or is a SPID error status
+        with *error_code* (e.g. 19, 22 or 25). The values of *attributes* are
+        formatted with *user*, to mint the responses of different users.
+        """
+        now = datetime.datetime.utcnow()
+        values = {
+            "samlp_ns": SAMLP_NS,
+            "saml_ns": SAML_NS,
+            "response_id": f"_{uuid.uuid4().hex}",
+            "assertion_id": f"_{uuid.uuid4().hex}",
+            "issue_instant": saml_instant(now),
+            "not_before": saml_instant(now - datetime.timedelta(minutes=1)),
+            "not_on_or_after": saml_instant(now + datetime.timedelta(minutes=5)),
+            "destination": quoteattr(authn_request["acs_url"]),
+            "in_response_to": quoteattr(authn_request["id"]),
+            "issuer": self.entity_id,
+            "audience": escape(authn_request["issuer"]),
+            "name_id": f"_{uuid.uuid4().hex}",
+            "session_index": f"_{uuid.uuid4().hex}",
+        }
+
+        if error_code is None:
+            values["status"] = STATUS_TEMPLATE.format(status="Success", sub_status="/>")
+            values["authn_context_class_ref"] = SPID_LEVELS[
+                level or authn_request["level"]
+            ]
+            values["attributes"] = "".join(
+                ATTRIBUTE_TEMPLATE.format(
+                    name=quoteattr(name), value=escape(value.format(user=user))
+                )
+                for name, value in (attributes or DEFAULT_ATTRIBUTES).items()
+            )
+            values["assertion"] = ASSERTION_TEMPLATE.format(**values)
+        else:
+            values["status"] = STATUS_TEMPLATE.format(
+                status="Responder",
+                sub_status=">\n      <samlp:StatusCode Value="
+                '"urn:oasis:names:tc:SAML:2.0:status:AuthnFailed"/>\n'
+                "    </samlp:StatusCode>\n"
+                f"    <samlp:StatusMessage>ErrorCode nr{error_code}</samlp:StatusMessage>",
+            )
+            values["assertion"] = ""
+
+        root = etree.fromstring(RESPONSE_TEMPLATE.format(**values))
+        assertion = root.find("saml:Assertion", namespaces=NSMAP)
+        if assertion is not None:
+            self.sign(root, assertion)
+        self.sign(root, root)
+        return etree.tostring(root)
+
+    @staticmethod
+    def response_form(saml_response, acs_url, relay_state=""):
+        """The auto-submit form that posts a Response to the ACS."""
+        return FORM_TEMPLATE.format(
+            action=quoteattr(acs_url),
+            saml_response=base64.b64encode(saml_response).decode(),
+            relay_state=quoteattr(relay_state),
+        )
+
+
+class IdPRequestHandler(BaseHTTPRequestHandler):
+    """Answers the AuthnRequests of both the HTTP-POST and HTTP-Redirect bindings."""
+
+    idp = None
+    level = None
+    error_code = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.endswith("/metadata"):
+            self.reply(self.idp.metadata(self.base_url()), "application/samlmetadata+xml")
+        else:
+            self.authn_response(parse_qs(url.query), deflated=True)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.authn_response(parse_qs(self.rfile.read(length).decode()))
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host', '%s:%d' % self.server.server_address)}"
+
+    def authn_response(self, params, deflated=False):
+        if "SAMLRequest" not in params:
+            self.send_error(400, "Missing SAMLRequest")
+            return
+        try:
+            authn_request = self.idp.parse_authn_request(
+                params["SAMLRequest"][0], deflated
+            )
+        except Exception as err:
+            self.send_error(400, f"Invalid SAMLRequest: {err}")
+            return
+
+        saml_response = self.idp.mint_response(
+            authn_request, level=self.level, error_code=self.error_code
+        )
+        relay_state = params.get("RelayState", [""])[0]
+        self.reply(
+            self.idp.response_form(saml_response, authn_request["acs_url"], relay_state),
+            "text/html; charset=utf-8",
+        )
+
+    def reply(self, content, content_type):
+        content = content.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    metadata_parser = subparsers.add_parser("metadata", help="write the IdP metadata")
+    metadata_parser.add_argument("directory")
+    metadata_parser.add_argument("--base-url", help="base URL of the IdP endpoints")
+
+    serve_parser = subparsers.add_parser("serve", help="run the IdP HTTP server")
+    serve_parser.add_argument("--address", default="127.0.0.1:8080")
+    serve_parser.add_argument("--level", type=int, choices=sorted(SPID_LEVELS))
+    serve_parser.add_argument("--error-code", type=int)
+    args = parser.parse_args()
+
+    idp = SyntheticIdP()
+    if args.command == "metadata":
+        print(idp.write_metadata(args.directory, args.base_url))
+        return
+
+    host, port = args.address.rsplit(":", 1)
+    handler = type(
+        "Handler",
+        (IdPRequestHandler,),
+        {"idp": idp, "level": args.level, "error_code": args.error_code},
+    )
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    print(f"Synthetic IdP {idp.entity_id} serving on http://{args.address}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of Saml2ResponseValidator: per-response cost of the SPID
+checks, with the response parsed by the validator or already parsed.
+
+    python benchmarks/validator.py [-n NUMBER] [--profile spid|strict]
+
+The response is minted by the synthetic IdP of spid_idp.py, that requires
+lxml and python-xmlsec.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import django
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=2000)
+    parser.add_argument("--profile", default="spid")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.test_settings")
+    django.setup()
+
+    from saml2 import samlp
+    from djangosaml2_spid.spid_validator import Saml2ResponseValidator
+    from spid_idp import SyntheticIdP
+
+    authn_request = {
+        "id": "_request",
+        "issuer": "http://testserver/spid/metadata/",
+        "acs_url": "http://testserver/spid/acs/",
+        "level": 2,
+    }
+    xml = SyntheticIdP().mint_response(authn_request).decode()
+    response = samlp.response_from_string(xml)
+    kwargs = dict(
+        recipient=authn_request["acs_url"],
+        in_response_to=authn_request["id"],
+        accepted_time_diff=300,
+        return_addrs=[authn_request["acs_url"]],
+    )
+
+    cases = {
+        "parse": lambda: samlp.response_from_string(xml),
+        "parse + run": lambda: Saml2ResponseValidator(xml, **kwargs).run(profile=args.profile),
+        "run": lambda: Saml2ResponseValidator(response, **kwargs).run(profile=args.profile),
+        "validate": lambda: Saml2ResponseValidator(response, **kwargs).validate(profile=args.profile),
+    }
+
+    print(f"Saml2ResponseValidator, profile {args.profile!r}, {args.number} responses")
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+        print(f"  {name:<12} {seconds / args.number * 1e6:10.1f} µs/response")
+
+
+if __name__ == "__main__":
+    main()
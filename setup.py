@@ -32,5 +32,8 @@ setup(
         'Programming Language :: Python :: Implementation :: CPython',
         "Topic :: Software Development :: Libraries :: Python Modules"],
     install_requires=REQUIREMENTS,
+    extras_require={
+        'xmlsec': ['xmlsec>=1.3.9'],
+    },
     zip_safe=False,
 )
@@ -4,6 +4,7 @@
 DISABLE_WEAK_XMLSEC_ALGORITHMS = True  # https://github.com/IdentityPython/pysaml2/pull/628
 ADD_XSD_DATE_TYPE = True  # https://github.com/IdentityPython/pysaml2/pull/602
 PATCH_RESPONSE_VERIFY = True  # https://github.com/IdentityPython/pysaml2/pull/812
+ADD_PYTHON_XMLSEC_BACKEND = True  # crypto_backend = 'python-xmlsec'
 
 
 def pysaml2_patch():
@@ -167,6 +168,8 @@ def pysaml2_patch():
         AttributeValueBase.set_text = set_text
 
     if PATCH_RESPONSE_VERIFY:
+        from .utils import parse_xs_datetime
+
         logger = logging.getLogger(StatusResponse.__module__)
 
         def _verify(self):
@@ -199,7 +202,35 @@ def pysaml2_patch():
             valid = self.issue_instant_ok() and self.status_ok()
             return valid
 
+        def issue_instant_ok(self):
+            """Check that the response was issued at a reasonable time"""
+            now = datetime.datetime.now(datetime.timezone.utc)
+            slack = datetime.timedelta(days=1, seconds=self.timeslack)
+            issued_at = parse_xs_datetime(self.response.issue_instant)
+            return now - slack < issued_at < now + slack
+
         StatusResponse._verify = _verify
+        StatusResponse.issue_instant_ok = issue_instant_ok
+
+    if ADD_PYTHON_XMLSEC_BACKEND:
+        import saml2.entity
+        import saml2.mdstore
+        import saml2.response
+        import saml2.sigver
+
+        from .spid_crypto import PYTHON_XMLSEC_BACKEND, spid_security_context
+
+        _security_context = saml2.sigver.security_context
+
+        def security_context(conf):
+            if conf and conf.crypto_backend == PYTHON_XMLSEC_BACKEND:
+                return spid_security_context(conf)
+            return _security_context(conf)
+
+        # Replace also the references imported by name in other modules
+        for module in (saml2.sigver, saml2.entity, saml2.mdstore,
+                       saml2.metadata, saml2.response):
+            module.security_context = security_context
 
 
 def register_oasis_default_nsmap():
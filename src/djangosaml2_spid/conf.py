@@ -1,6 +1,8 @@
 import os
 import copy
 import logging
+import re
+import threading
 from urllib.parse import urljoin
 from typing import Optional
 
@@ -14,8 +16,21 @@ from django.conf import settings
 from django.apps import apps
 from django.http import HttpRequest
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.urls import reverse
 
+try:
+    from importlib.metadata import version as package_version
+except ImportError:  # Python < 3.8
+    from pkg_resources import get_distribution
+
+    def package_version(name):
+        return get_distribution(name).version
+
+from .spid_crypto import PYTHON_XMLSEC_BACKEND, xmlsec
+from .spid_mdstore import get_metadata_store
+
 logger = logging.getLogger("djangosaml2")
 
 djangosaml2_spid_config = apps.get_app_config("djangosaml2_spid")
@@ -118,6 +133,23 @@ settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR = getattr(
     ),
 )
 
+# Certificate (PEM file) of the federation that signs the IdPs metadata, verified
+# by update_idps before activating them, and maximum size in bytes of a document
+settings.SPID_IDENTITY_PROVIDERS_METADATA_CERT = getattr(
+    settings, "SPID_IDENTITY_PROVIDERS_METADATA_CERT", None
+)
+settings.SPID_IDENTITY_PROVIDERS_METADATA_MAX_SIZE = getattr(
+    settings, "SPID_IDENTITY_PROVIDERS_METADATA_MAX_SIZE", 1024 * 1024
+)
+
+# File rewritten by update_idps when the IdPs metadata change: if set, the
+# workers scan the metadata directory again only when the file changes.
+# Recommended when the metadata directory can't be replaced by a link to a
+# snapshot, and its files are updated one by one
+settings.SPID_IDENTITY_PROVIDERS_METADATA_STAMP = getattr(
+    settings, "SPID_IDENTITY_PROVIDERS_METADATA_STAMP", None
+)
+
 # Validation tools settings
 if hasattr(settings, "SPID_SAML_CHECK_IDP_ACTIVE"):
     pass
@@ -161,6 +193,108 @@ settings.SPID_VALIDATOR_METADATA_URL = getattr(
     "https://validator.spid.gov.it/metadata.xml",
 )
 
+# Crypto backend: 'xmlsec1' (pysaml2 default) or 'python-xmlsec', that signs
+# in-process with the python xmlsec bindings (pip install djangosaml2-spid[xmlsec])
+settings.SPID_CRYPTO_BACKEND = getattr(settings, "SPID_CRYPTO_BACKEND", "xmlsec1")
+
+# Use the async variants of the login, logout, ACS and metadata views (ASGI).
+# Their CPU-bound work runs in a pool of at most SPID_EXECUTOR_MAX_WORKERS
+# threads (None for the default of ThreadPoolExecutor)
+settings.SPID_ASYNC_VIEWS = getattr(settings, "SPID_ASYNC_VIEWS", False)
+if settings.SPID_ASYNC_VIEWS:
+    # The async ACS view follows the internals of djangosaml2 1.9
+    _djangosaml2_version = re.match(r"(\d+)\.(\d+)", package_version("djangosaml2"))
+    if _djangosaml2_version is None or _djangosaml2_version.groups() != ("1", "9"):
+        raise ImproperlyConfigured(
+            "SPID_ASYNC_VIEWS richiede djangosaml2 1.9, "
+            f"versione installata: {package_version('djangosaml2')}"
+        )
+settings.SPID_EXECUTOR_MAX_WORKERS = getattr(settings, "SPID_EXECUTOR_MAX_WORKERS", None)
+
+# Process pool where the python-xmlsec backend computes and verifies the XML
+# signatures (0 disables it). At most SPID_CRYPTO_POOL_QUEUE_SIZE jobs wait for
+# a worker, the others wait up to SPID_CRYPTO_POOL_TIMEOUT seconds for a slot
+settings.SPID_CRYPTO_POOL_SIZE = getattr(settings, "SPID_CRYPTO_POOL_SIZE", 0)
+settings.SPID_CRYPTO_POOL_QUEUE_SIZE = getattr(
+    settings, "SPID_CRYPTO_POOL_QUEUE_SIZE", 64
+)
+settings.SPID_CRYPTO_POOL_TIMEOUT = getattr(settings, "SPID_CRYPTO_POOL_TIMEOUT", 5)
+
+# Debug dumps of the SAML messages: at most SPID_SAML_LOG_MAX_SIZE characters
+# (0 for no limit) of a sample of SPID_SAML_LOG_SAMPLE_RATE of the messages
+settings.SPID_SAML_LOG_MAX_SIZE = getattr(settings, "SPID_SAML_LOG_MAX_SIZE", 8192)
+settings.SPID_SAML_LOG_SAMPLE_RATE = getattr(settings, "SPID_SAML_LOG_SAMPLE_RATE", 1.0)
+
+# Rotating audit log file of all the SAML messages sent to the IdPs (None disables it)
+settings.SPID_SAML_AUDIT_LOG = getattr(settings, "SPID_SAML_AUDIT_LOG", None)
+settings.SPID_SAML_AUDIT_LOG_MAX_BYTES = getattr(
+    settings, "SPID_SAML_AUDIT_LOG_MAX_BYTES", 10 * 1024 * 1024
+)
+settings.SPID_SAML_AUDIT_LOG_BACKUP_COUNT = getattr(
+    settings, "SPID_SAML_AUDIT_LOG_BACKUP_COUNT", 5
+)
+
+# Sink of the timings of the login, ACS and logout phases: the dotted path of
+# a class with a timing(name, seconds, tags) method, and optionally count()
+# and gauge() methods for the ACS statistics of the IdPs, for example the
+# StatsD sink "djangosaml2_spid.spid_metrics.StatsdSink" (None disables it)
+settings.SPID_METRICS_SINK = getattr(settings, "SPID_METRICS_SINK", None)
+settings.SPID_METRICS_PREFIX = getattr(settings, "SPID_METRICS_PREFIX", "spid")
+settings.SPID_METRICS_STATSD_ADDRESS = getattr(
+    settings, "SPID_METRICS_STATSD_ADDRESS", "127.0.0.1:8125"
+)
+
+# Seconds between the flushes of the ACS statistics of the IdPs, and max age
+# in seconds of the AuthnRequests kept in the session for the round trip times
+settings.SPID_METRICS_FLUSH_INTERVAL = getattr(
+    settings, "SPID_METRICS_FLUSH_INTERVAL", 60
+)
+settings.SPID_METRICS_ROUND_TRIP_MAX_AGE = getattr(
+    settings, "SPID_METRICS_ROUND_TRIP_MAX_AGE", 3600
+)
+
+# Limits of the SAMLResponse posted to the ACS, checked before it's parsed:
+# max size in bytes of the request body and of the base64 SAMLResponse
+# (None for no limit), max nesting depth and max attributes of an element
+settings.SPID_SAML_RESPONSE_MAX_SIZE = getattr(
+    settings, "SPID_SAML_RESPONSE_MAX_SIZE", 131072
+)
+settings.SPID_SAML_RESPONSE_MAX_DEPTH = getattr(
+    settings, "SPID_SAML_RESPONSE_MAX_DEPTH", 32
+)
+settings.SPID_SAML_RESPONSE_MAX_ATTRIBUTES = getattr(
+    settings, "SPID_SAML_RESPONSE_MAX_ATTRIBUTES", 32
+)
+
+# Alias of the Django cache of the IDs of the assertions received by the ACS,
+# to reject their replays (None disables it). A cache shared by all the nodes
+# (memcached, database, redis) is needed to detect the replays across nodes.
+settings.SPID_REPLAY_CACHE = getattr(settings, "SPID_REPLAY_CACHE", "default")
+
+# Cache of the signed SP metadata, its maximum number of documents and
+# max-age of the metadata responses
+settings.SPID_METADATA_CACHE = getattr(settings, "SPID_METADATA_CACHE", True)
+settings.SPID_METADATA_CACHE_SIZE = getattr(settings, "SPID_METADATA_CACHE_SIZE", 16)
+settings.SPID_METADATA_CACHE_MAX_AGE = getattr(
+    settings, "SPID_METADATA_CACHE_MAX_AGE", 3600
+)
+
+# Directory of the SP metadata pre-rendered with the render_sp_metadata command
+settings.SPID_METADATA_STATIC_DIR = getattr(settings, "SPID_METADATA_STATIC_DIR", None)
+
+# Remote metadata of the validation tools are fetched in background and
+# persisted into a local cache directory, that must be owned by the user of
+# the process and not writable by others (None disables the persistence)
+settings.SPID_REMOTE_METADATA_CACHE_DIR = getattr(
+    settings,
+    "SPID_REMOTE_METADATA_CACHE_DIR",
+    os.path.join(settings.BASE_DIR, "remote_metadata/"),
+)
+settings.SPID_REMOTE_METADATA_TTL = getattr(settings, "SPID_REMOTE_METADATA_TTL", 900)
+settings.SPID_REMOTE_METADATA_TIMEOUT = getattr(
+    settings, "SPID_REMOTE_METADATA_TIMEOUT", 10
+)
+
 # Avviso 29v3
 settings.SPID_PREFIXES = getattr(
     settings,
@@ -270,19 +404,131 @@ settings.SPID_OPTIONAL_ATTRIBUTES = getattr(
     ],
 )
 
+# Fraction of the responses (0.0 - 1.0) that are also validated in collect-all
+# mode with the profile SPID_VALIDATION_REPORT_PROFILE, logging all the violations
+settings.SPID_VALIDATION_REPORT_SAMPLE_RATE = getattr(
+    settings, "SPID_VALIDATION_REPORT_SAMPLE_RATE", 0.0
+)
+settings.SPID_VALIDATION_REPORT_PROFILE = getattr(
+    settings, "SPID_VALIDATION_REPORT_PROFILE", "strict"
+)
+
+# Cache of the SPConfig instances built for SPID requests
+settings.SPID_CONFIG_CACHE = getattr(settings, "SPID_CONFIG_CACHE", True)
+settings.SPID_CONFIG_CACHE_SIZE = getattr(settings, "SPID_CONFIG_CACHE_SIZE", 16)
+
+# Minimum interval in seconds between two scans of the IdPs metadata directory
+settings.SPID_METADATA_REFRESH_INTERVAL = getattr(
+    settings, "SPID_METADATA_REFRESH_INTERVAL", 30
+)
+
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
+@receiver(setting_changed)
+def clear_config_cache(**kwargs):
+    """Drop all the cached SPID configurations."""
+    with _config_cache_lock:
+        _config_cache.clear()
+
+
+def _stat_fingerprint(*paths):
+    """
+    Returns a cheap fingerprint of the given files, based on their
+    modification times and sizes.
+    """
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            fingerprint.append((path, None, None))
+        else:
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+def _config_fingerprint():
+    # IdPs metadata changes are handled by the shared metadata store
+    return _stat_fingerprint(settings.SPID_PUBLIC_CERT, settings.SPID_PRIVATE_KEY)
+
+
+def _remote_metadata_urls():
+    remote_urls = []
+    if settings.SPID_SAML_CHECK_IDP_ACTIVE:
+        remote_urls.append(settings.SPID_SAML_CHECK_METADATA_URL)
+    if settings.SPID_DEMO_IDP_ACTIVE:
+        remote_urls.append(settings.SPID_DEMO_METADATA_URL)
+    if settings.SPID_VALIDATOR_IDP_ACTIVE:
+        remote_urls.append(settings.SPID_VALIDATOR_METADATA_URL)
+    return remote_urls
+
+
+def get_base_url(request: HttpRequest) -> str:
+    return settings.SPID_BASE_URL or request.build_absolute_uri("/")
+
 
 def config_settings_loader(request: Optional[HttpRequest] = None) -> SPConfig:
-    conf = SPConfig()
     if request is None:
         # Not a SPID request: load SAML_CONFIG unchanged
+        conf = SPConfig()
         conf.load(copy.deepcopy(settings.SAML_CONFIG))
         return conf
 
-    # Build a SAML_CONFIG for SPID
-    base_url = settings.SPID_BASE_URL or request.build_absolute_uri("/")
+    base_url = get_base_url(request)
+    if settings.SPID_METADATA_URL_PATH in request.get_full_path():
+        md_type = "spid"
+    else:
+        md_type = "cie"
+
+    return get_spid_config(base_url, md_type)
+
+
+def get_spid_config(base_url: str, md_type: str = "spid") -> SPConfig:
+    """
+    Returns the SPConfig for a base URL and a metadata type ('spid' or 'cie').
+    Configurations are cached per process and are rebuilt only when the SP
+    certificates change on disk. The IdPs metadata is kept in a metadata
+    store shared by all the configurations, that reloads changed files.
+    """
+    if not settings.SPID_CONFIG_CACHE:
+        return build_spid_config(base_url, md_type)
+
+    key = (
+        base_url,
+        md_type,
+        settings.SPID_SAML_CHECK_IDP_ACTIVE,
+        settings.SPID_DEMO_IDP_ACTIVE,
+        settings.SPID_VALIDATOR_IDP_ACTIVE,
+    )
+    fingerprint = _config_fingerprint()
+
+    with _config_cache_lock:
+        cached_fingerprint, conf = _config_cache.get(key, (None, None))
+
+    if conf is not None and cached_fingerprint == fingerprint:
+        conf.metadata.refresh()
+        return conf
+
+    conf = build_spid_config(base_url, md_type)
+
+    with _config_cache_lock:
+        _config_cache.pop(key, None)
+        while len(_config_cache) >= settings.SPID_CONFIG_CACHE_SIZE > 0:
+            # Discard the oldest entry, base URLs may come from Host headers
+            del _config_cache[next(iter(_config_cache))]
+        _config_cache[key] = (fingerprint, conf)
+
+    return conf
+
+
+def build_spid_config(base_url: str, md_type: str = "spid") -> SPConfig:
+    """Builds a new SPConfig for SPID/CIE, without using the cache."""
+    conf = SPConfig()
     metadata_url = urljoin(base_url, settings.SPID_METADATA_URL_PATH)
 
-    if settings.SPID_METADATA_URL_PATH in request.get_full_path():
+    if md_type == "spid":
         _REQUIRED_ATTRIBUTES = settings.SPID_REQUIRED_ATTRIBUTES
         _OPTIONAL_ATTRIBUTES = settings.SPID_OPTIONAL_ATTRIBUTES
     else:
@@ -347,10 +593,6 @@ def config_settings_loader(request: Optional[HttpRequest] = None) -> SPConfig:
         "disable_ssl_certificate_validation": settings.SAML_CONFIG.get(
             "disable_ssl_certificate_validation"
         ),
-        "metadata": {
-            "local": [settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR],
-            "remote": [],
-        },
         # Signing
         "key_file": settings.SPID_PRIVATE_KEY,
         "cert_file": settings.SPID_PUBLIC_CERT,
@@ -376,21 +618,26 @@ def config_settings_loader(request: Optional[HttpRequest] = None) -> SPConfig:
             ["/opt/local/bin", "/usr/bin/xmlsec1"]
         )
 
-    if settings.SPID_SAML_CHECK_IDP_ACTIVE:
-        saml_config["metadata"]["remote"].append(
-            {"url": settings.SPID_SAML_CHECK_METADATA_URL}
+    if settings.SPID_CRYPTO_BACKEND == PYTHON_XMLSEC_BACKEND:
+        if xmlsec is None:
+            raise ImproperlyConfigured(
+                "Il pacchetto python xmlsec è richiesto "
+                f"per SPID_CRYPTO_BACKEND = {PYTHON_XMLSEC_BACKEND!r}!"
+            )
+        saml_config["crypto_backend"] = PYTHON_XMLSEC_BACKEND
+    elif settings.SPID_CRYPTO_BACKEND != "xmlsec1":
+        raise ImproperlyConfigured(
+            f"Valore non valido per SPID_CRYPTO_BACKEND: {settings.SPID_CRYPTO_BACKEND!r}"
         )
-
-    if settings.SPID_DEMO_IDP_ACTIVE:
-        saml_config["metadata"]["remote"].append(
-            {"url": settings.SPID_DEMO_METADATA_URL}
+    elif settings.SPID_CRYPTO_POOL_SIZE:
+        raise ImproperlyConfigured(
+            "SPID_CRYPTO_POOL_SIZE richiede "
+            f"SPID_CRYPTO_BACKEND = {PYTHON_XMLSEC_BACKEND!r}!"
         )
 
-    if settings.SPID_VALIDATOR_IDP_ACTIVE:
-        saml_config["metadata"]["remote"].append(
-            {"url": settings.SPID_VALIDATOR_METADATA_URL}
-        )
-
-    logger.debug(f"SAML_CONFIG: {saml_config}")
+    logger.debug("SAML_CONFIG: %s", saml_config)
     conf.load(saml_config)
+
+    # Local and remote IdPs metadata are loaded into the shared store
+    conf.metadata = get_metadata_store(conf, _remote_metadata_urls())
     return conf
@@ -0,0 +1,184 @@
+#
+# Bounded executors: the thread pool used by the async views to run the
+# CPU-bound work (configuration loading, signing and verification of the
+# SAML messages) out of the event loop, and the optional process pool
+# where the XML signatures are computed and verified.
+#
+import asyncio
+import contextvars
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+logger = logging.getLogger("djangosaml2")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_crypto_pool = None
+_crypto_pool_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the executor of the SPID views, creating it on first use with
+    at most SPID_EXECUTOR_MAX_WORKERS threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.SPID_EXECUTOR_MAX_WORKERS,
+                thread_name_prefix="spid-executor",
+            )
+        return _executor
+
+
+@receiver(setting_changed)
+def shutdown_executor(setting, **kwargs):
+    """Shuts down the executor, a new one is created by the next call."""
+    global _executor
+    if setting != "SPID_EXECUTOR_MAX_WORKERS":
+        return
+
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def _run_job(func, *args, **kwargs):
+    # A job may use the ORM, the sessions or a database cache: the database
+    # connections of the worker thread are closed if unusable or older than
+    # CONN_MAX_AGE before and after it, as Django does for each request
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    Runs a callable in the executor of the SPID views, in a copy of the
+    current context, and returns its result.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(),
+        functools.partial(context.run, _run_job, func, *args, **kwargs),
+    )
+
+
+class CryptoPoolBusy(RuntimeError):
+    """Raised when no slot of the crypto pool is freed within the timeout."""
+
+
+class CryptoPoolStats:
+    """Counters of the crypto pool jobs and of the time they wait in queue."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.completed = 0
+        self.rejected = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def add(self, queue_time):
+        with self.lock:
+            self.completed += 1
+            self.queue_time_total += queue_time
+            self.queue_time_max = max(self.queue_time_max, queue_time)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "queue_time_avg": self.queue_time_total / self.completed
+                if self.completed else 0.0,
+                "queue_time_max": self.queue_time_max,
+            }
+
+
+crypto_pool_stats = CryptoPoolStats()
+
+
+def get_crypto_pool():
+    """
+    Returns the process pool of SPID_CRYPTO_POOL_SIZE workers and the
+    semaphore that bounds its jobs, creating them on first use.
+    """
+    global _crypto_pool
+    with _crypto_pool_lock:
+        if _crypto_pool is None:
+            size = settings.SPID_CRYPTO_POOL_SIZE
+            # The workers are spawned, forking a multi-threaded server is unsafe
+            pool = ProcessPoolExecutor(
+                max_workers=size, mp_context=multiprocessing.get_context("spawn")
+            )
+            slots = threading.BoundedSemaphore(
+                size + settings.SPID_CRYPTO_POOL_QUEUE_SIZE
+            )
+            _crypto_pool = pool, slots
+        return _crypto_pool
+
+
+@receiver(setting_changed)
+def shutdown_crypto_pool(setting=None, **kwargs):
+    """Shuts down the crypto pool, a new one is created by the next call."""
+    global _crypto_pool
+    if setting is not None and not setting.startswith("SPID_CRYPTO_POOL_"):
+        return
+
+    with _crypto_pool_lock:
+        crypto_pool, _crypto_pool = _crypto_pool, None
+    if crypto_pool is not None:
+        crypto_pool[0].shutdown(wait=False)
+
+
+def _run_timed(func, submitted_at, *args):
+    return time.time() - submitted_at, func(*args)
+
+
+def run_in_crypto_pool(func, *args):
+    """
+    Runs a picklable callable in the crypto pool and waits for its result.
+    At most SPID_CRYPTO_POOL_SIZE + SPID_CRYPTO_POOL_QUEUE_SIZE jobs are
+    accepted, the others wait for a slot up to SPID_CRYPTO_POOL_TIMEOUT
+    seconds and then raise CryptoPoolBusy.
+    """
+    global _crypto_pool
+    pool, slots = get_crypto_pool()
+    if not slots.acquire(timeout=settings.SPID_CRYPTO_POOL_TIMEOUT):
+        with crypto_pool_stats.lock:
+            crypto_pool_stats.rejected += 1
+        raise CryptoPoolBusy("The crypto pool is busy")
+
+    try:
+        queue_time, result = pool.submit(_run_timed, func, time.time(), *args).result()
+    except BrokenProcessPool:
+        logger.error("A crypto pool worker died, the pool will be recreated")
+        with _crypto_pool_lock:
+            if _crypto_pool is not None and _crypto_pool[0] is pool:
+                _crypto_pool = None
+        raise
+    finally:
+        slots.release()
+
+    crypto_pool_stats.add(queue_time)
+    logger.debug(f"{func.__name__} waited {queue_time * 1000:.3f}ms in the crypto pool")
+    return result
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from djangosaml2_spid.conf import get_spid_config
+from djangosaml2_spid.spid_metadata import italian_sp_metadata, sp_metadata_static_path
+from djangosaml2_spid.utils import write_file_atomic
+
+
+class Command(BaseCommand):
+    help = "Render the signed SPID and CIE metadata of the SP to static files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--base-url",
+            action="append",
+            dest="base_urls",
+            help="Base URL of the SP, can be repeated (default: SPID_BASE_URL)",
+        )
+        parser.add_argument(
+            "--md-type",
+            action="append",
+            dest="md_types",
+            choices=["spid", "cie"],
+            help="Type of metadata to render, can be repeated (default: both)",
+        )
+        parser.add_argument(
+            "--output-dir",
+            default=settings.SPID_METADATA_STATIC_DIR,
+            help="Output directory (default: SPID_METADATA_STATIC_DIR)",
+        )
+
+    def handle(self, *args, **options):
+        base_urls = options["base_urls"] or [settings.SPID_BASE_URL]
+        if None in base_urls:
+            raise CommandError("Provide a --base-url or configure SPID_BASE_URL")
+        if not options["output_dir"]:
+            raise CommandError(
+                "Provide an --output-dir or configure SPID_METADATA_STATIC_DIR"
+            )
+
+        for base_url in base_urls:
+            for md_type in options["md_types"] or ["spid", "cie"]:
+                self.render_metadata(base_url, md_type, options["output_dir"])
+
+        self.print_success(
+            f"Successfully rendered all SP metadata files into {options['output_dir']}"
+        )
+
+    def render_metadata(self, base_url, md_type, output_dir):
+        try:
+            metadata_file_path = sp_metadata_static_path(base_url, md_type, output_dir)
+        except ValueError as err:
+            raise CommandError(str(err))
+        conf = get_spid_config(base_url, md_type)
+        content = str(italian_sp_metadata(conf, md_type)).encode("utf-8")
+
+        self.print(
+            f"Writing {md_type.upper()} metadata of {conf.entityid} "
+            f"into {metadata_file_path}",
+            indentation_level=1,
+        )
+
+        # Write to a temporary file and rename it, so that a web server
+        # never reads a partially written file
+        write_file_atomic(metadata_file_path, content)
+
+    def print(self, string, *, indentation_level=0):
+        indentation = "  " * indentation_level
+        self.stdout.write(indentation + string)
+
+    def print_success(self, string, *, indentation_level=0):
+        self.print(self.style.SUCCESS(string), indentation_level=indentation_level)
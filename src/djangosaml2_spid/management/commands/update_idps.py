@@ -1,44 +1,237 @@
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 import os
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from saml2 import SAMLError
+from saml2.mdstore import InMemoryMetaData
+from saml2.sigver import CryptoBackendXmlSec1, get_xmlsec_binary
+from urllib3.util.retry import Retry
+
+from djangosaml2_spid.spid_crypto import (
+    PYTHON_XMLSEC_BACKEND,
+    check_signature_constraints,
+    verify_xml,
+    xmlsec,
+)
+from djangosaml2_spid.spid_mdstore import metadata_ttl, write_metadata_snapshot
+from djangosaml2_spid.utils import write_file_atomic
+
+# Validators (ETag and Last-Modified) of the downloaded metadata
+STATE_FILE_NAME = ".update_idps.json"
+
+# Counters of the daemon mode
+STATUS_FILE_NAME = ".update_idps.status.json"
+
+# Snapshots of the metadata directory, when it's a symbolic link
+SNAPSHOT_INFIX = ".snapshot-"
+
+# Bounds in seconds of the delay between two runs of the daemon mode
+MIN_INTERVAL = 60
+RETRY_INTERVAL = 60
+
+
+class MetadataRejected(Exception):
+    """A downloaded metadata document that doesn't pass the validation."""
 
 
 class Command(BaseCommand):
     help = "Download and write all the official identity providers metadata XML files"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of concurrent downloads (default: 8)",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=10,
+            help="Connect and read timeout in seconds for each host (default: 10)",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=3,
+            help="Retries of a failed request (default: 3)",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Download all the metadata, also if they are not modified",
+        )
+        parser.add_argument(
+            "--daemon",
+            action="store_true",
+            help="Keep running and update the metadata periodically",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=3600,
+            help="Seconds between two updates in daemon mode, shortened by the "
+                 "cacheDuration of the metadata (default: 3600)",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=0.1,
+            help="Random variation of the interval, as a fraction (default: 0.1)",
+        )
+
     def handle(self, *args, **options):
-        self.write_identity_providers_metadata()
+        self.workers = max(options["workers"], 1)
+        self.timeout = options["timeout"]
+        self.force = options["force"]
+        self.validate_signature = self.get_signature_validator()
+        self.ttls = {}
+        with self.get_session(options["retries"]) as self.session:
+            if options["daemon"]:
+                self.run_daemon(options["interval"], min(max(options["jitter"], 0), 1))
+            else:
+                self.write_identity_providers_metadata()
 
-    def write_identity_providers_metadata(self):
-        identity_providers = self.download_identity_providers()
+    def run_daemon(self, interval, jitter):
+        """
+        Updates the metadata until SIGINT or SIGTERM is received, waiting a
+        jittered interval between two runs. The counters of the runs are
+        written into the status file of the metadata directory.
+        """
+        self.stop = threading.Event()
+        handlers = {
+            signum: signal.signal(signum, lambda *args: self.stop.set())
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        self.status = {
+            "last_success": None,
+            "last_failure": None,
+            "last_error": None,
+            "successes": 0,
+            "failures": 0,
+            "consecutive_failures": 0,
+        }
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.write_identity_providers_metadata()
+                except Exception as err:
+                    self.stderr.write(f"Update of the IdPs metadata failed: {err}")
+                    self.status.update(
+                        last_failure=time.time(),
+                        last_error=str(err),
+                        failures=self.status["failures"] + 1,
+                        consecutive_failures=self.status["consecutive_failures"] + 1,
+                    )
+                else:
+                    self.status.update(
+                        last_success=time.time(),
+                        successes=self.status["successes"] + 1,
+                        consecutive_failures=0,
+                    )
+                self.write_status()
+                self.force = False
 
-        self.print(
-            f"Starting writing of IdPs metadata XML files "
-            f"into {settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR}:"
-        )
+                delay = self.next_delay(interval, jitter)
+                self.print(f"Next update of the IdPs metadata in {delay:.0f}s")
+                self.stop.wait(delay)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
 
-        for identity_provider in identity_providers:
-            idp_entity_code = identity_provider["ipa_entity_code"]
-            idp_entity_name = identity_provider["entity_name"]
-            idp_metadata = identity_provider["metadata"]
-            metadata_file_path = os.path.join(
-                settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR, f"{idp_entity_code}.xml"
+    def next_delay(self, interval, jitter):
+        """
+        Returns the seconds to wait before the next run: the interval, bounded
+        by the cacheDuration and validUntil of the metadata, or an exponential
+        backoff after failed runs.
+        """
+        min_interval = min(MIN_INTERVAL, interval)
+        failures = self.status["consecutive_failures"]
+        if failures:
+            delay = min(interval, RETRY_INTERVAL * 2 ** min(failures - 1, 16))
+        else:
+            delay = min(interval, *self.ttls.values())
+        delay = max(delay, min_interval)
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    def write_status(self):
+        path = os.path.join(settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR, STATUS_FILE_NAME)
+        try:
+            write_file_atomic(
+                path, json.dumps(self.status, indent=2, sort_keys=True).encode("utf8")
             )
+        except OSError as err:
+            self.stderr.write(f"Cannot write the status file {path}: {err}")
 
-            self.print(
-                f"Writing metadata XML file for IdP {idp_entity_name} "
-                f"into {metadata_file_path}",
-                indentation_level=1,
+    def get_session(self, retries):
+        """Returns a session with a connection pool for each concurrent download."""
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_signature_validator(self):
+        """
+        Returns the function that verifies the signature of the metadata
+        with the federation certificate, or `None` if it isn't configured.
+        """
+        if not settings.SPID_IDENTITY_PROVIDERS_METADATA_CERT:
+            return None
+        if not os.path.isfile(settings.SPID_IDENTITY_PROVIDERS_METADATA_CERT):
+            raise CommandError(
+                f"Federation certificate not found: "
+                f"{settings.SPID_IDENTITY_PROVIDERS_METADATA_CERT}"
             )
+        if settings.SPID_CRYPTO_BACKEND == PYTHON_XMLSEC_BACKEND:
+            if xmlsec is None:
+                raise CommandError("The python xmlsec package is not installed")
+            return verify_xml
+        return CryptoBackendXmlSec1(get_xmlsec_binary()).validate_signature
+
+    def write_identity_providers_metadata(self):
+        """
+        Downloads the metadata of the IdPs and activates the validated ones.
+        The IdPs whose metadata are rejected or cannot be downloaded keep
+        their previous files, and a CommandError lists them.
+        """
+        metadata_dir = settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR
+        identity_providers = self.download_identity_providers()
+
+        updated = [x for x in identity_providers if x["metadata"] is not None]
+        if updated:
+            self.print(f"Starting writing of IdPs metadata XML files into {metadata_dir}:")
+            self.activate_metadata(updated)
+            self.notify_workers(updated)
 
-            with open(metadata_file_path, "w", encoding="utf8") as metadata_file:
-                metadata_file.write(idp_metadata)
+        self.print_summary(identity_providers)
+
+        errors = [x for x in identity_providers if x["error"] is not None]
+        if errors:
+            raise CommandError(
+                f"Cannot update the metadata of {len(errors)} IdPs: "
+                + ", ".join(x["entity_name"] for x in errors)
+            )
 
         self.print_success(
-            f"Successfully wrote all IdPs metadata XML files "
-            f"into {settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR}"
+            f"Successfully wrote all IdPs metadata XML files into {metadata_dir}"
         )
 
     def download_identity_providers(self):
@@ -47,29 +240,291 @@ class Command(BaseCommand):
             f"official list from {settings.SPID_IDENTITY_PROVIDERS_URL}"
         )
 
-        with requests.get(
-            settings.SPID_IDENTITY_PROVIDERS_URL, verify=True
+        with self.session.get(
+            settings.SPID_IDENTITY_PROVIDERS_URL, verify=True, timeout=self.timeout
         ) as response:
+            response.raise_for_status()
             identity_providers = json.loads(response.content)["data"]
 
         self.print("Downloaded IdPs official list, starting IdPs metadata download:")
 
-        for identity_provider in identity_providers:
-            idp_entity_name = identity_provider["entity_name"]
-            idp_metadata_url = identity_provider["metadata_url"]
+        state = {} if self.force else self.load_state()
+        ttls, self.ttls = self.ttls, {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self.download_metadata, identity_provider, state)
+                for identity_provider in identity_providers
+            ]
+            for future in as_completed(futures):
+                identity_provider = future.result()
+                name = os.path.basename(self.metadata_file_path(identity_provider))
+                if identity_provider["ttl"] is not None:
+                    self.ttls[name] = identity_provider["ttl"]
+                elif name in ttls:
+                    self.ttls[name] = ttls[name]
+                if identity_provider["error"] is not None:
+                    self.stderr.write(
+                        f"  Cannot update metadata for IdP "
+                        f"{identity_provider['entity_name']} from "
+                        f"{identity_provider['metadata_url']}: {identity_provider['error']}"
+                    )
+                else:
+                    self.print(
+                        f"Downloaded metadata for IdP {identity_provider['entity_name']} "
+                        f"from {identity_provider['metadata_url']}",
+                        indentation_level=1,
+                    )
+
+        if all(x["error"] is None for x in identity_providers):
+            self.print_success("All IdPs metadata downloaded successfully")
 
+        return identity_providers
+
+    def download_metadata(self, identity_provider, state):
+        """
+        Downloads and validates the metadata of an IdP, with a conditional
+        request if the metadata file was already written. Sets the 'metadata'
+        of the IdP to `None` if the metadata is not modified, cannot be
+        downloaded or is not valid.
+        """
+        idp_metadata_url = identity_provider["metadata_url"]
+        identity_provider.update(
+            metadata=None, etag=None, last_modified=None, error=None, size=0, ttl=None
+        )
+
+        headers = {}
+        metadata_file_path = self.metadata_file_path(identity_provider)
+        validators = state.get(os.path.basename(metadata_file_path))
+        if validators and validators["url"] == idp_metadata_url \
+                and os.path.exists(metadata_file_path):
+            if validators["etag"]:
+                headers["If-None-Match"] = validators["etag"]
+            if validators["last_modified"]:
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        start_time = time.monotonic()
+        try:
+            with self.session.get(
+                idp_metadata_url,
+                headers=headers,
+                verify=True,
+                timeout=self.timeout,
+                stream=True,
+            ) as response:
+                if response.status_code != 304:
+                    response.raise_for_status()
+                    content = self.read_metadata(response)
+                    identity_provider["size"] = len(content)
+                    _md = self.validate_metadata(content)
+                    identity_provider.update(
+                        metadata=content,
+                        ttl=metadata_ttl(_md, float("inf")),
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                    )
+        except (requests.RequestException, MetadataRejected) as err:
+            identity_provider.update(metadata=None, error=err)
+        identity_provider["elapsed"] = time.monotonic() - start_time
+        return identity_provider
+
+    def read_metadata(self, response):
+        """Reads the body of a response, up to the maximum size of a document."""
+        max_size = settings.SPID_IDENTITY_PROVIDERS_METADATA_MAX_SIZE
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            content += chunk
+            if max_size and len(content) > max_size:
+                raise MetadataRejected(f"metadata larger than {max_size} bytes")
+        return bytes(content)
+
+    def validate_metadata(self, content):
+        """
+        Parses a metadata document as the workers do, rejecting expired
+        documents and documents without IdPs, then verifies its signature
+        with the federation certificate, if configured. The signature must
+        reference the ID of the root element of the document. Returns the
+        parsed metadata.
+        """
+        _md = InMemoryMetaData([], check_validity=True)
+        try:
+            _md.parse(content)
+        except Exception as err:
+            raise MetadataRejected(f"invalid metadata: {err}") from err
+        if _md.to_old:
+            raise MetadataRejected(f"validUntil expired for {', '.join(_md.to_old)}")
+        if not any("idpsso_descriptor" in x for x in _md.entity.values()):
+            raise MetadataRejected("no IdPs found into the metadata")
+
+        if self.validate_signature is None:
+            return _md
+
+        descriptor = _md.entities_descr or _md.entity_descr
+        if descriptor.signature is None:
+            raise MetadataRejected("unsigned metadata")
+        try:
+            check_signature_constraints(descriptor)
+            verified = self.validate_signature(
+                content,
+                settings.SPID_IDENTITY_PROVIDERS_METADATA_CERT,
+                "pem",
+                f"{descriptor.c_namespace}:{descriptor.c_tag}",
+                descriptor.id,
+            )
+        except SAMLError as err:
+            raise MetadataRejected(f"invalid signature: {err}") from err
+        if not verified:
+            raise MetadataRejected("invalid signature")
+        return _md
+
+    def activate_metadata(self, identity_providers):
+        """
+        Writes the validated metadata, the files of the other IdPs are left
+        unchanged. The metadata are written into a new snapshot of the
+        directory, with a copy of the previous files, and the metadata
+        directory, a symbolic link to the active snapshot, is switched to it
+        in one step. A plain directory is moved aside and replaced by the
+        link on the first run; if it can't be moved (eg. a mount point) its
+        files are replaced one by one, which is not atomic.
+        """
+        metadata_dir = os.path.normpath(settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR)
+        state = self.load_state()
+
+        parent_dir, name = os.path.split(metadata_dir)
+        snapshot_prefix = f"{name}{SNAPSHOT_INFIX}"
+        plain_dir = os.path.isdir(metadata_dir) and not os.path.islink(metadata_dir)
+        try:
+            snapshot_dir = tempfile.mkdtemp(
+                prefix=f"{snapshot_prefix}{time.strftime('%Y%m%d%H%M%S')}-", dir=parent_dir
+            )
+        except OSError as err:
+            if not plain_dir:
+                raise
+            self.write_metadata_in_place(metadata_dir, identity_providers, state, err)
+            return
+
+        try:
+            os.chmod(snapshot_dir, 0o755)
+            if os.path.isdir(metadata_dir):
+                for entry in os.scandir(metadata_dir):
+                    if entry.is_file():
+                        shutil.copy2(entry.path, snapshot_dir)
+            self.write_metadata(snapshot_dir, identity_providers, state)
+
+            tmp_link = os.path.join(parent_dir, f".{name}.{os.getpid()}.tmp")
+            os.symlink(os.path.basename(snapshot_dir), tmp_link)
+            # Sorted before the snapshots, removed by the next runs
+            previous_dir = os.path.join(parent_dir, f"{snapshot_prefix}00000000000000-{name}")
+            try:
+                if plain_dir:
+                    os.rename(metadata_dir, previous_dir)
+            except OSError as err:
+                os.unlink(tmp_link)
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+                self.write_metadata_in_place(metadata_dir, identity_providers, state, err)
+                return
+            try:
+                os.replace(tmp_link, metadata_dir)
+            except BaseException:
+                if plain_dir:
+                    os.rename(previous_dir, metadata_dir)
+                raise
+        except BaseException:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            raise
+
+        if plain_dir:
+            self.print(f"Replaced the directory {metadata_dir} with a link", indentation_level=1)
+        self.print(f"Activated metadata snapshot {snapshot_dir}", indentation_level=1)
+
+        # The previous snapshot is kept for the workers that are reading it
+        snapshots = sorted(
+            entry.path for entry in os.scandir(parent_dir or ".")
+            if entry.name.startswith(snapshot_prefix)
+            and entry.is_dir(follow_symlinks=False)
+        )
+        for path in snapshots[:-2]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def notify_workers(self, identity_providers):
+        """
+        Rewrites the stamp file, if configured, so that the workers scan the
+        metadata directory again.
+        """
+        if not settings.SPID_IDENTITY_PROVIDERS_METADATA_STAMP:
+            return
+        stamp = {
+            "updated_at": time.time(),
+            "identity_providers": sorted(x["entity_name"] for x in identity_providers),
+        }
+        write_file_atomic(
+            settings.SPID_IDENTITY_PROVIDERS_METADATA_STAMP,
+            json.dumps(stamp, indent=2).encode("utf8"),
+        )
+
+    def write_metadata_in_place(self, metadata_dir, identity_providers, state, err):
+        self.stderr.write(
+            f"Cannot replace {metadata_dir} with a link to a snapshot ({err}), "
+            "the metadata files are updated one by one"
+        )
+        self.write_metadata(metadata_dir, identity_providers, state)
+
+    def write_metadata(self, metadata_dir, identity_providers, state):
+        for identity_provider in identity_providers:
+            metadata_file_path = os.path.join(
+                metadata_dir, os.path.basename(self.metadata_file_path(identity_provider))
+            )
             self.print(
-                f"Downloading metadata for IdP {idp_entity_name} "
-                f"from {idp_metadata_url}",
+                f"Writing metadata XML file for IdP {identity_provider['entity_name']} "
+                f"into {metadata_file_path}",
                 indentation_level=1,
             )
+            write_file_atomic(metadata_file_path, identity_provider["metadata"])
+            state[os.path.basename(metadata_file_path)] = {
+                "url": identity_provider["metadata_url"],
+                "etag": identity_provider["etag"],
+                "last_modified": identity_provider["last_modified"],
+            }
 
-            with requests.get(idp_metadata_url, verify=True) as response:
-                identity_provider["metadata"] = response.text
+        path = os.path.join(metadata_dir, STATE_FILE_NAME)
+        write_file_atomic(path, json.dumps(state, indent=2, sort_keys=True).encode("utf8"))
+        write_metadata_snapshot(metadata_dir)
 
-        self.print_success("All IdPs metadata downloaded successfully")
+    def metadata_file_path(self, identity_provider):
+        return os.path.join(
+            settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR,
+            f"{identity_provider['ipa_entity_code']}.xml",
+        )
 
-        return identity_providers
+    def load_state(self):
+        path = os.path.join(settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR, STATE_FILE_NAME)
+        try:
+            with open(path, encoding="utf8") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def print_summary(self, identity_providers):
+        self.print("Summary:")
+        total_size = 0
+        for identity_provider in identity_providers:
+            if isinstance(identity_provider["error"], MetadataRejected):
+                status = "rejected"
+            elif identity_provider["error"] is not None:
+                status = "error"
+            elif identity_provider["metadata"] is None:
+                status = "not modified"
+            else:
+                status = "updated"
+            total_size += identity_provider["size"]
+            self.print(
+                f"{identity_provider['entity_name']}: {status}, "
+                f"{identity_provider['size']} bytes "
+                f"in {identity_provider['elapsed']:.3f}s",
+                indentation_level=1,
+            )
+        self.print(
+            f"Fetched {total_size} bytes of metadata of {len(identity_providers)} IdPs"
+        )
 
     def print(self, string, *, indentation_level=0):
         indentation = "  " * indentation_level
@@ -0,0 +1,481 @@
+#
+# In-process crypto backend for pysaml2, based on the python bindings
+# of xmlsec (https://github.com/xmlsec/python-xmlsec), that is used
+# when SPID_CRYPTO_BACKEND = 'python-xmlsec'.
+#
+import hashlib
+import logging
+import os
+import threading
+
+from django.conf import settings
+from saml2 import SamlBase
+from saml2.sigver import (
+    NODE_NAME,
+    CryptoBackendXmlSec1,
+    RSACrypto,
+    SecurityContext,
+    SignatureError,
+    SigverError,
+    get_xmlsec_binary,
+    import_rsa_key_from_file,
+    pem_format,
+)
+from saml2.xmldsig import (
+    ALLOWED_CANONICALIZATIONS,
+    ALLOWED_TRANSFORMS,
+    TRANSFORM_ENVELOPED,
+)
+
+try:
+    import xmlsec
+    from lxml import etree
+except ImportError:
+    xmlsec = etree = None
+else:
+    if not hasattr(xmlsec, "SignatureContext"):
+        # Another package (eg. pyXMLSecurity) is installed as 'xmlsec'
+        xmlsec = etree = None
+
+from .executor import run_in_crypto_pool
+from .spid_metrics import timed
+
+logger = logging.getLogger("djangosaml2")
+
+PYTHON_XMLSEC_BACKEND = "python-xmlsec"
+VERIFICATION_KEY_PREFIX = "spid-verification-key:"
+
+DS_SIGNATURE_TAG = "{http://www.w3.org/2000/09/xmldsig#}Signature"
+DS_REFERENCE_PATH = (
+    "{http://www.w3.org/2000/09/xmldsig#}SignedInfo/"
+    "{http://www.w3.org/2000/09/xmldsig#}Reference"
+)
+
+_private_keys = {}
+_rsa_keys = {}
+_verification_keys = {}  # name -> xmlsec.Key
+_verification_certs = {}  # name -> PEM, for the crypto pool workers
+_lock = threading.Lock()
+
+
+def load_private_key(key_file):
+    """
+    Returns the xmlsec private key loaded from a PEM file. Keys are loaded
+    once per process and are reloaded only when the file changes.
+    """
+    mtime_ns = os.stat(key_file).st_mtime_ns
+    with _lock:
+        try:
+            key, key_mtime_ns = _private_keys[key_file]
+        except KeyError:
+            pass
+        else:
+            if key_mtime_ns == mtime_ns:
+                return key
+
+        key = xmlsec.Key.from_file(key_file, xmlsec.constants.KeyDataFormatPem)
+        _private_keys[key_file] = key, mtime_ns
+        return key
+
+
+def get_rsa_crypto(key_file):
+    """Returns a cached RSACrypto, used for signing the HTTP-Redirect binding."""
+    mtime_ns = os.stat(key_file).st_mtime_ns
+    with _lock:
+        try:
+            rsa_crypto, key_mtime_ns = _rsa_keys[key_file]
+        except KeyError:
+            pass
+        else:
+            if key_mtime_ns == mtime_ns:
+                return rsa_crypto
+
+        rsa_crypto = RSACrypto(import_rsa_key_from_file(key_file))
+        _rsa_keys[key_file] = rsa_crypto, mtime_ns
+        return rsa_crypto
+
+
+def check_signature_constraints(item):
+    """
+    Checks the constraints of the SAML specifications on the signature of
+    a parsed element, as pysaml2 does for the responses and the assertions:
+    a single reference to the ID of the element, an allowed canonicalization
+    method, the enveloped-signature transform and no other transform than
+    the exclusive canonicalization. Prevents signature wrapping attacks,
+    where a signed element is moved into an unsigned document. Raises a
+    SignatureError if a constraint isn't satisfied.
+    """
+    if not item.id:
+        raise SignatureError(f"Missing ID attribute for the signed {item.c_tag}")
+
+    signed_info = item.signature.signed_info
+    if len(signed_info.reference) != 1:
+        raise SignatureError("The signature must have a single reference")
+
+    reference = signed_info.reference[0]
+    if reference.uri != f"#{item.id}":
+        raise SignatureError(
+            f"The signature reference {reference.uri!r} doesn't point "
+            f"to the ID of the signed {item.c_tag}"
+        )
+    if signed_info.canonicalization_method.algorithm not in ALLOWED_CANONICALIZATIONS:
+        raise SignatureError("Canonicalization method not allowed")
+
+    transforms = [x.algorithm for x in reference.transforms.transform] if reference.transforms else []
+    if (
+        not 1 <= len(transforms) <= 2
+        or TRANSFORM_ENVELOPED not in transforms
+        or not ALLOWED_TRANSFORMS.issuperset(transforms)
+    ):
+        raise SignatureError(f"Signature transforms not allowed: {transforms}")
+    if item.signature.object:
+        raise SignatureError("The signature must not contain ds:Object elements")
+
+
+def find_signature(root, node_name, node_id):
+    """
+    Returns the ds:Signature child of the node to be signed or verified.
+    When an ID is given, the node must be the only one with that ID.
+    """
+    namespace, _, local_name = node_name.rpartition(":")
+    nodes = root.iter(f"{{{namespace}}}{local_name}")
+    if node_id:
+        nodes = [x for x in nodes if x.get("ID") == node_id]
+        if len(nodes) != 1:
+            return None
+    for node in nodes:
+        signature_node = node.find(DS_SIGNATURE_TAG)
+        if signature_node is not None:
+            return signature_node
+    return None
+
+
+def parse_xml(text):
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+    return etree.fromstring(text, parser=parser)
+
+
+def sign_xml(statement, node_name, key_file, node_id):
+    """
+    Signs the node of an XML document with the private key of a PEM file
+    and returns the signed document. Can be run into the crypto pool.
+    """
+    try:
+        root = parse_xml(statement)
+    except etree.XMLSyntaxError as err:
+        raise SignatureError(f"Cannot parse {node_name}: {err}") from err
+
+    xmlsec.tree.add_ids(root, ["ID"])
+    signature_node = find_signature(root, node_name, node_id)
+    if signature_node is None:
+        raise SignatureError(f"Signature template not found for {node_name}")
+
+    ctx = xmlsec.SignatureContext()
+    try:
+        ctx.key = load_private_key(key_file)
+        ctx.sign(signature_node)
+    except (xmlsec.Error, OSError) as err:
+        raise SignatureError(f"Cannot sign {node_name} {node_id}: {err}") from err
+
+    return etree.tostring(
+        root.getroottree(), xml_declaration=True, encoding="UTF-8"
+    ).decode("utf-8")
+
+
+def get_verification_key(cert_file, cert_type, cert_pem=None):
+    """
+    Returns the xmlsec key of a certificate file, or of a key of the IdPs
+    signing keys index. The PEM of an index key is required by the crypto
+    pool workers, that load it the first time it's used.
+    """
+    try:
+        return _verification_keys[cert_file]
+    except KeyError:
+        pass
+
+    try:
+        if cert_pem is not None:
+            key = xmlsec.Key.from_memory(cert_pem, xmlsec.constants.KeyDataFormatCertPem)
+            with _lock:
+                return _verification_keys.setdefault(cert_file, key)
+
+        key_format = xmlsec.constants.KeyDataFormatCertPem \
+            if cert_type == "pem" else xmlsec.constants.KeyDataFormatCertDer
+        return xmlsec.Key.from_file(cert_file, key_format)
+    except (xmlsec.Error, OSError) as err:
+        raise SignatureError(f"Cannot load certificate {cert_file}: {err}") from err
+
+
+def verify_xml(signedtext, cert_file, cert_type, node_name, node_id, cert_pem=None):
+    """
+    Verifies the signature of the node of an XML document.
+    Can be run into the crypto pool.
+    """
+    if not node_id:
+        raise SignatureError(f"Missing ID of the signed {node_name}")
+    key = get_verification_key(cert_file, cert_type, cert_pem)
+
+    try:
+        root = parse_xml(signedtext)
+    except etree.XMLSyntaxError as err:
+        raise SignatureError(f"Cannot parse {node_name}: {err}") from err
+
+    xmlsec.tree.add_ids(root, ["ID"])
+    signature_node = find_signature(root, node_name, node_id)
+    if signature_node is None:
+        raise SignatureError(f"Signature not found for {node_name} {node_id}")
+    references = signature_node.findall(DS_REFERENCE_PATH)
+    if len(references) != 1 or references[0].get("URI") != f"#{node_id}":
+        raise SignatureError(f"The signature doesn't reference {node_name} {node_id}")
+
+    ctx = xmlsec.SignatureContext()
+    ctx.key = key
+    try:
+        ctx.verify(signature_node)
+    except xmlsec.VerificationError:
+        return False
+    except xmlsec.Error as err:
+        raise SignatureError(f"Cannot verify {node_name} {node_id}: {err}") from err
+    return True
+
+
+class CryptoBackendPythonXmlSec(CryptoBackendXmlSec1):
+    """
+    CryptoBackend that signs and verifies XML documents in-process, with the
+    python bindings of xmlsec, instead of running the xmlsec1 binary on
+    temporary files. The private key is loaded once per process and the IdPs
+    certificates are parsed once, when the metadata is loaded. Encryption and
+    decryption are still delegated to the xmlsec1 binary.
+
+    With `use_crypto_pool` the signatures are computed and verified by
+    the workers of the crypto process pool.
+    """
+
+    def __init__(self, xmlsec_binary, delete_tmpfiles=True, use_crypto_pool=False,
+                 **kwargs):
+        if xmlsec is None:
+            raise SigverError("The python xmlsec package is not installed")
+        self.use_crypto_pool = use_crypto_pool
+        super().__init__(xmlsec_binary, delete_tmpfiles=delete_tmpfiles, **kwargs)
+
+    def sign_statement(self, statement, node_name, key_file, node_id):
+        """
+        Sign an XML statement.
+
+        :param statement: The statement to be signed
+        :param node_name: string like 'urn:oasis:names:...:Assertion'
+        :param key_file: The file where the key can be found
+        :param node_id: The identifier of the node to sign
+        :return: The signed statement
+        """
+        if isinstance(statement, SamlBase):
+            statement = str(statement)
+
+        if self.use_crypto_pool:
+            return run_in_crypto_pool(sign_xml, statement, node_name, key_file, node_id)
+        return sign_xml(statement, node_name, key_file, node_id)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name, node_id):
+        """
+        Validate signature on XML document.
+
+        :param signedtext: The XML document as a string
+        :param cert_file: The public key that was used to sign the document,
+            or the name of a key of the IdPs signing keys index
+        :param cert_type: The file type of the certificate
+        :param node_name: The name of the class that is signed
+        :param node_id: The identifier of the node
+        :return: Boolean True if the signature was correct otherwise False.
+        """
+        with timed("signature_verification"):
+            if self.use_crypto_pool:
+                return run_in_crypto_pool(
+                    verify_xml, signedtext, cert_file, cert_type, node_name, node_id,
+                    _verification_certs.get(cert_file),
+                )
+            return verify_xml(signedtext, cert_file, cert_type, node_name, node_id)
+
+
+class VerificationKey:
+    """
+    A certificate of the IdPs signing keys index. It's used by the security
+    context in place of a temporary PEM file, the backend resolves its name.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name!r})"
+
+
+def load_verification_key(cert):
+    """
+    Returns the VerificationKey of a base64 encoded certificate,
+    parsing the certificate only the first time it's seen.
+    """
+    name = VERIFICATION_KEY_PREFIX + hashlib.sha256(cert.encode("ascii")).hexdigest()
+    if name not in _verification_keys:
+        cert_pem = pem_format(cert)
+        key = xmlsec.Key.from_memory(cert_pem, xmlsec.constants.KeyDataFormatCertPem)
+        with _lock:
+            _verification_keys.setdefault(name, key)
+            _verification_certs.setdefault(name, cert_pem)
+    return VerificationKey(name)
+
+
+def build_key_index(metadata, entity_ids=None):
+    """
+    Returns a mapping from entityID to the VerificationKey instances
+    of the signing certificates published into the metadata.
+    """
+    index = {}
+    for entity_id in metadata.keys() if entity_ids is None else entity_ids:
+        try:
+            certs = metadata.certs(entity_id, "any", "signing")
+        except KeyError:
+            continue
+
+        keys = []
+        for key_name, cert in certs:
+            try:
+                keys.append((key_name, load_verification_key(cert)))
+            except (xmlsec.Error, ValueError) as err:
+                logger.error(f"Invalid signing certificate for {entity_id}: {err}")
+        index[entity_id] = keys
+    return index
+
+
+def get_signing_keys(metadata, entity_id):
+    """
+    Returns the signing keys of an entity, as (key_name, VerificationKey)
+    pairs. The index is built once for each generation of a SPID metadata
+    store, and is rebuilt when the store reloads any metadata.
+    """
+    generation = getattr(metadata, "generation", None)
+    if generation is None:
+        index = build_key_index(metadata, [entity_id])
+    else:
+        index_generation, index = metadata.key_index
+        if index_generation != generation:
+            index = build_key_index(metadata)
+            logger.debug(f"Built IdPs signing keys index with {len(index)} entities")
+            metadata.key_index = generation, index
+
+    try:
+        return index[entity_id]
+    except KeyError:
+        raise KeyError(entity_id) from None
+
+
+class KeyIndexMetadata:
+    """
+    Wraps a metadata store, returning the signing certificates of
+    the entities from the IdPs signing keys index.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def __bool__(self):
+        return bool(self.metadata)
+
+    def __getattr__(self, name):
+        return getattr(self.metadata, name)
+
+    def certs(self, entity_id, descriptor, use="signing"):
+        if descriptor == "any" and use == "signing":
+            return get_signing_keys(self.metadata, entity_id)
+        return self.metadata.certs(entity_id, descriptor, use)
+
+
+class SpidSecurityContext(SecurityContext):
+    """
+    Security context that verifies the XML signatures with the IdPs signing
+    keys index, without writing the certificates to temporary files.
+    """
+
+    def __init__(self, *args, use_key_index=True, **kwargs):
+        self._local = threading.local()
+        self.use_key_index = use_key_index
+        super().__init__(*args, **kwargs)
+
+    @property
+    def metadata(self):
+        if self._metadata and getattr(self._local, "verifying", False):
+            return KeyIndexMetadata(self._metadata)
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
+
+    def _check_signature(self, decoded_xml, item, node_name=NODE_NAME, origdoc=None,
+                         must=False, only_valid_cert=False, issuer=None):
+        # The index is exposed only here, other users of the metadata
+        # (eg. the HTTP-Redirect binding) require the certificates as strings.
+        verifying = getattr(self._local, "verifying", False)
+        self._local.verifying = self.use_key_index
+        try:
+            return super()._check_signature(
+                decoded_xml, item, node_name, origdoc, must, only_valid_cert, issuer
+            )
+        finally:
+            self._local.verifying = verifying
+
+
+def spid_security_context(conf):
+    """
+    Creates a security context that uses the in-process crypto backend.
+    Mirrors saml2.sigver.security_context() for the other arguments.
+    """
+    if not conf:
+        return None
+
+    try:
+        metadata = conf.metadata
+    except AttributeError:
+        metadata = None
+
+    # The xmlsec1 binary is still used for the operations other than signing
+    xmlsec_binary = conf.xmlsec_binary
+    if not xmlsec_binary:
+        xmlsec_binary = get_xmlsec_binary(getattr(conf, "xmlsec_path", []))
+    if not os.path.exists(xmlsec_binary):
+        raise SigverError(f"xmlsec binary not found: {xmlsec_binary}")
+
+    crypto = CryptoBackendPythonXmlSec(
+        xmlsec_binary,
+        delete_tmpfiles=conf.delete_tmpfiles,
+        use_crypto_pool=bool(settings.SPID_CRYPTO_POOL_SIZE),
+    )
+
+    key_file = conf.getattr("key_file", "")
+    sec_backend = get_rsa_crypto(key_file) if key_file else None
+
+    enc_key_files = []
+    if conf.encryption_keypairs is not None:
+        for _encryption_keypair in conf.encryption_keypairs:
+            if "key_file" in _encryption_keypair:
+                enc_key_files.append(_encryption_keypair["key_file"])
+
+    return SpidSecurityContext(
+        crypto,
+        conf.key_file,
+        cert_file=conf.cert_file,
+        metadata=metadata,
+        only_use_keys_in_metadata=conf.only_use_keys_in_metadata,
+        cert_handler_extra_class=conf.cert_handler_extra_class,
+        generate_cert_info=conf.generate_cert_info,
+        tmp_cert_file=conf.tmp_cert_file,
+        tmp_key_file=conf.tmp_key_file,
+        validate_certificate=conf.validate_certificate,
+        enc_key_files=enc_key_files,
+        encryption_keypairs=conf.encryption_keypairs,
+        sec_backend=sec_backend,
+        delete_tmpfiles=conf.delete_tmpfiles,
+        # Certificate validation requires the certificates as PEM files
+        use_key_index=not conf.validate_certificate,
+    )
@@ -0,0 +1,106 @@
+#
+# Logging of the SAML messages: the debug dumps are formatted only if they
+# are emitted, and all the messages can be written to a rotating audit log.
+#
+import logging
+import logging.handlers
+import random
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .utils import repr_saml_request
+
+AUDIT_LOGGER_NAME = "djangosaml2_spid.audit"
+
+_audit_logger = None
+_audit_logger_lock = threading.Lock()
+
+
+class LazySamlMessage:
+    """
+    A SAML message, that is pretty printed and truncated to *max_size*
+    characters only when it is formatted by a log handler.
+    """
+
+    def __init__(self, message, b64=False, max_size=0):
+        self.message = message
+        self.b64 = b64
+        self.max_size = max_size
+
+    def __str__(self):
+        try:
+            text = repr_saml_request(self.message, b64=self.b64)
+        except Exception:
+            text = str(self.message)
+
+        if self.max_size and len(text) > self.max_size:
+            truncated = len(text) - self.max_size
+            text = f"{text[:self.max_size]}... [{truncated} characters truncated]"
+        return text
+
+
+def get_audit_logger():
+    """
+    Returns the logger of the SAML audit log, writing to the rotating file
+    SPID_SAML_AUDIT_LOG, or `None` if the audit log is disabled.
+    """
+    global _audit_logger
+    if not settings.SPID_SAML_AUDIT_LOG:
+        return None
+
+    with _audit_logger_lock:
+        if _audit_logger is None:
+            handler = logging.handlers.RotatingFileHandler(
+                settings.SPID_SAML_AUDIT_LOG,
+                maxBytes=settings.SPID_SAML_AUDIT_LOG_MAX_BYTES,
+                backupCount=settings.SPID_SAML_AUDIT_LOG_BACKUP_COUNT,
+                encoding="utf8",
+                delay=True,
+            )
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            audit_logger = logging.getLogger(AUDIT_LOGGER_NAME)
+            audit_logger.setLevel(logging.INFO)
+            audit_logger.propagate = False
+            audit_logger.addHandler(handler)
+            _audit_logger = audit_logger
+        return _audit_logger
+
+
+@receiver(setting_changed)
+def close_audit_logger(setting, **kwargs):
+    """Closes the handler of the audit log, it's opened again on the next message."""
+    global _audit_logger
+    if not setting.startswith("SPID_SAML_AUDIT_LOG"):
+        return
+
+    with _audit_logger_lock:
+        audit_logger, _audit_logger = _audit_logger, None
+    if audit_logger is not None:
+        for handler in audit_logger.handlers[:]:
+            audit_logger.removeHandler(handler)
+            handler.close()
+
+
+def log_saml_message(logger, kind, destination, message, b64=False):
+    """
+    Logs a SAML message sent to or received from *destination*: a size-capped
+    and sampled debug dump to *logger*, if its debug level is enabled, and the
+    whole message to the audit log, if configured.
+    """
+    audit_logger = get_audit_logger()
+    if audit_logger is not None:
+        audit_logger.info("%s %s: %s", kind, destination, message)
+
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if random.random() >= settings.SPID_SAML_LOG_SAMPLE_RATE:
+        return
+    logger.debug(
+        "%s %s: %s",
+        kind,
+        destination,
+        LazySamlMessage(message, b64=b64, max_size=settings.SPID_SAML_LOG_MAX_SIZE),
+    )
@@ -0,0 +1,585 @@
+import calendar
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from saml2.mdstore import InMemoryMetaData, MetadataStore, MetaDataFile
+from saml2.mdstore import name as mdstore_name
+from saml2.time_util import parse_duration, str_to_time
+
+from .utils import write_file_atomic
+
+logger = logging.getLogger("djangosaml2")
+
+# Pre-parsed IdPs metadata, written into the metadata directory by update_idps
+SNAPSHOT_FILE_NAME = ".metadata_snapshot.json"
+SNAPSHOT_VERSION = 1
+
+
+def metadata_ttl(md, default):
+    """
+    Returns the time to live in seconds of a parsed metadata document,
+    bounded by its cacheDuration and validUntil attributes.
+    """
+    ttl = default
+    descriptor = md.entities_descr or md.entity_descr
+    if descriptor is None:
+        return ttl
+
+    if descriptor.cache_duration:
+        try:
+            sign, duration = parse_duration(descriptor.cache_duration)
+        except (ValueError, IndexError):
+            logger.warning(f"Invalid cacheDuration {descriptor.cache_duration!r}")
+        else:
+            seconds = (
+                duration["tm_year"] * 31536000
+                + duration["tm_mon"] * 2592000
+                + duration["tm_mday"] * 86400
+                + duration["tm_hour"] * 3600
+                + duration["tm_min"] * 60
+                + duration["tm_sec"]
+            )
+            if sign == "+":
+                ttl = min(ttl, seconds)
+
+    if descriptor.valid_until:
+        try:
+            valid_until = calendar.timegm(str_to_time(descriptor.valid_until))
+        except (ValueError, AttributeError):
+            logger.warning(f"Invalid validUntil {descriptor.valid_until!r}")
+        else:
+            ttl = min(ttl, valid_until - time.time())
+
+    return max(ttl, 0)
+
+
+def _valid_until(md):
+    """Returns the earliest validUntil of a parsed metadata document, as a timestamp."""
+    descriptors = []
+    if md.entities_descr is not None:
+        descriptors.append(md.entities_descr)
+        descriptors.extend(md.entities_descr.entity_descriptor)
+    elif md.entity_descr is not None:
+        descriptors.append(md.entity_descr)
+
+    valid_until = None
+    for descriptor in descriptors:
+        if descriptor.valid_until:
+            timestamp = calendar.timegm(str_to_time(descriptor.valid_until))
+            valid_until = timestamp if valid_until is None else min(valid_until, timestamp)
+    return valid_until
+
+
+def load_metadata_snapshot(path):
+    """Returns the files of a metadata snapshot, or an empty dict on errors."""
+    try:
+        with open(path, encoding="utf8") as fp:
+            snapshot = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        logger.warning(f"Cannot load IdPs metadata snapshot {path}: {err}")
+        return {}
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return {}
+    return snapshot["files"]
+
+
+def is_metadata_file(entry):
+    """
+    Returns whether a directory entry is an IdP metadata file: all the regular
+    files are, except the hidden ones (the snapshot, the state files of
+    update_idps and the temporary files).
+    """
+    return not entry.name.startswith(".") and entry.is_file()
+
+
+def write_metadata_snapshot(metadata_dir):
+    """
+    Writes a snapshot of the parsed IdPs metadata files of a directory, that
+    the workers load instead of parsing the XML files. Each file is recorded
+    with its SHA-256 hash, so the workers use only the entries of the files
+    that are unchanged since the snapshot was written. The snapshot is a JSON
+    document, loaded with a single read.
+    """
+    path = os.path.join(metadata_dir, SNAPSHOT_FILE_NAME)
+    previous = load_metadata_snapshot(path)
+    files = {}
+    with os.scandir(metadata_dir) as entries:
+        for entry in sorted(entries, key=lambda x: x.name):
+            if not is_metadata_file(entry):
+                continue
+            with open(entry.path, "rb") as fp:
+                content = fp.read()
+            digest = hashlib.sha256(content).hexdigest()
+
+            if entry.name in previous and previous[entry.name]["digest"] == digest:
+                files[entry.name] = previous[entry.name]
+                continue
+
+            _md = InMemoryMetaData([], check_validity=False)
+            try:
+                _md.parse(content)
+                valid_until = _valid_until(_md)
+            except Exception as err:
+                logger.error(f"Cannot parse IdP metadata file {entry.path}: {err}")
+                continue
+            files[entry.name] = {
+                "digest": digest,
+                "valid_until": valid_until,
+                "entity": _md.entity,
+            }
+
+    snapshot = {"version": SNAPSHOT_VERSION, "files": files}
+    write_file_atomic(path, json.dumps(snapshot, separators=(",", ":")).encode("utf8"))
+    return path
+
+
+def secure_cache_dir(path):
+    """
+    Creates a private cache directory, or checks that an existing one is
+    owned by the user of the process and not writable by others, because
+    its files are loaded as trusted metadata. Returns `True` on success.
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        stat = os.stat(path)
+    except OSError as err:
+        logger.warning(f"Cannot create the remote metadata cache {path}: {err}")
+        return False
+
+    if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+        logger.warning(f"Remote metadata cache {path} not owned by the process user")
+        return False
+    if stat.st_mode & 0o022:
+        logger.warning(f"Remote metadata cache {path} writable by other users")
+        return False
+    return True
+
+
+class RemoteMetadata:
+    """
+    Remote metadata of a test IdP (SAML-check, Demo or Validator).
+
+    The document is fetched by a background thread, kept in memory and
+    persisted to a local cache directory. The request path only reads the
+    in-memory copy, so a slow or unreachable remote endpoint never delays
+    or breaks a login: at most the IdP is missing until it's reachable.
+    The cache directory is not used if other users can write into it.
+    """
+
+    def __init__(self, store, url, cache_dir=None, ttl=900, retry_interval=60, timeout=10):
+        self.store = store
+        self.url = url
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.expires_at = 0
+        self.last_error = None
+
+        if cache_dir and secure_cache_dir(cache_dir):
+            digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+            self.cache_file = os.path.join(cache_dir, f"{digest}.xml")
+        else:
+            self.cache_file = None
+
+        self._fetching = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(url={self.url!r})"
+
+    @property
+    def stale(self):
+        return time.time() >= self.expires_at
+
+    def parse(self, content):
+        _md = InMemoryMetaData(self.store.attrc, check_validity=self.store.check_validity)
+        _md.parse(content)
+        return _md
+
+    def load_cached(self):
+        """Loads the copy persisted on disk, if any. Returns `True` on success."""
+        if not self.cache_file:
+            return False
+
+        try:
+            with open(self.cache_file, "rb") as fp:
+                content = fp.read()
+            mtime = os.path.getmtime(self.cache_file)
+            _md = self.parse(content)
+        except FileNotFoundError:
+            return False
+        except Exception as err:
+            logger.warning(f"Cannot load cached remote metadata of {self.url}: {err}")
+            return False
+
+        self.expires_at = mtime + metadata_ttl(_md, self.ttl)
+        self.store.set_remote_metadata(self.url, _md)
+        return True
+
+    def fetch(self):
+        """Downloads, parses and persists the remote metadata."""
+        try:
+            response = self.store.http.send(self.url, timeout=self.timeout)
+            if response.status_code != 200:
+                raise ValueError(f"response status {response.status_code}")
+            _md = self.parse(response.content)
+        except Exception as err:
+            self.last_error = err
+            self.expires_at = time.time() + self.retry_interval
+            logger.error(f"Cannot fetch remote metadata of {self.url}: {err}")
+            return False
+
+        self.last_error = None
+        self.expires_at = time.time() + metadata_ttl(_md, self.ttl)
+        self.store.set_remote_metadata(self.url, _md)
+
+        if self.cache_file:
+            try:
+                write_file_atomic(self.cache_file, response.content, mode=0o600)
+            except OSError as err:
+                logger.warning(f"Cannot persist remote metadata of {self.url}: {err}")
+
+        logger.info(f"Fetched remote metadata of {self.url}")
+        return True
+
+    def refresh_async(self):
+        """Starts a background fetch if the metadata is stale."""
+        if not self.stale or not self._fetching.acquire(blocking=False):
+            return None
+
+        def target():
+            try:
+                self.fetch()
+            finally:
+                self._fetching.release()
+
+        thread = threading.Thread(
+            target=target, name=f"spid-remote-metadata-{self.url}", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+class SpidMetadataStore(MetadataStore):
+    """
+    A pysaml2 MetadataStore for a directory of IdPs metadata files, that is
+    intended to be shared between all the configurations of a process.
+
+    Each file is parsed only once and is parsed again only when its content
+    changes. Changes are detected with a stat sweep of the directory, that is
+    throttled by *refresh_interval* seconds, followed by a content hash check.
+    If a *stamp_file* is given, the sweep is done only when it changes.
+
+    The files whose hash matches the one recorded into the snapshot of the
+    directory written by update_idps are loaded from it, without parsing
+    the XML. The entities,
+    their services and the IdPs names are indexed for each generation of
+    the store, so the lookups of the SPID views are dictionary hits.
+    Remote metadata sources are handled by :class:`RemoteMetadata` instances.
+    """
+
+    def __init__(
+        self, attrc, config, metadata_dir, refresh_interval=0, stamp_file=None, **kwargs
+    ):
+        super().__init__(attrc, config, **kwargs)
+        self.metadata_dir = metadata_dir
+        self.refresh_interval = refresh_interval
+        self.stamp_file = stamp_file
+        self._stamp = None  # (inode, mtime_ns, size) of the stamp file
+        self._snapshot = (None, {})  # ((inode, mtime_ns, size), files) of the snapshot
+        self._index = (None, None, None, None)  # generation, metadata, entities, cache
+        self.generation = 0
+        self.key_index = (None, None)  # (generation, index) of the IdPs signing keys
+        self._files = {}  # path -> (mtime_ns, size, sha256 digest)
+        self._last_sweep = None
+        self._lock = threading.RLock()
+        self.remote = {}
+
+    def add_remote(self, url, **kwargs):
+        """
+        Adds a remote metadata source, loading its persisted copy if there
+        is one and scheduling a background fetch if it's missing or stale.
+        """
+        remote = RemoteMetadata(self, url, **kwargs)
+        self.remote[url] = remote
+        remote.load_cached()
+        remote.refresh_async()
+        return remote
+
+    def set_remote_metadata(self, url, md):
+        with self._lock:
+            metadata = dict(self.metadata)
+            metadata[url] = md
+            self.metadata = metadata
+            self.generation += 1
+
+    def refresh(self, force=False):
+        """
+        Reloads the metadata files that have been added, changed or removed
+        since the last sweep. Returns `True` if the store has been modified.
+        Stale remote metadata are refreshed in background.
+        """
+        for remote in self.remote.values():
+            remote.refresh_async()
+
+        if not force and self._last_sweep is not None and \
+                time.monotonic() - self._last_sweep < self.refresh_interval:
+            return False
+
+        with self._lock:
+            if not force and self._last_sweep is not None and \
+                    time.monotonic() - self._last_sweep < self.refresh_interval:
+                return False  # another thread has just done the sweep
+            self._last_sweep = time.monotonic()
+
+            if self.stamp_file:
+                try:
+                    stat = os.stat(self.stamp_file)
+                except OSError:
+                    stamp = None  # not written yet, always sweep
+                else:
+                    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if not force and stamp is not None and stamp == self._stamp:
+                    return False
+                self._stamp = stamp
+
+            try:
+                with os.scandir(self.metadata_dir) as entries:
+                    stats = {
+                        os.path.join(self.metadata_dir, entry.name): entry.stat()
+                        for entry in entries
+                        if is_metadata_file(entry)
+                    }
+            except OSError as err:
+                logger.error(f"Cannot scan IdPs metadata directory: {err}")
+                self._stamp = None  # scan again on the next refresh
+                return False
+
+            snapshot = self.load_snapshot()
+
+            # Replace the mapping instead of updating it in place: concurrent
+            # readers keep iterating on the previous version.
+            metadata = dict(self.metadata)
+            changed = False
+
+            for path in set(self._files).difference(stats):
+                logger.info(f"Removing IdP metadata file {path}")
+                metadata.pop(path, None)
+                self.to_old.pop(path, None)
+                del self._files[path]
+                changed = True
+
+            for path, stat in sorted(stats.items()):
+                try:
+                    mtime_ns, size, digest = self._files[path]
+                except KeyError:
+                    pass
+                else:
+                    if (mtime_ns, size) == (stat.st_mtime_ns, stat.st_size):
+                        continue
+
+                try:
+                    with open(path, "rb") as fp:
+                        content = fp.read()
+                except OSError as err:
+                    logger.error(f"Cannot read IdP metadata file {path}: {err}")
+                    continue
+                new_digest = hashlib.sha256(content).hexdigest()
+
+                if path in self._files and digest == new_digest:
+                    # Touched but not modified
+                    self._files[path] = (stat.st_mtime_ns, stat.st_size, digest)
+                    continue
+
+                entry = self.snapshot_entry(snapshot, path, new_digest)
+                if entry is not None:
+                    _md = MetaDataFile(self.attrc, path, check_validity=self.check_validity)
+                    _md.entity = entry["entity"]
+                else:
+                    _md = self.parse_metadata_file(path, content)
+                if _md is None:
+                    continue  # keep the last good version, if any
+
+                logger.info(f"Loaded IdP metadata file {path}")
+                metadata[path] = _md
+                if _md.to_old:
+                    self.to_old[path] = _md.to_old
+                else:
+                    self.to_old.pop(path, None)
+                self._files[path] = (stat.st_mtime_ns, stat.st_size, new_digest)
+                changed = True
+
+            if changed:
+                self.metadata = metadata
+                self.generation += 1
+            return changed
+
+    def load_snapshot(self):
+        """Returns the files of the directory snapshot, reading it only if it changed."""
+        path = os.path.join(self.metadata_dir, SNAPSHOT_FILE_NAME)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._snapshot = (None, {})
+            return {}
+
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._snapshot[0] != key:
+            self._snapshot = (key, load_metadata_snapshot(path))
+        return self._snapshot[1]
+
+    def snapshot_entry(self, snapshot, path, digest):
+        """
+        Returns the snapshot entry of a metadata file with the SHA-256 *digest*,
+        or `None` if the file changed since the snapshot was written or it must
+        be parsed again.
+        """
+        entry = snapshot.get(os.path.basename(path))
+        if entry is None or self.filter:
+            return None
+        if entry["digest"] != digest:
+            return None
+        if self.check_validity and entry["valid_until"] is not None \
+                and entry["valid_until"] <= time.time():
+            return None  # parsed again, to report the expired entities
+        return entry
+
+    def get_index(self):
+        """
+        Returns the index of the current generation: the metadata, a mapping
+        from entityID to metadata key and a cache of the lookups.
+        """
+        index = self._index
+        if index[0] != self.generation:
+            with self._lock:
+                generation, metadata = self.generation, self.metadata
+                entities = {}
+                for key, _md in metadata.items():
+                    for entity_id in _md.keys():
+                        entities.setdefault(entity_id, key)
+                index = self._index = (generation, metadata, entities, {})
+        return index
+
+    def __getitem__(self, item):
+        _, metadata, entities, _ = self.get_index()
+        try:
+            return metadata[entities[item]][item]
+        except KeyError:
+            return super().__getitem__(item)
+
+    def name(self, entity_id, langpref="en"):
+        _, metadata, entities, cache = self.get_index()
+        key = ("name", entity_id, langpref)
+        if key not in cache:
+            if entity_id in entities:
+                cache[key] = mdstore_name(metadata[entities[entity_id]][entity_id], langpref)
+            else:
+                cache[key] = super().name(entity_id, langpref)
+        return cache[key]
+
+    def service(self, entity_id, typ, service, binding=None):
+        _, metadata, entities, cache = self.get_index()
+        key = ("service", entity_id, typ, service, binding)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        srvs = None
+        if entity_id in entities:
+            srvs = metadata[entities[entity_id]].service(entity_id, typ, service, binding)
+        if not srvs:
+            # Raises UnknownSystemEntity or UnsupportedBinding
+            srvs = super().service(entity_id, typ, service, binding)
+        cache[key] = srvs
+        return srvs
+
+    def available_idps(self, langpref="en"):
+        """
+        Returns the entityIDs and names of the IdPs with a single sign-on
+        service, as djangosaml2.utils.available_idps.
+        """
+        _, metadata, entities, cache = self.get_index()
+        key = ("available_idps", langpref)
+        if key not in cache:
+            cache[key] = {
+                entity_id: self.name(entity_id, langpref)
+                for entity_id, md_key in entities.items()
+                if any(
+                    "single_sign_on_service" in descriptor
+                    for descriptor in metadata[md_key][entity_id].get(
+                        "idpsso_descriptor", []
+                    )
+                )
+            }
+        return dict(cache[key])
+
+    def parse_metadata_file(self, path, content):
+        """Parses the content of a metadata file, returns `None` on errors."""
+        kwargs = {"filter": self.filter} if self.filter else {}
+        _md = MetaDataFile(self.attrc, path, check_validity=self.check_validity, **kwargs)
+        try:
+            _md.parse_and_check_signature(content)
+        except Exception as err:
+            logger.error(f"Cannot parse IdP metadata file {path}: {err}")
+            return None
+        return _md
+
+
+_metadata_store = None
+_metadata_store_key = None
+_metadata_store_lock = threading.Lock()
+
+
+@receiver(setting_changed)
+def clear_metadata_store(**kwargs):
+    """Discard the shared metadata store."""
+    global _metadata_store, _metadata_store_key
+
+    with _metadata_store_lock:
+        _metadata_store = _metadata_store_key = None
+
+
+def get_metadata_store(conf, remote_urls=()):
+    """
+    Returns the metadata store shared by the process, creating it with the
+    attribute converters and the security settings of *conf* if necessary.
+    """
+    global _metadata_store, _metadata_store_key
+
+    key = (settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR, tuple(remote_urls))
+
+    with _metadata_store_lock:
+        if _metadata_store is None or _metadata_store_key != key:
+            store = SpidMetadataStore(
+                conf.attribute_converters,
+                conf,
+                metadata_dir=settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR,
+                refresh_interval=settings.SPID_METADATA_REFRESH_INTERVAL,
+                stamp_file=settings.SPID_IDENTITY_PROVIDERS_METADATA_STAMP,
+                ca_certs=conf.ca_certs,
+                disable_ssl_certificate_validation=conf.disable_ssl_certificate_validation,
+                http_client_timeout=conf.http_client_timeout,
+            )
+            store.refresh(force=True)
+            for url in remote_urls:
+                store.add_remote(
+                    url,
+                    cache_dir=settings.SPID_REMOTE_METADATA_CACHE_DIR,
+                    ttl=settings.SPID_REMOTE_METADATA_TTL,
+                    timeout=settings.SPID_REMOTE_METADATA_TIMEOUT,
+                )
+
+            _metadata_store, _metadata_store_key = store, key
+            return store
+
+    _metadata_store.refresh()
+    return _metadata_store
@@ -1,10 +1,169 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
 from xml.etree import ElementTree
 
 import saml2
 import saml2.md
+import saml2.sigver
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from saml2.metadata import entity_descriptor, sign_entity_descriptor
-from saml2.sigver import security_context
+
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+_file_digests = {}  # path -> ((inode, mtime_ns, size), sha256 digest)
+
+
+@receiver(setting_changed)
+def clear_metadata_cache(**kwargs):
+    """Drop all the cached signed metadata documents."""
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
+
+
+def _file_digest(path):
+    """
+    Returns the SHA-256 digest of a file and its stat result. The file is
+    hashed again only when its inode, modification time or size change.
+    """
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _file_digests.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1], stat
+
+    with open(path, "rb") as fp:
+        digest = hashlib.sha256(fp.read()).hexdigest()
+    _file_digests[path] = (key, digest)
+    return digest, stat
+
+
+def key_material_fingerprint(conf):
+    """
+    Returns a fingerprint of the SP certificate and private key, and the
+    time of their last modification.
+    """
+    digest = hashlib.sha256()
+    last_modified = 0
+    for path in (conf.cert_file, conf.key_file):
+        file_digest, stat = _file_digest(path)
+        digest.update(file_digest.encode("ascii"))
+        last_modified = max(last_modified, stat.st_mtime)
+    return digest.hexdigest(), int(last_modified)
+
+
+def sp_metadata_static_path(base_url: str, md_type: str = "spid", static_dir=None):
+    """
+    Returns the path of the pre-rendered metadata file for a base URL,
+    eg. '<static_dir>/sp.example.org/spid.xml' for 'https://sp.example.org/'.
+    Raises a ValueError if the host of the URL is not a valid directory name.
+    """
+    if static_dir is None:
+        static_dir = settings.SPID_METADATA_STATIC_DIR
+
+    url = urlsplit(base_url)
+    netloc = url.netloc.replace(":", "_")
+    if netloc in ("", ".", "..") or any(c in netloc for c in "/\\\0"):
+        raise ValueError(f"Invalid host for a metadata file: {url.netloc!r}")
+
+    parts = [netloc]
+    parts.extend(x for x in url.path.split("/") if x and x not in (".", ".."))
+    return os.path.join(static_dir, *parts, f"{md_type}.xml")
+
+
+def sp_metadata_settings_digest(conf, md_type: str = "spid"):
+    """
+    Returns a digest of the settings the metadata document is built from:
+    the sp section of the configuration, the organization and the contacts.
+    The digest is computed once per configuration, that is rebuilt when the
+    settings change.
+    """
+    digests = conf.__dict__.setdefault("_spid_metadata_digests", {})
+    try:
+        return digests[md_type]
+    except KeyError:
+        pass
+
+    if md_type == "spid":
+        contacts, prefixes = settings.SPID_CONTACTS, settings.SPID_PREFIXES
+    else:
+        contacts = getattr(settings, "CIE_CONTACTS", None)
+        prefixes = settings.CIE_PREFIXES
+
+    sp_settings = {k: v for k, v in vars(conf).items() if k.startswith("_sp_")}
+    document_settings = [
+        conf.entityid,
+        sp_settings,
+        conf.organization,
+        conf.contact_person,
+        contacts,
+        prefixes,
+    ]
+    # Objects without a JSON form (eg. the attribute policy) are not part
+    # of the document, only their type is taken into account
+    serialized = json.dumps(
+        document_settings, sort_keys=True, default=lambda obj: type(obj).__name__
+    )
+    digests[md_type] = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    return digests[md_type]
+
+
+def sp_metadata_cache_key(conf, md_type: str = "spid"):
+    return (
+        conf.entityid,
+        md_type,
+        key_material_fingerprint(conf)[0],
+        sp_metadata_settings_digest(conf, md_type),
+    )
+
+
+def sp_metadata_validators(conf, md_type: str = "spid"):
+    """
+    Returns the ETag and the Last-Modified time of the signed metadata,
+    computed without building or signing the document. The ETag is weak
+    because every signature produces a new document ID. The Last-Modified
+    time is the generation time of the cached document, `None` if the
+    document isn't cached.
+    """
+    key = sp_metadata_cache_key(conf, md_type)
+    digest = hashlib.sha256(" ".join(key).encode("utf-8")).hexdigest()[:32]
+    with _metadata_cache_lock:
+        cached = _metadata_cache.get(key)
+    return f'W/"{digest}"', cached[1] if cached else None
+
+
+def cached_sp_metadata(conf, md_type: str = "spid", build_metadata=None):
+    """
+    Returns the signed metadata as bytes and their generation time. Documents
+    are cached per entity ID, metadata type, key material fingerprint and
+    digest of the settings, and are signed again only when the settings or
+    the SP certificate/key change. An optional callable without arguments
+    can be provided to build the metadata document.
+    """
+    if build_metadata is None:
+        def build_metadata():
+            return italian_sp_metadata(conf, md_type)
+
+    if not settings.SPID_METADATA_CACHE:
+        return str(build_metadata()).encode("utf-8"), int(time.time())
+
+    key = sp_metadata_cache_key(conf, md_type)
+    with _metadata_cache_lock:
+        cached = _metadata_cache.get(key)
+
+    if cached is None:
+        cached = (str(build_metadata()).encode("utf-8"), int(time.time()))
+        with _metadata_cache_lock:
+            while len(_metadata_cache) >= settings.SPID_METADATA_CACHE_SIZE > 0:
+                del _metadata_cache[next(iter(_metadata_cache))]
+            _metadata_cache[key] = cached
+
+    return cached
 
 
 def italian_sp_metadata(conf, md_type: str = "spid"):
@@ -50,7 +209,7 @@ def italian_sp_metadata(conf, md_type: str = "spid"):
         cie_contacts(metadata)
 
     # metadata signature
-    secc = security_context(conf)
+    secc = saml2.sigver.security_context(conf)
     sign_dig_algs = dict(
         sign_alg=conf._sp_signing_algorithm, digest_alg=conf._sp_digest_algorithm
     )
@@ -0,0 +1,385 @@
+#
+# Timing of the phases of the SPID login, ACS and logout flows. The phases
+# of a flow are collected into a trace, that is emitted at the end of the
+# flow, tagged with the entityID of the IdP, to the receivers of the
+# phase_timed signal and to the metrics sink configured by SPID_METRICS_SINK.
+#
+# The responses received by the ACS are also counted per IdP: the round trip
+# time from the AuthnRequest, the SPID error codes and the failed validation
+# checks are aggregated in memory and flushed every SPID_METRICS_FLUSH_INTERVAL
+# seconds, by a background thread, to the receivers of the idp_stats_flushed
+# signal and to the sink.
+#
+import atexit
+import contextvars
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+from djangosaml2.cache import DjangoSessionCacheAdapter
+
+logger = logging.getLogger("djangosaml2")
+
+# Sent for each timed phase of a flow, with sender the name of the flow
+# ('login', 'acs' or 'logout') and the arguments phase, duration (seconds)
+# and idp (entityID of the IdP, or None if unknown).
+phase_timed = Signal()
+
+# Sent on each flush of the ACS statistics, with the argument stats: a dict
+# of the statistics of each IdP since the previous flush (see IdpStats).
+idp_stats_flushed = Signal()
+
+_current_trace = contextvars.ContextVar("spid_metrics_trace", default=None)
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+class StatsdSink:
+    """
+    Sends the timings as StatsD lines with DogStatsD tags, over UDP to
+    SPID_METRICS_STATSD_ADDRESS ("host:port").
+    """
+
+    def __init__(self, address=None, prefix=None):
+        host, port = (address or settings.SPID_METRICS_STATSD_ADDRESS).rsplit(":", 1)
+        self.address = (host, int(port))
+        self.prefix = settings.SPID_METRICS_PREFIX if prefix is None else prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @staticmethod
+    def format_tags(tags):
+        tags = [
+            f"{key}:{value}".translate({ord(c): "_" for c in ",|#"})
+            for key, value in tags.items()
+            if value is not None
+        ]
+        return f"|#{','.join(tags)}" if tags else ""
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line.encode("utf8"), self.address)
+        except OSError as err:
+            logger.debug(f"Cannot send metrics to {self.address}: {err}")
+
+    def timing(self, name, seconds, tags):
+        self.send(f"{self.prefix}.{name}:{seconds * 1000:.3f}|ms{self.format_tags(tags)}")
+
+    def count(self, name, value, tags):
+        self.send(f"{self.prefix}.{name}:{value}|c{self.format_tags(tags)}")
+
+    def gauge(self, name, value, tags):
+        self.send(f"{self.prefix}.{name}:{value:.3f}|g{self.format_tags(tags)}")
+
+    def close(self):
+        self.socket.close()
+
+
+def metrics_enabled():
+    """True if a sink is configured or a receiver is connected to the signals."""
+    return bool(
+        settings.SPID_METRICS_SINK
+        or phase_timed.has_listeners()
+        or idp_stats_flushed.has_listeners()
+    )
+
+
+def get_sink():
+    """Returns the metrics sink of SPID_METRICS_SINK, or `None` if not configured."""
+    global _sink
+    if not settings.SPID_METRICS_SINK:
+        return None
+
+    with _sink_lock:
+        if _sink is None:
+            _sink = import_string(settings.SPID_METRICS_SINK)()
+        return _sink
+
+
+@receiver(setting_changed)
+def close_sink(setting, **kwargs):
+    """Discards the metrics sink, a new one is created on the next use."""
+    global _sink
+    if not setting.startswith("SPID_METRICS_"):
+        return
+
+    with _sink_lock:
+        sink, _sink = _sink, None
+    if hasattr(sink, "close"):
+        sink.close()
+
+
+class Trace:
+    """The timed phases of a flow, the durations of a repeated phase are summed."""
+
+    def __init__(self, flow, idp=None):
+        self.flow = flow
+        self.idp = idp
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, phase, duration):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+    def emit(self):
+        sink = get_sink()
+        tags = {"idp": self.idp}
+        for phase, duration in self.phases.items():
+            phase_timed.send(
+                sender=self.flow, phase=phase, duration=duration, idp=self.idp
+            )
+            if sink is not None:
+                try:
+                    sink.timing(f"{self.flow}.{phase}", duration, tags)
+                except Exception as err:
+                    logger.error(f"Metrics sink error: {err}")
+
+
+@contextmanager
+def trace_flow(flow, idp=None):
+    """
+    Collects the phases timed into the context, and their total as the
+    'total' phase, emitting them at the end. Nothing is timed if no sink
+    is configured and no receiver is connected to phase_timed.
+    """
+    if not metrics_enabled():
+        yield None
+        return
+
+    trace = Trace(flow, idp)
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.add("total", time.perf_counter() - start)
+        _current_trace.reset(token)
+        trace.emit()
+
+
+@contextmanager
+def timed(phase):
+    """Times a phase of the current flow, if it's traced."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(phase, time.perf_counter() - start)
+
+
+def add_phase(phase, duration):
+    """Adds a phase timed by the caller to the current flow, if it's traced."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(phase, duration)
+
+
+def set_idp(idp):
+    """Tags the current flow with the entityID of the IdP, once it's known."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.idp = idp
+
+
+class AuthnRequestsCache(DjangoSessionCacheAdapter):
+    """
+    The creation time and the IdP entityID of the AuthnRequests of the
+    OutstandingQueriesCache, by session id, for the round trip times.
+    """
+
+    def __init__(self, django_session):
+        super().__init__(django_session, "_spid_authn_requests")
+
+    def set(self, saml2_session_id, idp):
+        # The requests never answered are discarded with the session or
+        # when they are older than the max age of the outstanding queries
+        now = time.time()
+        for session_id, (created, _idp) in list(self.items()):
+            if now - created > settings.SPID_METRICS_ROUND_TRIP_MAX_AGE:
+                del self[session_id]
+
+        self[saml2_session_id] = [now, idp]
+        self.sync()
+
+    def pop_round_trip(self, saml2_session_id):
+        """Returns the IdP and the seconds elapsed since the request, or `None`."""
+        if saml2_session_id not in self:
+            return None
+
+        created, idp = self.pop(saml2_session_id)
+        self.sync()
+        return idp, time.time() - created
+
+
+class IdpStats:
+    """
+    The statistics of the responses received by the ACS, by IdP entityID.
+    The statistics of an IdP are a dict with the keys 'responses' (count),
+    'round_trips' (count), 'round_trip_sum' and 'round_trip_max' (seconds),
+    'errors' (count by SPID error code, or by exception class name for the
+    other failures) and 'validation_failures' (count by validation check).
+    """
+
+    def __init__(self):
+        self.idps = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.flusher_pid = None  # pid of the process where the flusher runs
+
+    def get(self, idp):
+        try:
+            return self.idps[idp]
+        except KeyError:
+            return self.idps.setdefault(
+                idp,
+                {
+                    "responses": 0,
+                    "round_trips": 0,
+                    "round_trip_sum": 0.0,
+                    "round_trip_max": 0.0,
+                    "errors": {},
+                    "validation_failures": {},
+                },
+            )
+
+    def add_response(self, idp, round_trip=None):
+        with self.lock:
+            stats = self.get(idp)
+            stats["responses"] += 1
+            if round_trip is not None:
+                stats["round_trips"] += 1
+                stats["round_trip_sum"] += round_trip
+                stats["round_trip_max"] = max(stats["round_trip_max"], round_trip)
+        self.maybe_flush()
+
+    def add_error(self, idp, code):
+        with self.lock:
+            errors = self.get(idp)["errors"]
+            errors[code] = errors.get(code, 0) + 1
+        self.maybe_flush()
+
+    def add_validation_failure(self, idp, check):
+        with self.lock:
+            failures = self.get(idp)["validation_failures"]
+            failures[check] = failures.get(check, 0) + 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        self.start_flusher()
+        if time.monotonic() - self.last_flush >= settings.SPID_METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def start_flusher(self):
+        """
+        Starts the daemon thread that flushes the statistics collected when
+        no more responses are received. It's started on the first response
+        received by each process, so that it's not lost by a fork.
+        """
+        if self.flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+        thread = threading.Thread(
+            target=self.run_flusher, name="spid-idp-stats-flusher", daemon=True
+        )
+        thread.start()
+
+    def run_flusher(self):
+        while True:
+            elapsed = time.monotonic() - self.last_flush
+            time.sleep(max(settings.SPID_METRICS_FLUSH_INTERVAL - elapsed, 1))
+            try:
+                self.maybe_flush()
+            except Exception as err:
+                logger.error(f"Flush of the ACS statistics failed: {err}")
+
+    def flush(self):
+        """Emits the statistics collected since the previous flush."""
+        with self.lock:
+            stats, self.idps = self.idps, {}
+            self.last_flush = time.monotonic()
+        if not stats:
+            return
+
+        idp_stats_flushed.send(sender=self.__class__, stats=stats)
+
+        sink = get_sink()
+        if sink is None or not hasattr(sink, "count"):
+            return
+        try:
+            for idp, idp_stats in stats.items():
+                self.emit(sink, idp, idp_stats)
+        except Exception as err:
+            logger.error(f"Metrics sink error: {err}")
+
+    @staticmethod
+    def emit(sink, idp, stats):
+        tags = {"idp": idp}
+        if stats["responses"]:
+            sink.count("acs.responses", stats["responses"], tags)
+        if stats["round_trips"]:
+            sink.count("acs.round_trips", stats["round_trips"], tags)
+            if hasattr(sink, "gauge"):
+                avg = stats["round_trip_sum"] / stats["round_trips"]
+                sink.gauge("acs.round_trip.avg", avg, tags)
+                sink.gauge("acs.round_trip.max", stats["round_trip_max"], tags)
+        for code, value in stats["errors"].items():
+            sink.count("acs.errors", value, {**tags, "code": code})
+        for check, value in stats["validation_failures"].items():
+            sink.count("acs.validation_failures", value, {**tags, "check": check})
+
+
+idp_stats = IdpStats()
+atexit.register(idp_stats.flush)
+
+
+def record_authn_request(django_session, saml2_session_id, idp):
+    """Records the creation of an AuthnRequest, for its round trip time."""
+    if metrics_enabled():
+        AuthnRequestsCache(django_session).set(saml2_session_id, idp)
+
+
+def record_response(django_session, idp, in_response_to):
+    """
+    Records a response received by the ACS, with the round trip time
+    from the AuthnRequest it replies to. Returns the IdP of the response,
+    that is the IdP of the request if the issuer of the response is unknown.
+    """
+    if not metrics_enabled():
+        return idp
+
+    round_trip = None
+    if in_response_to:
+        request_info = AuthnRequestsCache(django_session).pop_round_trip(in_response_to)
+        if request_info is not None:
+            idp = idp or request_info[0]
+            round_trip = request_info[1]
+    idp_stats.add_response(idp, round_trip)
+    return idp
+
+
+def record_error(idp, code):
+    """Records an ACS failure, by SPID error code or exception class name."""
+    if metrics_enabled():
+        idp_stats.add_error(idp, code)
+
+
+def record_validation_failure(idp, check):
+    """Records a failed validation check of a response."""
+    if metrics_enabled():
+        idp_stats.add_validation_failure(idp, check)
@@ -0,0 +1,71 @@
+#
+# Replay detection of the assertions received by the ACS. The ID of each
+# accepted assertion is added to a Django cache (SPID_REPLAY_CACHE) until
+# the assertion expires, so that a replay within its NotOnOrAfter window is
+# rejected on every node that shares the cache backend.
+#
+import datetime
+import hashlib
+import math
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .spid_validator import SpidValidationError
+from .utils import parse_xs_datetime
+
+REPLAY_CACHE_KEY_PREFIX = "spid_replay"
+
+
+def replay_cache_key(issuer, assertion_id):
+    """A cache key of bounded length and safe characters, for any backend."""
+    digest = hashlib.sha256(f"{issuer}\0{assertion_id}".encode("utf8")).hexdigest()
+    return f"{REPLAY_CACHE_KEY_PREFIX}:{digest}"
+
+
+def assertion_expiry(assertion):
+    """
+    Returns the earliest NotOnOrAfter of the conditions and of the subject
+    confirmations of an assertion, or `None` if it has none.
+    """
+    values = [getattr(assertion.conditions, "not_on_or_after", None)]
+    subject = getattr(assertion, "subject", None)
+    for subject_confirmation in getattr(subject, "subject_confirmation", None) or ():
+        data = subject_confirmation.subject_confirmation_data
+        values.append(getattr(data, "not_on_or_after", None))
+
+    expiries = []
+    for value in values:
+        if value:
+            try:
+                expiries.append(parse_xs_datetime(value))
+            except ValueError:
+                pass
+    return min(expiries, default=None)
+
+
+def check_assertion_replay(issuer, assertion, accepted_time_diff=0, now=None):
+    """
+    Records the ID of an accepted assertion, until its expiry plus the accepted
+    time difference. Raises a SpidValidationError if the ID was already recorded.
+    """
+    if not settings.SPID_REPLAY_CACHE:
+        return
+
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    expiry = assertion_expiry(assertion)
+    if expiry is None:
+        ttl = accepted_time_diff
+    else:
+        ttl = (expiry - now).total_seconds() + accepted_time_diff
+    if ttl <= 0:
+        return  # an expired assertion is rejected by the validator
+
+    cache = caches[settings.SPID_REPLAY_CACHE]
+    key = replay_cache_key(issuer, assertion.id)
+    if not cache.add(key, True, timeout=math.ceil(ttl)):
+        raise SpidValidationError(
+            f"Assertion {assertion.id} of {issuer} already received",
+            check="assertion_replay",
+        )
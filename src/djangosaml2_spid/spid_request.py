@@ -1,10 +1,18 @@
+import copy
 import logging
+import threading
 
 import saml2
 from django.conf import settings
 from django.urls import reverse
 from djangosaml2.overrides import Saml2Client
 from saml2.authn_context import requested_authn_context
+from saml2.httpbase import http_cookiejar
+from saml2.population import Population
+from saml2.sigver import security_context
+
+from .spid_logging import log_saml_message
+from .spid_metrics import timed
 
 
 SAML2_DEFAULT_BINDING = getattr(
@@ -14,68 +22,104 @@ SAML2_DEFAULT_BINDING = getattr(
 logger = logging.getLogger("djangosaml2")
 
 
+def get_saml2_client(conf, state_cache=None, identity_cache=None):
+    """
+    Returns a Saml2Client for a configuration, with the given per-request
+    state and identity caches. The security context and the other parts that
+    don't depend on the request are built once for each configuration, and
+    for each generation of its metadata: the clients are shallow copies of
+    a prototype client, cached on the configuration.
+
+    All the attributes that pysaml2 changes while handling a request are
+    replaced on each copy. The shared security context isn't changed after
+    its construction, unless the certificates are generated per request
+    (`generate_cert_func`), in which case each copy has its own context.
+    """
+    generation = getattr(conf.metadata, "generation", None)
+    cached = getattr(conf, "_spid_client", None)
+    if cached is None or cached[0] != generation:
+        cached = conf._spid_client = (generation, Saml2Client(conf))
+
+    client = copy.copy(cached[1])
+    client.users = Population(identity_cache)
+    client.state = {} if state_cache is None else state_cache
+    client.lock = threading.Lock()
+    client.artifact = {}
+    client.artifact2response = {}
+    client.cookiejar = http_cookiejar.CookieJar()
+    client.request_args = dict(client.request_args)
+    if client.sec.cert_handler.generate_cert():
+        client.sec = security_context(conf)
+    return client
+
+
 def spid_sp_authn_request(conf, selected_idp, next_url=""):
-    client = Saml2Client(conf)
+    with timed("request_build"):
+        client = get_saml2_client(conf)
 
     logger.debug(f"Redirecting user to the IdP via {SAML2_DEFAULT_BINDING} binding.")
 
     # use the html provided by pysaml2 if no template was specified or it didn't exist
     # SPID want the fqdn of the IDP, not the SSO endpoint
     location_fixed = selected_idp
-    location = client.sso_location(selected_idp, SAML2_DEFAULT_BINDING)
-
-    authn_req = saml2.samlp.AuthnRequest()
-    authn_req.destination = location_fixed
-    # spid-testenv2 preleva l'attribute consumer service dalla authnRequest (anche se questo sta già nei metadati...)
-    authn_req.attribute_consuming_service_index = "0"
-
-    # issuer
-    issuer = saml2.saml.Issuer()
-    issuer.name_qualifier = client.config.entityid
-    issuer.text = client.config.entityid
-    issuer.format = "urn:oasis:names:tc:SAML:2.0:nameid-format:entity"
-    authn_req.issuer = issuer
-
-    # message id
-    authn_req.id = saml2.s_utils.sid()
-    authn_req.version = saml2.VERSION  # "2.0"
-    authn_req.issue_instant = saml2.time_util.instant()
-
-    name_id_policy = saml2.samlp.NameIDPolicy()
-    name_id_policy.format = settings.SPID_NAMEID_FORMAT
-    authn_req.name_id_policy = name_id_policy
-
-    authn_context = requested_authn_context(class_ref=settings.SPID_AUTH_CONTEXT)
-    authn_req.requested_authn_context = authn_context
-
-    # if SPID authentication level is > 1 then forceauthn must be True
-    authn_req.force_authn = settings.SPID_ACR_FAUTHN_MAP[settings.SPID_AUTH_CONTEXT]
-
-    authn_req.protocol_binding = SAML2_DEFAULT_BINDING
-
-    assertion_consumer_service_url = client.config._sp_endpoints[
-        "assertion_consumer_service"
-    ][0][0]
-    authn_req.assertion_consumer_service_url = assertion_consumer_service_url
-
-    authn_req_signed = client.sign(
-        authn_req,
-        sign_prepare=False,
-        sign_alg=settings.SPID_SIG_ALG,
-        digest_alg=settings.SPID_DIG_ALG,
-    )
-
-    logger.debug(f"AuthRequest to {selected_idp}: {authn_req_signed}")
+    with timed("metadata_lookup"):
+        location = client.sso_location(selected_idp, SAML2_DEFAULT_BINDING)
+
+    with timed("request_build"):
+        authn_req = saml2.samlp.AuthnRequest()
+        authn_req.destination = location_fixed
+        # spid-testenv2 preleva l'attribute consumer service dalla authnRequest (anche se questo sta già nei metadati...)
+        authn_req.attribute_consuming_service_index = "0"
+
+        # issuer
+        issuer = saml2.saml.Issuer()
+        issuer.name_qualifier = client.config.entityid
+        issuer.text = client.config.entityid
+        issuer.format = "urn:oasis:names:tc:SAML:2.0:nameid-format:entity"
+        authn_req.issuer = issuer
+
+        # message id
+        authn_req.id = saml2.s_utils.sid()
+        authn_req.version = saml2.VERSION  # "2.0"
+        authn_req.issue_instant = saml2.time_util.instant()
+
+        name_id_policy = saml2.samlp.NameIDPolicy()
+        name_id_policy.format = settings.SPID_NAMEID_FORMAT
+        authn_req.name_id_policy = name_id_policy
+
+        authn_context = requested_authn_context(class_ref=settings.SPID_AUTH_CONTEXT)
+        authn_req.requested_authn_context = authn_context
+
+        # if SPID authentication level is > 1 then forceauthn must be True
+        authn_req.force_authn = settings.SPID_ACR_FAUTHN_MAP[settings.SPID_AUTH_CONTEXT]
+
+        authn_req.protocol_binding = SAML2_DEFAULT_BINDING
+
+        assertion_consumer_service_url = client.config._sp_endpoints[
+            "assertion_consumer_service"
+        ][0][0]
+        authn_req.assertion_consumer_service_url = assertion_consumer_service_url
+
+    with timed("signing"):
+        authn_req_signed = client.sign(
+            authn_req,
+            sign_prepare=False,
+            sign_alg=settings.SPID_SIG_ALG,
+            digest_alg=settings.SPID_DIG_ALG,
+        )
+
+    log_saml_message(logger, "AuthnRequest to", selected_idp, authn_req_signed)
 
     relay_state = next_url or reverse("djangosaml2:saml2_echo_attributes")
-    http_info = client.apply_binding(
-        SAML2_DEFAULT_BINDING,
-        authn_req_signed,
-        location,
-        sign=True,
-        sigalg=settings.SPID_SIG_ALG,
-        relay_state=relay_state,
-    )
+    with timed("binding"):
+        http_info = client.apply_binding(
+            SAML2_DEFAULT_BINDING,
+            authn_req_signed,
+            location,
+            sign=True,
+            sigalg=settings.SPID_SIG_ALG,
+            relay_state=relay_state,
+        )
 
     return dict(
         http_response=http_info,
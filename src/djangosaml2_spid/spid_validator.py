@@ -1,10 +1,9 @@
 import datetime
-import pytz
-import inspect
+import functools
 
-from saml2 import samlp
+from saml2 import SAMLError, samlp
 
-from .spid_errors import SpidError
+from .utils import parse_xs_datetime
 
 ALLOWED_AUTHN_CONTEXT_CLASS = [
     "https://www.spid.gov.it/SpidL1",
@@ -12,8 +11,93 @@ ALLOWED_AUTHN_CONTEXT_CLASS = [
     "https://www.spid.gov.it/SpidL3",
 ]
 
+NAMEID_FORMAT_ENTITY = "urn:oasis:names:tc:SAML:2.0:nameid-format:entity"
+
+RESPONSE_SCOPE = "response"
+ASSERTION_SCOPE = "assertion"
+
+DEFAULT_PROFILES = ("spid", "strict")
+STRICT_PROFILES = ("strict",)
+
+
+class SpidValidationError(SAMLError):
+    """
+    A SPID response validation failure. The check that failed and
+    its SPID test numbers are set by Saml2ResponseValidator.run().
+    """
+
+    def __init__(self, message, check=None, tests=()):
+        super().__init__(message)
+        self.message = message
+        self.check = check
+        self.tests = tests
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(message={self.message!r}, "
+            f"check={self.check!r}, tests={self.tests!r})"
+        )
+
+    def as_dict(self):
+        return {"check": self.check, "tests": list(self.tests), "message": self.message}
+
+
+class ValidationCheck(object):
+    """A check of the registry of Saml2ResponseValidator."""
+
+    __slots__ = ("name", "tests", "scope", "profiles", "func")
+
+    def __init__(self, name, tests, scope, profiles, func=None):
+        self.name = name
+        self.tests = tests
+        self.scope = scope
+        self.profiles = profiles
+        self.func = func
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name!r}, tests={self.tests!r})"
+
+
+def response_check(*tests, profiles=DEFAULT_PROFILES):
+    """Registers a validator method as a check of the response."""
+
+    def decorator(func):
+        func.spid_check = ValidationCheck(func.__name__, tests, RESPONSE_SCOPE, profiles)
+        return func
+
+    return decorator
+
+
+def assertion_check(*tests, profiles=DEFAULT_PROFILES):
+    """
+    Registers a validator method as a check of an assertion. Called
+    without an assertion the method checks all the assertions.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, assertion=None):
+            if assertion is not None:
+                return func(self, assertion)
+            for assertion in self.response.assertion:
+                func(self, assertion)
+
+        wrapper.spid_check = ValidationCheck(func.__name__, tests, ASSERTION_SCOPE, profiles)
+        return wrapper
+
+    return decorator
+
 
 class Saml2ResponseValidator(object):
+    """
+    SPID checks of an authentication response. The checks are registered
+    with the response_check() and assertion_check() decorators and the
+    check sets of each profile are compiled once, when the class is created.
+    """
+
+    checks = {}  # name -> ValidationCheck
+    profiles = {}  # profile -> (response checks, assertion checks)
+
     def __init__(
         self,
         authn_response="",
@@ -26,8 +110,17 @@ class Saml2ResponseValidator(object):
         authn_context_class_ref="https://www.spid.gov.it/SpidL2",
         return_addrs=(),
     ):
-
-        self.response = samlp.response_from_string(authn_response)
+        """
+        *authn_response* can be the XML string of the response, a parsed
+        samlp.Response or a pysaml2 AuthnResponse, whose parsed response
+        is used without parsing the XML again.
+        """
+        if isinstance(authn_response, samlp.Response):
+            self.response = authn_response
+        elif isinstance(getattr(authn_response, "response", None), samlp.Response):
+            self.response = authn_response.response
+        else:
+            self.response = samlp.response_from_string(authn_response)
         self.nameid_formats = nameid_formats
         self.recipient = recipient
         self.accepted_time_diff = accepted_time_diff or 300
@@ -35,28 +128,73 @@ class Saml2ResponseValidator(object):
         self.in_response_to = in_response_to
         self.requester = requester
         self.return_addrs = return_addrs
+        self.now = datetime.datetime.now(datetime.timezone.utc)
+        self.time_diff = datetime.timedelta(seconds=self.accepted_time_diff)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile_checks()
+
+    @classmethod
+    def compile_checks(cls):
+        """Builds the registry of the checks and the check sets of each profile."""
+        checks = {}
+        for name in dir(cls):
+            # Overridden checks keep the registration of the parent class
+            for klass in cls.__mro__:
+                check = getattr(klass.__dict__.get(name), "spid_check", None)
+                if check is not None:
+                    checks[name] = ValidationCheck(
+                        name, check.tests, check.scope, check.profiles, getattr(cls, name)
+                    )
+                    break
+
+        # Checks run in the order of their SPID test numbers
+        cls.checks = dict(sorted(checks.items(), key=lambda x: x[1].tests))
+        cls.profiles = {}
+        for profile in {p for check in checks.values() for p in check.profiles}:
+            cls.profiles[profile] = cls.split_checks(
+                [c for c in cls.checks.values() if profile in c.profiles]
+            )
+
+    @staticmethod
+    def split_checks(checks):
+        return (
+            tuple(c for c in checks if c.scope == RESPONSE_SCOPE),
+            tuple(c for c in checks if c.scope == ASSERTION_SCOPE),
+        )
+
+    @staticmethod
+    def parse_datetime(value, msg):
+        """Parses an xs:dateTime value, raising a SpidValidationError if it's malformed."""
+        try:
+            return parse_xs_datetime(value)
+        except ValueError:
+            raise SpidValidationError(msg) from None
 
     # handled adding authn req arguments in the session state (cookie)
+    @response_check(16, 17, 18)
     def validate_in_response_to(self):
         """spid test 16, 17 e 18"""
         if not self.response.in_response_to:
             if self.response.in_response_to is None:
-                raise SpidError("InResponseTo not provided")  # Error nr.17
-            raise SpidError("InResponseTo unspecified")  # Error nr.16
+                raise SpidValidationError("InResponseTo not provided")  # Error nr.17
+            raise SpidValidationError("InResponseTo unspecified")  # Error nr.16
 
         # Check for error nr.18
         if isinstance(self.in_response_to, str):
             if self.response.in_response_to != self.in_response_to:
-                raise SpidError(
+                raise SpidValidationError(
                     f"InResponseTo not valid: "
                     f"{self.response.in_response_to} != {self.in_response_to}"
                 )
         elif self.response.in_response_to not in self.in_response_to:
-            raise SpidError(
+            raise SpidValidationError(
                 f"InResponseTo not valid: "
                 f"{self.response.in_response_to} not in {self.in_response_to}"
             )
 
+    @response_check(19, 20)
     def validate_destination(self):
         """spid test 19 e 20
         inutile se disabiliti gli unsolicited
@@ -66,275 +204,264 @@ class Saml2ResponseValidator(object):
             or self.response.destination not in self.return_addrs
         ):
             _msg = f"Destination is not valid: {self.response.destination} not in {self.return_addrs}"
-            raise SpidError(_msg)
+            raise SpidValidationError(_msg)
 
+    @response_check(30, 31)
     def validate_issuer(self):
-        """spid saml check 30, 70, 71, 72
+        """spid saml check 30, 31
         <saml:Issuer Format="urn:oasis:names:tc:SAML:2.0:nameid-format:entity">https://localhost:8080</saml:Issuer>
         """
+        if self.response.issuer is None:
+            raise SpidValidationError("Missing Issuer")
 
         # check that this issuer is in the metadata...
         if self.requester:
             if self.requester != self.response.issuer.text:
-                raise SpidError(f"Issuer different {self.response.issuer.text}")
+                raise SpidValidationError(f"Issuer different {self.response.issuer.text}")
 
         # 30, 31
         # check that this issuer is in the metadata...
         if self.response.issuer.format:
-            if (
-                self.response.issuer.format
-                != "urn:oasis:names:tc:SAML:2.0:nameid-format:entity"
-            ):
-                raise SpidError(
-                    f'Issuer NameFormat is invalid: {self.response.issuer.format} != "urn:oasis:names:tc:SAML:2.0:nameid-format:entity"'
+            if self.response.issuer.format != NAMEID_FORMAT_ENTITY:
+                raise SpidValidationError(
+                    f'Issuer NameFormat is invalid: {self.response.issuer.format} != "{NAMEID_FORMAT_ENTITY}"'
                 )
 
-        msg = "Issuer format is not valid: {}"
-        # 70, 71
-        # if not hasattr(self.response.issuer, 'format') or \
-        #     not getattr(self.response.issuer, 'format', None):
-        #     raise SpidError(msg.format(self.response.issuer.format))
-
-        # 70, 71, 72
-        for i in self.response.assertion:
-            if not hasattr(i.issuer, "format"):
-                raise SpidError(msg.format(self.response.issuer.format))
-            elif i.issuer.format != "urn:oasis:names:tc:SAML:2.0:nameid-format:entity":
-                raise SpidError(msg.format(self.response.issuer.format))
-
-    def validate_assertion_version(self):
+    @assertion_check(35)
+    def validate_assertion_version(self, assertion):
         """spid saml check 35"""
-        for i in self.response.assertion:
-            if i.version != "2.0":
-                msg = 'validate_assertion_version failed on: "{}"'
-                raise SpidError(msg.format(i.version))
+        if assertion.version != "2.0":
+            msg = 'validate_assertion_version failed on: "{}"'
+            raise SpidValidationError(msg.format(assertion.version))
 
-    def validate_issueinstant(self):
+    @assertion_check(39, 40)
+    def validate_issueinstant(self, assertion):
         """spid saml check 39, 40"""
-        # Spid dt standard format
-        for i in self.response.assertion:
+        msg = f"Not a valid issue_instant: {assertion.issue_instant}"
+        issue_instant = self.parse_datetime(assertion.issue_instant, msg)
+        if abs(self.now - issue_instant) > self.time_diff:
+            raise SpidValidationError(msg)
 
-            try:
-                issueinstant_naive = datetime.datetime.strptime(
-                    i.issue_instant, "%Y-%m-%dT%H:%M:%SZ"
+    @assertion_check(43, 45, 46, 47, 48, 49)
+    def validate_name_qualifier(self, assertion):
+        """spid saml check 43, 45, 46, 47, 48, 49"""
+        name_id = assertion.subject.name_id
+        if not getattr(name_id, "name_qualifier", None):
+            raise SpidValidationError("Not a valid subject.name_id.name_qualifier")
+        if not name_id.format:
+            raise SpidValidationError("Not a valid subject.name_id.format")
+        if name_id.format not in self.nameid_formats:
+            msg = "Not a valid subject.name_id.format: {}"
+            raise SpidValidationError(msg.format(name_id.format))
+
+    @assertion_check(50, 59, 60, 61, 63, 64)
+    def validate_subject_confirmation_data(self, assertion):
+        """spid saml check 50, 59, 60, 61, 63, 64
+
+        saml_response.assertion[0].subject.subject_confirmation[0].subject_confirmation_data.__dict__
+        """
+        for subject_confirmation in assertion.subject.subject_confirmation:
+            data = getattr(subject_confirmation, "subject_confirmation_data", None)
+            # 61
+            if not data:
+                raise SpidValidationError("subject_confirmation_data not present")
+
+            # 60
+            if not data.in_response_to:
+                raise SpidValidationError(
+                    "subject.subject_confirmation_data in response -> null data"
                 )
-            except ValueError:
-                issueinstant_naive = datetime.datetime.strptime(
-                    i.issue_instant, "%Y-%m-%dT%H:%M:%S.%fZ"
+
+            # 50
+            if self.recipient != data.recipient:
+                msg = "subject_confirmation_data.recipient not valid: {}"
+                raise SpidValidationError(msg.format(data.recipient))
+
+            # 63 ,64
+            msg = "subject.subject_confirmation_data not_on_or_after not valid"
+            if not getattr(data, "not_on_or_after", None):
+                raise SpidValidationError(msg)
+            not_on_or_after = self.parse_datetime(data.not_on_or_after, msg)
+            if not_on_or_after <= self.now - self.time_diff:
+                raise SpidValidationError(
+                    f"subject.subject_confirmation_data expired on {data.not_on_or_after}"
                 )
 
-            issuerinstant_aware = pytz.utc.localize(issueinstant_naive)
-            now = pytz.utc.localize(datetime.datetime.utcnow())
+    @assertion_check(62, profiles=STRICT_PROFILES)
+    def validate_subject_confirmation_in_response_to(self, assertion):
+        """spid saml check 62
 
-            if now < issuerinstant_aware:
-                seconds = (issuerinstant_aware - now).seconds
-            else:
-                seconds = (now - issuerinstant_aware).seconds
+        Already covered by pysaml2 when allow_unsolicited is false
+        (XML parse error: Unsolicited response: id-OsoMQGYzX4HGLsfL7)
+        """
+        for subject_confirmation in assertion.subject.subject_confirmation:
+            data = subject_confirmation.subject_confirmation_data
+            if data.in_response_to != self.response.in_response_to:
+                raise SpidValidationError(
+                    "subject.subject_confirmation_data in response to not valid"
+                )
 
-            if seconds > self.accepted_time_diff:
-                msg = "Not a valid issue_instant: {}"
-                raise SpidError(msg.format(self.response.issue_instant))
+    @assertion_check(70, 71, 72)
+    def validate_assertion_issuer(self, assertion):
+        """spid saml check 70, 71, 72"""
+        if getattr(assertion.issuer, "format", None) != NAMEID_FORMAT_ENTITY:
+            msg = "Issuer format is not valid: {}"
+            raise SpidValidationError(msg.format(self.response.issuer.format))
 
-    def validate_name_qualifier(self):
-        """spid saml check 43, 45, 46, 47, 48, 49"""
-        for i in self.response.assertion:
-            if (
-                not hasattr(i.subject.name_id, "name_qualifier")
-                or not i.subject.name_id.name_qualifier
-            ):
-                raise SpidError("Not a valid subject.name_id.name_qualifier")
-            if not i.subject.name_id.format:
-                raise SpidError("Not a valid subject.name_id.format")
-            if i.subject.name_id.format not in self.nameid_formats:
-                msg = "Not a valid subject.name_id.format: {}"
-                raise SpidError(msg.format(i.subject.name_id.format))
-
-    def validate_subject_confirmation_data(self):
-        """spid saml check 59, 61, 62, 63, 64
+    @assertion_check(73, 74, 75, 76, 79, 80, 84, 85)
+    def validate_assertion_conditions(self, assertion):
+        """spid saml check 73, 74, 75, 76, 79, 80, 84, 85
 
-        saml_response.assertion[0].subject.subject_confirmation[0].subject_confirmation_data.__dict__
+        saml_response.assertion[0].conditions
         """
-        for i in self.response.assertion:
-            for subject_confirmation in i.subject.subject_confirmation:
-                # 61
-                if not hasattr(
-                    subject_confirmation, "subject_confirmation_data"
-                ) or not getattr(
-                    subject_confirmation, "subject_confirmation_data", None
-                ):
-                    msg = "subject_confirmation_data not present"
-                    raise SpidError(msg)
-
-                # 60
-                if not subject_confirmation.subject_confirmation_data.in_response_to:
-                    raise SpidError(
-                        "subject.subject_confirmation_data in response -> null data"
-                    )
+        conditions = getattr(assertion, "conditions", None)
+        # 73, 74
+        if not conditions:
+            raise SpidValidationError("Assertion conditions not present")
+
+        # 75, 76
+        msg = "Assertion conditions not_before not valid"
+        if not getattr(conditions, "not_before", None):
+            raise SpidValidationError(msg)
+        not_before = self.parse_datetime(conditions.not_before, msg)
+        if not_before > self.now + self.time_diff:
+            raise SpidValidationError(
+                f"Assertion conditions not valid before {conditions.not_before}"
+            )
 
-                # 62 avoided with allow_unsolicited set to false (XML parse error: Unsolicited response: id-OsoMQGYzX4HGLsfL7)
-                # if subject.subject_confirmation_data.in_response_to != self.in_response_to:
-                # raise SpidError('subject.subject_confirmation_data in response to not valid')
-
-                # 50
-                if (
-                    self.recipient
-                    != subject_confirmation.subject_confirmation_data.recipient
-                ):
-                    msg = "subject_confirmation_data.recipient not valid: {}"
-                    raise SpidError(
-                        msg.format(
-                            subject_confirmation.subject_confirmation_data.recipient
-                        )
-                    )
+        # 79, 80
+        msg = "Assertion conditions not_on_or_after not valid"
+        if not getattr(conditions, "not_on_or_after", None):
+            raise SpidValidationError(msg)
+        not_on_or_after = self.parse_datetime(conditions.not_on_or_after, msg)
+        if not_on_or_after <= self.now - self.time_diff:
+            raise SpidValidationError(
+                f"Assertion conditions expired on {conditions.not_on_or_after}"
+            )
 
-                # 63 ,64
-                if not hasattr(
-                    subject_confirmation.subject_confirmation_data, "not_on_or_after"
-                ) or not getattr(
-                    subject_confirmation.subject_confirmation_data,
-                    "not_on_or_after",
-                    None,
-                ):
-                    raise SpidError(
-                        "subject.subject_confirmation_data not_on_or_after not valid"
-                    )
+        # 84
+        if not getattr(conditions, "audience_restriction", None):
+            raise SpidValidationError("Assertion conditions without audience_restriction")
+
+        # 85
+        # already filtered by pysaml2: AttributeError: 'NoneType' object has no attribute 'strip'
+        for aud in conditions.audience_restriction:
+            if not getattr(aud, "audience", None) or not aud.audience[0].text:
+                raise SpidValidationError(
+                    "Assertion conditions audience_restriction without audience"
+                )
 
-                if not hasattr(
-                    subject_confirmation.subject_confirmation_data, "in_response_to"
-                ) or not getattr(
-                    subject_confirmation.subject_confirmation_data,
-                    "in_response_to",
-                    None,
-                ):
-                    raise SpidError(
-                        "subject.subject_confirmation_data in response to not valid"
+    @assertion_check(90, 92, 93, 94, 95, 96, 97, 98)
+    def validate_assertion_authn_statement(self, assertion):
+        """spid saml check 90, 92, 93, 94, 95, 96, 97, 98"""
+        if not getattr(assertion, "authn_statement", None):
+            raise SpidValidationError("Assertion authn_statement is missing/invalid")
+
+        # 90, 92, 93
+        for authns in assertion.authn_statement:
+            authn_context = getattr(authns, "authn_context", None)
+            class_ref = getattr(authn_context, "authn_context_class_ref", None)
+            if not class_ref:
+                raise SpidValidationError(
+                    "Assertion authn_statement.authn_context_class_ref is missing/invalid"
+                )
+            # 94, 95, 96
+            if class_ref.text != self.authn_context_class_ref:
+                _msg = (
+                    "Invalid Spid authn_context_class_ref, requested: "
+                    f"{self.authn_context_class_ref}, got {class_ref.text}"
+                )
+                try:
+                    level_sp = int(self.authn_context_class_ref[-1])
+                    level_idp = int(class_ref.text.strip().replace("\n", "")[-1])
+                except Exception:
+                    raise SpidValidationError(_msg)
+                if level_idp < level_sp:
+                    raise SpidValidationError(_msg)
+
+            # 97
+            if class_ref.text not in ALLOWED_AUTHN_CONTEXT_CLASS:
+                raise SpidValidationError(
+                    "Assertion authn_statement.authn_context."
+                    "authn_context_class_ref is missing/invalid"
+                )
+            # 98
+            if not getattr(assertion, "attribute_statement", None):
+                raise SpidValidationError("Assertion attribute_statement is missing/invalid")
+
+            for attri in assertion.attribute_statement:
+                if not attri.attribute:
+                    raise SpidValidationError(
+                        "Assertion attribute_statement.attribute is missing/invalid"
                     )
 
-    def validate_assertion_conditions(self):
-        """spid saml check 73, 74, 75, 76, 79, 80, 84, 85
+    def get_checks(self, tests=(), profile="spid"):
+        """
+        Returns the response and the assertion checks to run: the checks
+        named in *tests*, or the precompiled check set of the *profile*.
+        """
+        if not tests:
+            try:
+                return self.profiles[profile]
+            except KeyError:
+                raise ValueError(f"Unknown validation profile {profile!r}") from None
 
-        saml_response.assertion[0].conditions
+        try:
+            return self.split_checks([self.checks[name] for name in tests])
+        except KeyError as err:
+            raise ValueError(f"Unknown validation check {err.args[0]!r}") from None
+
+    def run(self, tests=(), profile="spid"):
         """
-        for i in self.response.assertion:
-            # 73, 74
-            if not hasattr(i, "conditions") or not getattr(i, "conditions", None):
-                # or not i.conditions.text.strip(' ').strip('\n'):
-                raise SpidError("Assertion conditions not present")
-
-            # 75, 76
-            if not hasattr(i.conditions, "not_before") or not getattr(
-                i.conditions, "not_before", None
-            ):
-                # or not i.conditions.text.strip(' ').strip('\n'):
-                raise SpidError("Assertion conditions not_before not valid")
-
-            # 79, 80
-            if not hasattr(i.conditions, "not_on_or_after") or not getattr(
-                i.conditions, "not_on_or_after", None
-            ):
-                # or not i.conditions.text.strip(' ').strip('\n'):
-                raise SpidError("Assertion conditions not_on_or_after not valid")
-
-            # 84
-            if not hasattr(i.conditions, "audience_restriction") or not getattr(
-                i.conditions, "audience_restriction", None
-            ):
-                raise SpidError("Assertion conditions without audience_restriction")
-
-            # 85
-            # already filtered by pysaml2: AttributeError: 'NoneType' object has no attribute 'strip'
-            for aud in i.conditions.audience_restriction:
-                if not getattr(aud, "audience", None):
-                    raise SpidError(
-                        (
-                            "Assertion conditions audience_restriction "
-                            "without audience"
-                        )
-                    )
-                if not aud.audience[0].text:
-                    raise SpidError(
-                        (
-                            "Assertion conditions audience_restriction "
-                            "without audience"
-                        )
-                    )
+        Runs the checks of a profile ('spid' or 'strict') or the checks
+        named in *tests*. The checks on assertions run in one pass over each
+        assertion. Raises a SpidValidationError on the first failure.
+        """
+        response_checks, assertion_checks = self.get_checks(tests, profile)
+
+        check = None
+        try:
+            for check in response_checks:
+                check.func(self)
+
+            for assertion in self.response.assertion:
+                for check in assertion_checks:
+                    check.func(self, assertion)
+        except SpidValidationError as err:
+            if err.check is None:
+                err.check, err.tests = check.name, check.tests
+            raise
+
+    def validate(self, tests=(), profile="spid"):
+        """
+        Runs all the checks, like run(), without stopping at the first
+        failure. Returns the list of the SpidValidationError instances
+        of all the violations, that is empty if the response is valid.
+        """
+        response_checks, assertion_checks = self.get_checks(tests, profile)
+        report = []
 
-    def validate_assertion_authn_statement(self):
-        """spid saml check 90, 92, 97, 98"""
-        for i in self.response.assertion:
-            if not hasattr(i, "authn_statement") or not getattr(
-                i, "authn_statement", None
-            ):
-                raise SpidError("Assertion authn_statement is missing/invalid")
-
-            # 90, 92, 93
-            for authns in i.authn_statement:
-                if (
-                    not hasattr(authns, "authn_context")
-                    or not getattr(authns, "authn_context", None)
-                    or not hasattr(authns.authn_context, "authn_context_class_ref")
-                    or not getattr(
-                        authns.authn_context, "authn_context_class_ref", None
-                    )
-                ):
-                    raise SpidError(
-                        "Assertion authn_statement.authn_context_class_ref is missing/invalid"
-                    )
-                # 94, 95, 96
-                if (
-                    authns.authn_context.authn_context_class_ref.text
-                    != self.authn_context_class_ref
-                ):
-                    _msg = (
-                        "Invalid Spid authn_context_class_ref, requested: "
-                        f"{self.authn_context_class_ref}, got {authns.authn_context.authn_context_class_ref.text}"
-                    )
-                    try:
-                        level_sp = int(self.authn_context_class_ref[-1])
-                        level_idp = int(
-                            authns.authn_context.authn_context_class_ref.text.strip().replace(
-                                "\n", ""
-                            )[
-                                -1
-                            ]
-                        )
-                        if level_idp < level_sp:
-                            raise SpidError(_msg)
-                    except Exception as e:
-                        raise SpidError(_msg)
-
-                # 97
-                if (
-                    authns.authn_context.authn_context_class_ref.text
-                    not in ALLOWED_AUTHN_CONTEXT_CLASS
-                ):
-                    raise SpidError(
-                        "Assertion authn_statement.authn_context."
-                        "authn_context_class_ref is missing/invalid"
-                    )
-                # 98
-                if not hasattr(i, "attribute_statement") or not getattr(
-                    i, "attribute_statement", None
-                ):
-                    raise SpidError("Assertion attribute_statement is missing/invalid")
-
-                for attri in i.attribute_statement:
-                    if not attri.attribute:
-                        raise SpidError(
-                            "Assertion attribute_statement.attribute is missing/invalid"
-                        )
-
-    def run(self, tests=()):
-        """run all tests/methods"""
-        if not tests:
-            tests = [
-                i[0]
-                for i in inspect.getmembers(self, predicate=inspect.ismethod)
-                if not i[0].startswith("_")
-            ]
-            tests.remove("run")
+        def run_check(check, *args):
+            try:
+                check.func(self, *args)
+            except SpidValidationError as err:
+                if err.check is None:
+                    err.check, err.tests = check.name, check.tests
+                report.append(err)
+            except Exception as err:
+                # A malformed response can break a check: report it and go on
+                report.append(SpidValidationError(
+                    f"{err.__class__.__name__}: {err}", check.name, check.tests
+                ))
+
+        for check in response_checks:
+            run_check(check)
+
+        for assertion in self.response.assertion:
+            for check in assertion_checks:
+                run_check(check, assertion)
+
+        return report
 
-            # tests.remove('validate_issuer')
 
-        for element in tests:
-            getattr(self, element)()
+Saml2ResponseValidator.compile_checks()
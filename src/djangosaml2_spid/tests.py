@@ -1,5 +1,8 @@
 import os
 import io
+import asyncio
+import json
+import logging
 import glob
 import unittest
 from unittest.mock import patch
@@ -8,17 +11,32 @@ from xml.parsers.expat import ExpatError
 import zlib
 import binascii
 import base64
+import copy
+import datetime
 import pathlib
-
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+import saml2.saml
+import saml2.samlp
 from saml2 import BINDING_HTTP_POST  # , BINDING_HTTP_REDIRECT
 from saml2.saml import NAMEID_FORMAT_TRANSIENT, NAMEID_FORMAT_ENCRYPTED
+from saml2.time_util import instant
 from saml2.xmldsig import DIGEST_SHA256, DIGEST_SHA512, SIG_RSA_SHA256, SIG_RSA_SHA512
 
 from django.contrib.auth import get_user_model
-from django.core.management import call_command
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
 from django.http import HttpResponseBadRequest
 from django.test import (
     SimpleTestCase,
+    AsyncRequestFactory,
     Client,
     TestCase,
     RequestFactory,
@@ -27,11 +45,48 @@ from django.test import (
 from django.urls import reverse
 from django.conf import settings
 
+from djangosaml2.cache import OutstandingQueriesCache
 from djangosaml2.conf import get_config_loader, get_config
 
-from .conf import config_settings_loader
-from .utils import repr_saml_request, saml_request_from_html_form
+from . import views
+from .conf import config_settings_loader, get_spid_config
+from .executor import CryptoPoolBusy, get_executor, run_in_executor
+from .spid_crypto import xmlsec
+from .spid_metadata import clear_metadata_cache, sp_metadata_static_path
+from .spid_replay import assertion_expiry, check_assertion_replay, replay_cache_key
+from .spid_request import get_saml2_client
+from .spid_mdstore import (
+    RemoteMetadata,
+    SpidMetadataStore,
+    metadata_ttl,
+    write_metadata_snapshot,
+)
+from .utils import (
+    SamlResponseTooLarge,
+    UnsafeSamlResponse,
+    check_saml_response,
+    parse_xs_datetime,
+    repr_saml_request,
+    saml_request_from_html_form,
+    write_file_atomic,
+)
 from .spid_errors import SpidError
+from .spid_logging import LazySamlMessage, log_saml_message
+from .spid_metrics import (
+    AuthnRequestsCache,
+    add_phase,
+    idp_stats,
+    idp_stats_flushed,
+    phase_timed,
+    record_authn_request,
+    record_error,
+    record_response,
+    record_validation_failure,
+    set_idp,
+    timed,
+    trace_flow,
+)
+from .spid_validator import Saml2ResponseValidator, SpidValidationError
 
 base_dir = pathlib.Path(settings.BASE_DIR)
 
@@ -274,6 +329,708 @@ class TestSpidConfig(TestCase):
             ],
         )
 
+    def test_config_cache(self):
+        request = self.factory.get("/spid/metadata/")
+        saml_config = get_config(request=request)
+        self.assertIs(get_config(request=self.factory.get("/spid/metadata/")), saml_config)
+        base_url = settings.SPID_BASE_URL or "http://testserver/"
+        self.assertIs(get_spid_config(base_url, "spid"), saml_config)
+
+        cie_config = get_config(request=self.factory.get("/cie/metadata/"))
+        self.assertIsNot(cie_config, saml_config)
+        self.assertIn("dateOfBirth", cie_config._sp_required_attributes)
+
+        with override_settings(SPID_CONFIG_CACHE=False):
+            self.assertIsNot(get_config(request=request), get_config(request=request))
+
+    def test_config_cache_invalidation(self):
+        request = self.factory.get("/spid/metadata")
+
+        with tempfile.TemporaryDirectory() as certs_dir:
+            cert_file = os.path.join(certs_dir, "public.cert")
+            shutil.copy(settings.SPID_PUBLIC_CERT, cert_file)
+
+            with override_settings(SPID_PUBLIC_CERT=cert_file):
+                saml_config = get_config(request=request)
+                self.assertIs(get_config(request=request), saml_config)
+
+                stat = os.stat(cert_file)
+                os.utime(cert_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                self.assertIsNot(get_config(request=request), saml_config)
+
+    def test_saml2_client(self):
+        conf = get_config(request=self.factory.get("/spid/metadata"))
+        state = {}
+        client = get_saml2_client(conf, state_cache=state)
+        other_client = get_saml2_client(conf)
+        self.assertIsNot(client, other_client)
+        self.assertIs(client.sec, other_client.sec)
+        self.assertIs(client.state, state)
+        self.assertIsNot(client.users, other_client.users)
+
+        # The shared parts are built again when the metadata change
+        conf.metadata.generation += 1
+        self.assertIsNot(get_saml2_client(conf).sec, client.sec)
+
+    def test_saml2_client_concurrency(self):
+        conf = get_config(request=self.factory.get("/spid/metadata"))
+        barrier = threading.Barrier(2)
+        seen = {}
+
+        def handle_request(name):
+            client = get_saml2_client(conf, state_cache={})
+            barrier.wait()
+            client.state[name] = {"entity_id": name}
+            client.artifact[name] = name
+            client.artifact2response[name] = name
+            client.request_args[name] = name
+            client.users.cache.set(
+                saml2.saml.NameID(text=name), name, {"uid": [name]}, time.time() + 60
+            )
+            barrier.wait()
+            seen[name] = (
+                set(client.state) | set(client.artifact) | set(client.artifact2response)
+                | {x for x in client.request_args if x in ("a", "b")}
+                | {x.text for x in client.users.subjects()}
+            )
+
+        threads = [threading.Thread(target=handle_request, args=(x,)) for x in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each client sees only the state of its own request
+        self.assertEqual(seen, {"a": {"a"}, "b": {"b"}})
+        self.assertEqual(conf._spid_client[1].artifact2response, {})
+        self.assertNotIn("a", conf._spid_client[1].request_args)
+
+
+class TestSpidMetadataStore(TestCase):
+    def setUp(self):
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        self.metadata_file = os.path.join(self.metadata_dir, "idp.xml")
+        shutil.copy(
+            os.path.join(
+                settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR, "spid-saml-check.xml"
+            ),
+            self.metadata_file,
+        )
+
+        request = RequestFactory().get("/spid/metadata/")
+        self.conf = get_config(request=request)
+        self.store = SpidMetadataStore(
+            self.conf.attribute_converters, self.conf, self.metadata_dir
+        )
+
+    def update_metadata_file(self, content):
+        stat = os.stat(self.metadata_file)
+        with open(self.metadata_file, "w") as fp:
+            fp.write(content)
+        os.utime(self.metadata_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_shared_store(self):
+        request = RequestFactory().get("/spid/metadata/")
+        saml_config = get_config(request=request)
+        self.assertIsInstance(saml_config.metadata, SpidMetadataStore)
+
+        cie_config = get_config(request=RequestFactory().get("/cie/metadata/"))
+        self.assertIsNot(cie_config, saml_config)
+        self.assertIs(cie_config.metadata, saml_config.metadata)
+
+    def test_incremental_reload(self):
+        self.assertTrue(self.store.refresh())
+        self.assertEqual(self.store.generation, 1)
+        self.assertIn("https://localhost:8080", self.store.identity_providers())
+        md_file = self.store.metadata[self.metadata_file]
+
+        # Unchanged or only touched files are not parsed again
+        self.assertFalse(self.store.refresh(force=True))
+        with open(self.metadata_file) as fp:
+            content = fp.read()
+        self.update_metadata_file(content)
+        self.assertFalse(self.store.refresh(force=True))
+        self.assertIs(self.store.metadata[self.metadata_file], md_file)
+
+        self.update_metadata_file(
+            content.replace("https://localhost:8080", "https://localhost:8081")
+        )
+        self.assertTrue(self.store.refresh(force=True))
+        self.assertEqual(self.store.generation, 2)
+        self.assertIn("https://localhost:8081", self.store.identity_providers())
+        self.assertNotIn("https://localhost:8080", self.store.identity_providers())
+
+        # A broken file doesn't replace the last good version
+        with self.assertLogs("djangosaml2", level="ERROR"):
+            self.update_metadata_file("<broken")
+            self.assertFalse(self.store.refresh(force=True))
+        self.assertIn("https://localhost:8081", self.store.identity_providers())
+
+        os.remove(self.metadata_file)
+        self.assertTrue(self.store.refresh(force=True))
+        self.assertEqual(self.store.identity_providers(), [])
+
+    def test_metadata_files(self):
+        # All the regular files are loaded, except the hidden ones
+        with open(self.metadata_file) as fp:
+            content = fp.read()
+        with open(os.path.join(self.metadata_dir, "idp2.metadata"), "w") as fp:
+            fp.write(content.replace("https://localhost:8080", "https://localhost:8081"))
+        with open(os.path.join(self.metadata_dir, ".idp3.xml.tmp"), "w") as fp:
+            fp.write("<partial")
+        os.mkdir(os.path.join(self.metadata_dir, "subdir"))
+        write_metadata_snapshot(self.metadata_dir)
+
+        self.assertTrue(self.store.refresh())
+        self.assertEqual(
+            sorted(self.store.identity_providers()),
+            ["https://localhost:8080", "https://localhost:8081"],
+        )
+        self.assertEqual(
+            sorted(os.path.basename(x) for x in self.store.metadata),
+            ["idp.xml", "idp2.metadata"],
+        )
+
+    def test_refresh_interval(self):
+        self.store.refresh_interval = 3600
+        self.assertTrue(self.store.refresh())
+        os.remove(self.metadata_file)
+        self.assertFalse(self.store.refresh())
+        self.assertTrue(self.store.refresh(force=True))
+
+    def test_stamp_file(self):
+        self.store.stamp_file = os.path.join(self.metadata_dir, "stamp")
+        self.assertTrue(self.store.refresh())
+        self.assertFalse(self.store.refresh())
+
+        # Without a stamp file the directory is always swept
+        os.remove(self.metadata_file)
+        self.assertTrue(self.store.refresh())
+
+        write_file_atomic(self.store.stamp_file, b"1")
+        shutil.copy(
+            os.path.join(
+                settings.SPID_IDENTITY_PROVIDERS_METADATA_DIR, "spid-saml-check.xml"
+            ),
+            self.metadata_file,
+        )
+        self.assertTrue(self.store.refresh())
+
+        # Changes are ignored until the stamp file is rewritten
+        os.remove(self.metadata_file)
+        self.assertFalse(self.store.refresh())
+        write_file_atomic(self.store.stamp_file, b"2")
+        self.assertTrue(self.store.refresh())
+
+    def test_snapshot(self):
+        write_metadata_snapshot(self.metadata_dir)
+        with patch.object(self.store, "parse_metadata_file") as mock_parse:
+            self.assertTrue(self.store.refresh())
+        mock_parse.assert_not_called()
+        self.assertIn("https://localhost:8080", self.store.identity_providers())
+
+        # A file changed after the snapshot is parsed
+        with open(self.metadata_file) as fp:
+            content = fp.read()
+        self.update_metadata_file(
+            content.replace("https://localhost:8080", "https://localhost:8081")
+        )
+        self.assertTrue(self.store.refresh(force=True))
+        self.assertIn("https://localhost:8081", self.store.identity_providers())
+
+        # The snapshot entries are matched by hash, not by size and mtime
+        write_metadata_snapshot(self.metadata_dir)
+        stat = os.stat(self.metadata_file)
+        with open(self.metadata_file, "w") as fp:
+            fp.write(content.replace("https://localhost:8080", "https://localhost:8082"))
+        os.utime(self.metadata_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        store = SpidMetadataStore(self.conf.attribute_converters, self.conf, self.metadata_dir)
+        self.assertTrue(store.refresh())
+        self.assertIn("https://localhost:8082", store.identity_providers())
+
+    def test_index(self):
+        from djangosaml2.utils import available_idps
+        from saml2.mdstore import MetadataStore, UnknownSystemEntity
+
+        self.store.refresh()
+        entity_id = "https://localhost:8080"
+        self.assertEqual(
+            self.store.available_idps(),
+            available_idps(unittest.mock.Mock(metadata=self.store)),
+        )
+        self.assertEqual(
+            self.store.single_sign_on_service(entity_id, BINDING_HTTP_POST),
+            MetadataStore.service(
+                self.store, entity_id, "idpsso_descriptor", "single_sign_on_service",
+                BINDING_HTTP_POST,
+            ),
+        )
+        self.assertIs(
+            self.store.single_logout_service(entity_id, BINDING_HTTP_POST, "idpsso"),
+            self.store.single_logout_service(entity_id, BINDING_HTTP_POST, "idpsso"),
+        )
+        with self.assertRaises(UnknownSystemEntity), self.assertLogs("saml2.mdstore"):
+            self.store.single_sign_on_service("https://unknown.example.org")
+
+        # The index is rebuilt with the metadata
+        os.remove(self.metadata_file)
+        self.store.refresh(force=True)
+        self.assertEqual(self.store.available_idps(), {})
+
+    def test_remote_metadata(self):
+        remote_url = "https://idp.example.org/metadata.xml"
+        with open(self.metadata_file, "rb") as fp:
+            content = fp.read().replace(b"https://localhost:8080", remote_url.encode())
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        with patch.object(RemoteMetadata, "refresh_async") as mock_refresh:
+            remote = self.store.add_remote(remote_url, cache_dir=cache_dir)
+        mock_refresh.assert_called_once()
+        self.assertTrue(remote.stale)
+
+        # An unreachable endpoint doesn't fail: the IdP is missing until it's fetched
+        with patch.object(self.store.http, "send", side_effect=ConnectionError("down")):
+            with self.assertLogs("djangosaml2", level="ERROR"):
+                self.assertFalse(remote.fetch())
+        self.assertNotIn(remote_url, self.store.identity_providers())
+        self.assertIsInstance(remote.last_error, ConnectionError)
+        self.assertIsNone(remote.refresh_async())  # retry later
+
+        remote.expires_at = 0
+        response = unittest.mock.Mock(status_code=200, content=content)
+        with patch.object(self.store.http, "send", return_value=response):
+            remote.refresh_async().join()
+        self.assertIn(remote_url, self.store.identity_providers())
+        self.assertFalse(remote.stale)
+        self.assertTrue(os.path.isfile(remote.cache_file))
+
+        # A new store loads the persisted copy without fetching it
+        request = RequestFactory().get("/spid/metadata/")
+        conf = get_config(request=request)
+        store = SpidMetadataStore(conf.attribute_converters, conf, self.metadata_dir)
+        with patch.object(store.http, "send") as mock_send:
+            store.add_remote(remote_url, cache_dir=cache_dir)
+            store.refresh()
+        mock_send.assert_not_called()
+        self.assertIn(remote_url, store.identity_providers())
+
+    def test_remote_metadata_cache_dir(self):
+        parent_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent_dir)
+        remote_url = "https://idp.example.org/metadata.xml"
+
+        cache_dir = os.path.join(parent_dir, "remote_metadata")
+        with patch.object(RemoteMetadata, "refresh_async"):
+            remote = self.store.add_remote(remote_url, cache_dir=cache_dir)
+        self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.path.dirname(remote.cache_file), cache_dir)
+
+        # A directory that other users can write into is not used
+        os.chmod(cache_dir, 0o777)
+        with patch.object(RemoteMetadata, "refresh_async"):
+            with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+                remote = self.store.add_remote(remote_url, cache_dir=cache_dir)
+        self.assertIsNone(remote.cache_file)
+        self.assertIn("writable by other users", ctx.output[0])
+
+        os.chmod(cache_dir, 0o700)
+        with patch("os.getuid", return_value=os.stat(cache_dir).st_uid + 1), \
+                patch.object(RemoteMetadata, "refresh_async"):
+            with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+                remote = self.store.add_remote(remote_url, cache_dir=cache_dir)
+        self.assertIsNone(remote.cache_file)
+        self.assertIn("not owned by the process user", ctx.output[0])
+
+    def test_metadata_ttl(self):
+        self.store.refresh()
+        md_file = self.store.metadata[self.metadata_file]
+        self.assertEqual(metadata_ttl(md_file, 600), 600)
+
+        md_file.entity_descr.cache_duration = "PT1M"
+        self.assertEqual(metadata_ttl(md_file, 600), 60)
+
+        md_file.entity_descr.valid_until = "2001-01-01T00:00:00Z"
+        self.assertEqual(metadata_ttl(md_file, 600), 0)
+
+
+IDP_METADATA_TEMPLATE = """<?xml version="1.0"?>
+<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    xmlns:ds="http://www.w3.org/2000/09/xmldsig#" entityID="{entity_id}">
+  <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:KeyDescriptor use="signing">
+      <ds:KeyInfo><ds:X509Data><ds:X509Certificate>{cert}</ds:X509Certificate></ds:X509Data></ds:KeyInfo>
+    </md:KeyDescriptor>
+    <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+        Location="{entity_id}/sso"/>
+  </md:IDPSSODescriptor>
+</md:EntityDescriptor>
+"""
+
+
+@unittest.skipIf(xmlsec is None, "python xmlsec package is not installed")
+class TestSpidCrypto(TestCase):
+    idp_entity_id = "https://idp.example.org"
+
+    def setUp(self):
+        # An IdP that signs with the SP test key
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        with open(settings.SPID_PUBLIC_CERT) as fp:
+            cert = "".join(line.strip() for line in fp if not line.startswith("-----"))
+        with open(os.path.join(self.metadata_dir, "idp.xml"), "w") as fp:
+            fp.write(IDP_METADATA_TEMPLATE.format(entity_id=self.idp_entity_id, cert=cert))
+
+        override = override_settings(
+            SPID_CRYPTO_BACKEND="python-xmlsec",
+            SPID_IDENTITY_PROVIDERS_METADATA_DIR=self.metadata_dir,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        self.conf = get_config(request=RequestFactory().get("/spid/metadata/"))
+
+    def signed_response(self, secc):
+        from saml2 import class_name, saml, samlp
+        from saml2.s_utils import sid
+        from saml2.sigver import pre_signature_part, signed_instance_factory
+        from saml2.time_util import instant
+
+        response = samlp.Response(
+            id=sid(),
+            version="2.0",
+            issue_instant=instant(),
+            issuer=saml.Issuer(text=self.idp_entity_id, format=saml.NAMEID_FORMAT_ENTITY),
+            status=samlp.Status(status_code=samlp.StatusCode(value=samlp.STATUS_SUCCESS)),
+        )
+        response.signature = pre_signature_part(response.id, secc.my_cert, 1)
+        return signed_instance_factory(response, secc, [(class_name(response), response.id)])
+
+    def test_security_context(self):
+        import saml2.sigver
+        from .spid_crypto import CryptoBackendPythonXmlSec, SpidSecurityContext
+
+        secc = saml2.sigver.security_context(self.conf)
+        self.assertIsInstance(secc, SpidSecurityContext)
+        self.assertIsInstance(secc.crypto, CryptoBackendPythonXmlSec)
+        self.assertIs(secc.metadata, self.conf.metadata)
+
+    def test_verify_with_key_index(self):
+        import saml2.sigver
+        from saml2.sigver import MissingKey, SignatureError
+        from .spid_crypto import VERIFICATION_KEY_PREFIX
+
+        secc = saml2.sigver.security_context(self.conf)
+        signed_xml = self.signed_response(secc)
+
+        with patch("saml2.sigver.make_temp") as mock_make_temp, \
+                patch.object(secc.crypto, "validate_signature",
+                             wraps=secc.crypto.validate_signature) as mock_validate:
+            response = secc.correctly_signed_response(signed_xml)
+            mock_make_temp.assert_not_called()
+
+        self.assertEqual(response.issuer.text, self.idp_entity_id)
+        self.assertTrue(mock_validate.call_args[1]["cert_file"].startswith(VERIFICATION_KEY_PREFIX))
+
+        key_generation, key_index = self.conf.metadata.key_index
+        self.assertEqual(key_generation, self.conf.metadata.generation)
+        self.assertIn(self.idp_entity_id, key_index)
+
+        tampered_xml = signed_xml.replace(self.idp_entity_id, "https://evil.example.org/", 1)
+        with self.assertRaises(MissingKey):
+            secc.correctly_signed_response(tampered_xml)
+
+        tampered_xml = signed_xml.replace('Version="2.0"', 'Version="2.0" Destination="x"', 1)
+        with self.assertRaises(SignatureError):
+            secc.correctly_signed_response(tampered_xml)
+
+    @override_settings(
+        SPID_CRYPTO_POOL_SIZE=1, SPID_CRYPTO_POOL_QUEUE_SIZE=0, SPID_CRYPTO_POOL_TIMEOUT=0
+    )
+    def test_crypto_pool(self):
+        import saml2.sigver
+        from .executor import CryptoPoolBusy, crypto_pool_stats, get_crypto_pool
+
+        crypto_pool_stats.reset()
+        secc = saml2.sigver.security_context(self.conf)
+        self.assertTrue(secc.crypto.use_crypto_pool)
+
+        # Signed and verified by the pool worker
+        signed_xml = self.signed_response(secc)
+        response = secc.correctly_signed_response(signed_xml)
+        self.assertEqual(response.issuer.text, self.idp_entity_id)
+
+        stats = crypto_pool_stats.as_dict()
+        self.assertEqual(stats["completed"], 2)
+        self.assertGreaterEqual(stats["queue_time_max"], stats["queue_time_avg"])
+
+        pool, slots = get_crypto_pool()
+        slots.acquire()
+        try:
+            with self.assertRaises(CryptoPoolBusy):
+                secc.correctly_signed_response(signed_xml)
+        finally:
+            slots.release()
+        self.assertEqual(crypto_pool_stats.as_dict()["rejected"], 1)
+
+        with override_settings(SPID_CRYPTO_BACKEND="xmlsec1"), \
+                self.assertRaises(ImproperlyConfigured):
+            get_config(request=RequestFactory().get("/spid/metadata/"))
+
+
+SPID_RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"
+    xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"
+    ID="_response" Version="2.0" IssueInstant="{issue_instant}"
+    Destination="{recipient}" InResponseTo="{in_response_to}">
+  <saml:Issuer Format="urn:oasis:names:tc:SAML:2.0:nameid-format:entity">https://localhost:8080</saml:Issuer>
+  <samlp:Status>
+    <samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:status:Success"/>
+  </samlp:Status>
+  <saml:Assertion ID="_assertion" Version="2.0" IssueInstant="{issue_instant}">
+    <saml:Issuer Format="urn:oasis:names:tc:SAML:2.0:nameid-format:entity">https://localhost:8080</saml:Issuer>
+    <saml:Subject>
+      <saml:NameID Format="urn:oasis:names:tc:SAML:2.0:nameid-format:transient"
+          NameQualifier="https://localhost:8080">_nameid</saml:NameID>
+      <saml:SubjectConfirmation Method="urn:oasis:names:tc:SAML:2.0:cm:bearer">
+        <saml:SubjectConfirmationData InResponseTo="{in_response_to}"
+            NotOnOrAfter="{not_on_or_after}" Recipient="{recipient}"/>
+      </saml:SubjectConfirmation>
+    </saml:Subject>
+    <saml:Conditions NotBefore="{not_before}" NotOnOrAfter="{not_on_or_after}">
+      <saml:AudienceRestriction>
+        <saml:Audience>http://testserver/spid/metadata/</saml:Audience>
+      </saml:AudienceRestriction>
+    </saml:Conditions>
+    <saml:AuthnStatement AuthnInstant="{issue_instant}" SessionIndex="_session">
+      <saml:AuthnContext>
+        <saml:AuthnContextClassRef>{authn_context_class_ref}</saml:AuthnContextClassRef>
+      </saml:AuthnContext>
+    </saml:AuthnStatement>
+    <saml:AttributeStatement>
+      <saml:Attribute Name="spidCode">
+        <saml:AttributeValue>SPID-0001</saml:AttributeValue>
+      </saml:Attribute>
+    </saml:AttributeStatement>
+  </saml:Assertion>
+</samlp:Response>
+"""
+
+
+def spid_response_xml(**kwargs):
+    now = datetime.datetime.utcnow()
+    values = {
+        "issue_instant": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "not_before": (now - datetime.timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "not_on_or_after": (now + datetime.timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "recipient": "http://testserver/spid/acs/",
+        "in_response_to": "_request",
+        "authn_context_class_ref": "https://www.spid.gov.it/SpidL2",
+    }
+    values.update(kwargs)
+    return SPID_RESPONSE_TEMPLATE.format(**values)
+
+
+class TestSaml2ResponseValidator(unittest.TestCase):
+    def get_validator(self, authn_response=None, **kwargs):
+        kwargs.setdefault("recipient", "http://testserver/spid/acs/")
+        kwargs.setdefault("in_response_to", "_request")
+        kwargs.setdefault("accepted_time_diff", 300)
+        kwargs.setdefault("return_addrs", ["http://testserver/spid/acs/"])
+        return Saml2ResponseValidator(
+            authn_response=authn_response or spid_response_xml(), **kwargs
+        )
+
+    def test_run(self):
+        validator = self.get_validator()
+        self.assertIsNone(validator.run())
+
+        validator = self.get_validator(in_response_to="_other_request")
+        with self.assertRaises(SpidValidationError) as ctx:
+            validator.run()
+        self.assertEqual(ctx.exception.check, "validate_in_response_to")
+        self.assertEqual(ctx.exception.tests, (16, 17, 18))
+
+        validator = self.get_validator(
+            spid_response_xml(authn_context_class_ref="https://www.spid.gov.it/SpidL1")
+        )
+        with self.assertRaises(SpidValidationError) as ctx:
+            validator.run()
+        self.assertEqual(ctx.exception.check, "validate_assertion_authn_statement")
+
+        # A subset of checks
+        self.assertIsNone(validator.run(tests=["validate_destination", "validate_issuer"]))
+        with self.assertRaises(ValueError):
+            validator.run(tests=["validate_unknown"])
+
+    def test_time_checks(self):
+        now = datetime.datetime.utcnow()
+
+        def xs_datetime(**kwargs):
+            return (now + datetime.timedelta(**kwargs)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+        validator = self.get_validator(spid_response_xml(issue_instant=xs_datetime(seconds=-10)))
+        self.assertIsNone(validator.validate_issueinstant())
+
+        # A skew of one day and a few seconds was accepted
+        for issue_instant in (xs_datetime(days=-1, seconds=-10), xs_datetime(seconds=400),
+                              "2021-03-01 10:20:30"):
+            validator = self.get_validator(spid_response_xml(issue_instant=issue_instant))
+            with self.assertRaises(SpidValidationError):
+                validator.validate_issueinstant()
+
+        validator = self.get_validator(spid_response_xml(
+            not_before=xs_datetime(minutes=10),
+            not_on_or_after=xs_datetime(minutes=-10),
+        ))
+        self.assertEqual(
+            [err.message for err in validator.validate()],
+            [
+                f"subject.subject_confirmation_data expired on {xs_datetime(minutes=-10)}",
+                f"Assertion conditions not valid before {xs_datetime(minutes=10)}",
+            ],
+        )
+
+    def test_validate(self):
+        validator = self.get_validator()
+        self.assertEqual(validator.validate(), [])
+        self.assertEqual(validator.validate(profile="strict"), [])
+
+        xml = spid_response_xml(
+            recipient="http://testserver/other/acs/",
+            authn_context_class_ref="https://www.spid.gov.it/SpidL1",
+        ).replace('<saml:Assertion ID="_assertion" Version="2.0"',
+                  '<saml:Assertion ID="_assertion" Version="1.0"')
+        validator = self.get_validator(xml)
+        report = validator.validate()
+        self.assertEqual(
+            [err.check for err in report],
+            [
+                "validate_destination",
+                "validate_assertion_version",
+                "validate_subject_confirmation_data",
+                "validate_assertion_authn_statement",
+            ],
+        )
+        self.assertEqual(report[1].as_dict(), {
+            "check": "validate_assertion_version",
+            "tests": [35],
+            "message": 'validate_assertion_version failed on: "1.0"',
+        })
+
+        # The fail-fast mode raises the first violation
+        with self.assertRaises(SpidValidationError) as ctx:
+            validator.run()
+        self.assertEqual(ctx.exception.check, report[0].check)
+
+        # Unexpected errors of malformed responses are reported too
+        validator.response.assertion[0].subject = None
+        report = validator.validate(tests=["validate_name_qualifier"])
+        self.assertEqual(len(report), 1)
+        self.assertTrue(report[0].message.startswith("AttributeError"))
+
+    def test_check_registry(self):
+        checks = Saml2ResponseValidator.checks
+        self.assertEqual(list(checks)[0], "validate_in_response_to")
+        self.assertEqual(checks["validate_issueinstant"].tests, (39, 40))
+        for check in checks.values():
+            self.assertTrue(all(16 <= test <= 98 for test in check.tests))
+
+        response_checks, assertion_checks = Saml2ResponseValidator.profiles["spid"]
+        self.assertIn(checks["validate_destination"], response_checks)
+        self.assertIn(checks["validate_assertion_conditions"], assertion_checks)
+        self.assertEqual(set(Saml2ResponseValidator.profiles), {"spid", "strict"})
+
+        strict_checks = Saml2ResponseValidator.profiles["strict"][1]
+        check = checks["validate_subject_confirmation_in_response_to"]
+        self.assertIn(check, strict_checks)
+        self.assertNotIn(check, assertion_checks)
+
+        validator = self.get_validator(spid_response_xml(in_response_to="_other_request"),
+                                       in_response_to="_other_request")
+        self.assertIsNone(validator.run())
+        self.assertIsNone(validator.run(profile="strict"))
+        with self.assertRaises(ValueError):
+            validator.run(profile="unknown")
+
+    def test_check_override(self):
+        class CustomValidator(Saml2ResponseValidator):
+            def validate_destination(self):
+                raise SpidValidationError("Custom destination check")
+
+        self.assertIs(CustomValidator.checks["validate_destination"].func,
+                      CustomValidator.validate_destination)
+        self.assertEqual(CustomValidator.checks["validate_destination"].tests, (19, 20))
+
+        validator = CustomValidator(
+            spid_response_xml(), recipient="http://testserver/spid/acs/",
+            in_response_to="_request", accepted_time_diff=300,
+        )
+        with self.assertRaises(SpidValidationError) as ctx:
+            validator.run()
+        self.assertEqual(ctx.exception.message, "Custom destination check")
+
+    def test_parsed_response(self):
+        from saml2 import samlp
+
+        response = samlp.response_from_string(spid_response_xml())
+
+        with patch("djangosaml2_spid.spid_validator.samlp.response_from_string") as mock_parse:
+            validator = self.get_validator(response)
+            self.assertIs(validator.response, response)
+
+            # A pysaml2 AuthnResponse, already parsed
+            authn_response = unittest.mock.Mock(response=response, xmlstr="")
+            validator = self.get_validator(authn_response)
+            self.assertIs(validator.response, response)
+
+        mock_parse.assert_not_called()
+        self.assertIsNone(validator.run())
+
+
+class TestSpidReplay(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.assertion = saml2.samlp.response_from_string(spid_response_xml()).assertion[0]
+
+    def test_assertion_expiry(self):
+        expiry = assertion_expiry(self.assertion)
+        self.assertEqual(
+            expiry, parse_xs_datetime(self.assertion.conditions.not_on_or_after)
+        )
+        self.assertIsNone(assertion_expiry(saml2.saml.Assertion()))
+
+    def test_check_assertion_replay(self):
+        issuer = "https://localhost:8080"
+        self.assertIsNone(check_assertion_replay(issuer, self.assertion, 300))
+        with self.assertRaises(SpidValidationError) as ctx:
+            check_assertion_replay(issuer, self.assertion, 300)
+        self.assertEqual(ctx.exception.check, "assertion_replay")
+
+        # The IDs are recorded by issuer
+        other_issuer = "https://idp.example.org"
+        self.assertIsNone(check_assertion_replay(other_issuer, self.assertion))
+
+        with override_settings(SPID_REPLAY_CACHE=None):
+            self.assertIsNone(check_assertion_replay(issuer, self.assertion, 300))
+
+        # The IDs are kept until the expiry of the assertion
+        key = replay_cache_key(issuer, self.assertion.id)
+        self.assertTrue(key.startswith("spid_replay:"))
+        with patch("djangosaml2_spid.spid_replay.caches") as mock_caches:
+            check_assertion_replay(issuer, self.assertion, 300)
+            mock_caches["default"].add.assert_called_once()
+            args, kwargs = mock_caches["default"].add.call_args
+            self.assertEqual(args[0], key)
+            self.assertTrue(540 <= kwargs["timeout"] <= 600)
+
+            # An expired assertion is not recorded
+            mock_caches["default"].add.reset_mock()
+            now = assertion_expiry(self.assertion) + datetime.timedelta(seconds=301)
+            check_assertion_replay(issuer, self.assertion, 300, now=now)
+            mock_caches["default"].add.assert_not_called()
+
 
 class TestUtils(unittest.TestCase):
     def test_repr_saml_request(self):
@@ -324,6 +1081,265 @@ class TestUtils(unittest.TestCase):
         )
         self.assertEqual(saml_str, "PGZvby8+")
 
+    def test_parse_xs_datetime(self):
+        utc = datetime.timezone.utc
+        expected = datetime.datetime(2021, 3, 1, 10, 20, 30, tzinfo=utc)
+        self.assertEqual(parse_xs_datetime("2021-03-01T10:20:30Z"), expected)
+        self.assertEqual(parse_xs_datetime("2021-03-01T10:20:30"), expected)
+        self.assertEqual(parse_xs_datetime("2021-03-01T12:20:30+02:00"), expected)
+        self.assertEqual(parse_xs_datetime("2021-03-01T09:50:30-00:30"), expected)
+        self.assertEqual(
+            parse_xs_datetime("2021-03-01T10:20:30.5Z"), expected.replace(microsecond=500000)
+        )
+        self.assertEqual(
+            parse_xs_datetime("2021-03-01T10:20:30.123456789Z"),
+            expected.replace(microsecond=123456),
+        )
+        self.assertEqual(
+            parse_xs_datetime("2021-02-28T24:00:00Z"), datetime.datetime(2021, 3, 1, tzinfo=utc)
+        )
+
+        for value in ("2021-03-01", "2021-13-01T10:20:30Z", "2021-03-01T10:20:30.Z",
+                      "2021-03-01T10:20:30+2:00", "", None):
+            with self.assertRaises(ValueError):
+                parse_xs_datetime(value)
+
+    @patch("djangosaml2_spid.utils.SAML_RESPONSE_CHUNK_SIZE", 8)
+    def test_check_saml_response(self):
+        def b64(xml):
+            return base64.b64encode(xml.encode()).decode()
+
+        # The unverified Issuer and InResponseTo are returned
+        saml_response = b64(spid_response_xml())
+        self.assertEqual(
+            check_saml_response(saml_response, 20000, 10, 10),
+            ("https://localhost:8080", "_request"),
+        )
+        # Line-wrapped base64, as sent by some IdPs
+        wrapped = "\n".join(
+            saml_response[i:i + 76] for i in range(0, len(saml_response), 76)
+        )
+        self.assertEqual(
+            check_saml_response(wrapped, 20000, 10, 10),
+            ("https://localhost:8080", "_request"),
+        )
+        self.assertEqual(check_saml_response(b64("<foo/>"), 20000, 10, 10), (None, None))
+
+        with self.assertRaises(SamlResponseTooLarge):
+            check_saml_response(saml_response, max_size=1000)
+
+        cases = [
+            ("foo", "not valid base64"),
+            (b64("<foo>"), "not valid XML"),
+            (b64('<!DOCTYPE foo [<!ENTITY x "y">]><foo>&x;</foo>'), "with a DTD"),
+            (b64("<foo>" * 11 + "</foo>" * 11), "nested deeper than 10"),
+            (b64("<foo %s/>" % " ".join(f'a{i}="1"' for i in range(11))), "11 attributes"),
+        ]
+        for value, msg in cases:
+            with self.assertRaises(UnsafeSamlResponse) as ctx:
+                check_saml_response(value, 20000, 10, 10)
+            self.assertIn(msg, str(ctx.exception))
+            self.assertEqual(ctx.exception.status, 400)
+
+
+class TestSpidLogging(SimpleTestCase):
+    def test_lazy_saml_message(self):
+        message = LazySamlMessage("<foo><bar/></foo>")
+        self.assertEqual(
+            str(message), '<?xml version="1.0" ?>\n<foo>\n\t<bar/>\n</foo>\n'
+        )
+        self.assertEqual(str(LazySamlMessage("PGZvby8+", b64=True, max_size=10)),
+                         '<?xml vers... [20 characters truncated]')
+        self.assertEqual(str(LazySamlMessage("not xml")), "not xml")
+
+    def test_log_saml_message(self):
+        logger = logging.getLogger("djangosaml2")
+        with patch("djangosaml2_spid.spid_logging.repr_saml_request") as mock_repr, \
+                patch.object(logger, "isEnabledFor", return_value=False):
+            log_saml_message(logger, "AuthnRequest to", "https://idp", "<foo/>")
+        mock_repr.assert_not_called()
+
+        with self.assertLogs("djangosaml2", level="DEBUG") as logs:
+            log_saml_message(logger, "AuthnRequest to", "https://idp", "<foo/>")
+        self.assertEqual(
+            logs.records[0].getMessage(),
+            'AuthnRequest to https://idp: <?xml version="1.0" ?>\n<foo/>\n',
+        )
+
+        with override_settings(SPID_SAML_LOG_SAMPLE_RATE=0), \
+                patch.object(logger, "debug") as mock_debug:
+            log_saml_message(logger, "AuthnRequest to", "https://idp", "<foo/>")
+        mock_debug.assert_not_called()
+
+    def test_audit_log(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        audit_log = os.path.join(log_dir, "audit.log")
+
+        with override_settings(SPID_SAML_AUDIT_LOG=audit_log):
+            log_saml_message(
+                logging.getLogger("djangosaml2"), "LogoutRequest to", "https://idp", "<foo/>"
+            )
+        with open(audit_log) as fp:
+            self.assertTrue(fp.read().endswith(" LogoutRequest to https://idp: <foo/>\n"))
+
+
+class TestSpidMetrics(SimpleTestCase):
+    def setUp(self):
+        self.timings = []
+        phase_timed.connect(self.receiver)
+        self.addCleanup(phase_timed.disconnect, self.receiver)
+
+    def receiver(self, sender, phase, duration, idp, **kwargs):
+        self.timings.append((sender, phase, duration, idp))
+
+    def test_trace_flow(self):
+        with trace_flow("login") as trace:
+            with timed("signing"):
+                pass
+            add_phase("signing", 1.0)
+            set_idp("https://idp.example.org")
+            self.assertEqual(self.timings, [])
+
+        self.assertEqual(
+            [(flow, phase, idp) for flow, phase, _, idp in self.timings],
+            [
+                ("login", "signing", "https://idp.example.org"),
+                ("login", "total", "https://idp.example.org"),
+            ],
+        )
+        self.assertGreater(trace.phases["signing"], 1.0)
+
+        # The phases out of a flow and the flows without receivers are not timed
+        self.timings.clear()
+        with timed("signing"):
+            pass
+        phase_timed.disconnect(self.receiver)
+        with trace_flow("login") as trace:
+            self.assertIsNone(trace)
+        self.assertEqual(self.timings, [])
+
+    def test_executor_context(self):
+        async def login():
+            with trace_flow("login"):
+                await run_in_executor(add_phase, "signing", 1.0)
+
+        asyncio.run(login())
+        self.assertEqual(self.timings[0][:3], ("login", "signing", 1.0))
+
+    def test_idp_stats(self):
+        flushed = []
+
+        def receiver(sender, stats, **kwargs):
+            flushed.append(stats)
+
+        idp_stats.flush()
+        idp_stats_flushed.connect(receiver)
+        self.addCleanup(idp_stats_flushed.disconnect, receiver)
+
+        session = SessionStore()
+        record_authn_request(session, "id-1", "https://idp.example.org")
+        record_authn_request(session, "id-2", "https://idp.example.org")
+        with patch("time.time", return_value=time.time() + 2.5):
+            idp = record_response(session, None, "id-1")
+        self.assertEqual(idp, "https://idp.example.org")
+        record_error(idp, 19)
+        record_error(idp, 19)
+        record_response(session, "https://idp2.example.org", "unknown")
+        record_validation_failure("https://idp2.example.org", "validate_issuer")
+        self.assertEqual(flushed, [])
+
+        with override_settings(SPID_METRICS_FLUSH_INTERVAL=0):
+            record_error("https://idp2.example.org", "SignatureError")
+        self.assertEqual(len(flushed), 1)
+        stats = flushed[0]["https://idp.example.org"]
+        self.assertEqual(stats["responses"], 1)
+        self.assertEqual(stats["round_trips"], 1)
+        self.assertAlmostEqual(stats["round_trip_max"], 2.5, places=1)
+        self.assertEqual(stats["errors"], {19: 2})
+        self.assertEqual(
+            flushed[0]["https://idp2.example.org"],
+            {
+                "responses": 1,
+                "round_trips": 0,
+                "round_trip_sum": 0.0,
+                "round_trip_max": 0.0,
+                "errors": {"SignatureError": 1},
+                "validation_failures": {"validate_issuer": 1},
+            },
+        )
+        self.assertEqual(list(AuthnRequestsCache(session)), ["id-2"])
+
+        # The requests older than the max age are discarded
+        with patch("time.time", return_value=time.time() + 7200):
+            record_authn_request(session, "id-3", "https://idp.example.org")
+        self.assertEqual(list(AuthnRequestsCache(session)), ["id-3"])
+
+    def test_idp_stats_flusher(self):
+        from . import spid_metrics
+
+        flushed = []
+
+        def receiver(sender, stats, **kwargs):
+            flushed.append(stats)
+
+        idp_stats.flush()
+        idp_stats_flushed.connect(receiver)
+        self.addCleanup(idp_stats_flushed.disconnect, receiver)
+
+        # The flusher thread is started once per process
+        flusher_pid = idp_stats.flusher_pid
+        self.addCleanup(setattr, idp_stats, "flusher_pid", flusher_pid)
+        idp_stats.flusher_pid = None
+        with patch.object(spid_metrics.threading, "Thread") as mock_thread:
+            record_error("https://idp.example.org", 19)
+            record_error("https://idp.example.org", 19)
+        mock_thread.assert_called_once()
+        self.assertEqual(mock_thread.call_args[1]["target"], idp_stats.run_flusher)
+        self.assertEqual(flushed, [])
+
+        # The statistics are flushed without other responses
+        class Stop(Exception):
+            pass
+
+        idp_stats.last_flush -= settings.SPID_METRICS_FLUSH_INTERVAL
+        with patch.object(spid_metrics.time, "sleep", side_effect=[None, Stop]) as mock_sleep:
+            with self.assertRaises(Stop):
+                idp_stats.run_flusher()
+        self.assertEqual(mock_sleep.call_args_list[0][0], (1,))
+        self.assertEqual(flushed, [{"https://idp.example.org": unittest.mock.ANY}])
+        self.assertEqual(flushed[0]["https://idp.example.org"]["errors"], {19: 2})
+
+    def test_statsd_sink(self):
+        import socket
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        address = "127.0.0.1:%d" % server.getsockname()[1]
+
+        with override_settings(
+            SPID_METRICS_SINK="djangosaml2_spid.spid_metrics.StatsdSink",
+            SPID_METRICS_STATSD_ADDRESS=address,
+        ):
+            phase_timed.disconnect(self.receiver)
+            with trace_flow("logout", idp="https://idp.example.org/a,b"):
+                add_phase("binding", 0.0015)
+            idp_stats.flush()
+            record_error("https://idp.example.org", 19)
+            idp_stats.flush()
+
+        self.assertEqual(
+            server.recv(1024),
+            b"spid.logout.binding:1.500|ms|#idp:https://idp.example.org/a_b",
+        )
+        self.assertTrue(server.recv(1024).startswith(b"spid.logout.total:"))
+        self.assertEqual(
+            server.recv(1024),
+            b"spid.acs.errors:1|c|#idp:https://idp.example.org,code:19",
+        )
+
 
 class TestCommands(TestCase):
     @patch("sys.stderr", new_callable=io.StringIO)
@@ -346,6 +1362,375 @@ class TestCommands(TestCase):
         success_message = "Successfully wrote all IdPs metadata XML files"
         self.assertIn(success_message, mock_out.getvalue().strip().split("\n")[-1])
 
+    def mock_idps_registry(self, idps):
+        """
+        Patches the requests of update_idps, to serve a registry of the IdPs
+        metadata in *idps* (url -> content). Returns the registry data, the
+        list of the requests and the patch.
+        """
+        import requests
+
+        registry = {
+            "data": [
+                {"ipa_entity_code": f"idp_{n}", "entity_name": f"IdP {n}", "metadata_url": url}
+                for n, url in enumerate(idps, 1)
+            ]
+        }
+        requested = []
+
+        def get(session, url, headers=None, **kwargs):
+            self.assertIn("timeout", kwargs)
+            requested.append((url, headers))
+            response = requests.Response()
+            response.status_code = 200
+            response._content_consumed = True
+            if url == settings.SPID_IDENTITY_PROVIDERS_URL:
+                response._content = json.dumps(registry).encode()
+            elif url not in idps:
+                response.status_code = 503
+                response._content = b""
+            elif headers.get("If-None-Match") == '"v1"':
+                response.status_code = 304
+                response._content = b""
+            else:
+                response._content = idps[url].encode()
+                response.headers["ETag"] = '"v1"'
+            return response
+
+        return registry, requested, patch("requests.Session.get", autospec=True, side_effect=get)
+
+    def test_update_idps_conditional(self):
+        idps = {
+            f"https://idp{n}.example.org/metadata.xml": IDP_METADATA_TEMPLATE.format(
+                entity_id=f"https://idp{n}.example.org", cert=""
+            )
+            for n in (1, 2)
+        }
+        registry, requested, mock_get = self.mock_idps_registry(idps)
+
+        parent_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent_dir)
+        metadata_dir = os.path.join(parent_dir, "metadata")
+        out = io.StringIO()
+        with override_settings(SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir), mock_get:
+            call_command("update_idps", stdout=out, stderr=io.StringIO())
+            self.assertEqual(sorted(os.listdir(metadata_dir)), [
+                ".metadata_snapshot.json", ".update_idps.json", "idp_1.xml", "idp_2.xml",
+            ])
+            self.assertRegex(out.getvalue(), r"IdP 1: updated, \d+ bytes")
+
+            # Unchanged metadata are not downloaded again
+            requested.clear()
+            out = io.StringIO()
+            call_command("update_idps", stdout=out, stderr=io.StringIO())
+            self.assertEqual(requested[1][1], {"If-None-Match": '"v1"'})
+            self.assertIn("IdP 2: not modified, 0 bytes", out.getvalue())
+
+            requested.clear()
+            call_command("update_idps", "--force", stdout=out, stderr=io.StringIO())
+            self.assertEqual(requested[1][1], {})
+
+            # Metadata that cannot be downloaded are not overwritten
+            registry["data"][0]["metadata_url"] = "https://down.example.org/metadata.xml"
+            with self.assertRaises(CommandError):
+                call_command("update_idps", stdout=out, stderr=io.StringIO())
+            with open(os.path.join(metadata_dir, "idp_1.xml")) as fp:
+                self.assertEqual(fp.read(), idps["https://idp1.example.org/metadata.xml"])
+
+    def test_update_idps_validation(self):
+        valid = IDP_METADATA_TEMPLATE.format(entity_id="https://idp1.example.org", cert="")
+        idps = {
+            "https://idp1.example.org/metadata.xml": valid,
+            "https://idp2.example.org/metadata.xml": valid.replace(
+                "entityID=", 'validUntil="2000-01-01T00:00:00Z" entityID='
+            ),
+            "https://idp3.example.org/metadata.xml": valid.replace(
+                "</md:EntityDescriptor>", f"<!-- {'x' * 4096} --></md:EntityDescriptor>"
+            ),
+            "https://idp4.example.org/metadata.xml": "<md:EntityDescriptor/>",
+        }
+        registry, requested, mock_get = self.mock_idps_registry(idps)
+
+        # The metadata directory is a link to the active snapshot
+        parent_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent_dir)
+        metadata_dir = os.path.join(parent_dir, "metadata")
+        out = io.StringIO()
+        with override_settings(
+            SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir,
+            SPID_IDENTITY_PROVIDERS_METADATA_MAX_SIZE=4096,
+        ), mock_get:
+            with self.assertRaisesRegex(CommandError, "IdP 2, IdP 3, IdP 4"):
+                call_command("update_idps", stdout=out, stderr=io.StringIO())
+            for n in (2, 3, 4):
+                self.assertIn(f"IdP {n}: rejected", out.getvalue())
+
+            self.assertTrue(os.path.islink(metadata_dir))
+            self.assertEqual(
+                sorted(os.listdir(metadata_dir)),
+                [".metadata_snapshot.json", ".update_idps.json", "idp_1.xml"],
+            )
+            snapshot = os.readlink(metadata_dir)
+
+            del registry["data"][1:]
+            call_command("update_idps", "--force", stdout=out, stderr=io.StringIO())
+            self.assertNotEqual(os.readlink(metadata_dir), snapshot)
+            call_command("update_idps", "--force", stdout=out, stderr=io.StringIO())
+            self.assertEqual(len(os.listdir(parent_dir)), 3)  # link and 2 snapshots
+
+    def test_update_idps_partial_failure(self):
+        def metadata(n, comment=""):
+            return IDP_METADATA_TEMPLATE.format(
+                entity_id=f"https://idp{n}.example.org", cert=""
+            ).replace("</md:EntityDescriptor>", f"<!--{comment}--></md:EntityDescriptor>")
+
+        idps = {
+            "https://idp1.example.org/metadata.xml": metadata(1, "new"),
+            "https://idp2.example.org/metadata.xml": "<md:EntityDescriptor/>",
+            "https://idp3.example.org/metadata.xml": "<md:EntityDescriptor/>",
+        }
+        registry, requested, mock_get = self.mock_idps_registry(idps)
+
+        # A plain directory, that is replaced by a link to a snapshot, and
+        # a link to the active snapshot
+        for link in (False, True):
+            parent_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, parent_dir)
+            metadata_dir = os.path.join(parent_dir, "metadata")
+            os.mkdir(os.path.join(parent_dir, "previous"))
+            for n in (1, 2):
+                with open(os.path.join(parent_dir, "previous", f"idp_{n}.xml"), "w") as fp:
+                    fp.write(metadata(n, "old"))
+            if link:
+                os.symlink("previous", metadata_dir)
+            else:
+                os.rename(os.path.join(parent_dir, "previous"), metadata_dir)
+
+            out = io.StringIO()
+            with override_settings(SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir), \
+                    mock_get:
+                with self.assertRaisesRegex(CommandError, "2 IdPs: IdP 2, IdP 3"):
+                    call_command("update_idps", stdout=out, stderr=io.StringIO())
+
+            # The failed IdPs keep their previous files, if any
+            self.assertEqual(
+                sorted(x for x in os.listdir(metadata_dir) if x.endswith(".xml")),
+                ["idp_1.xml", "idp_2.xml"],
+            )
+            for n, comment in ((1, "new"), (2, "old")):
+                with open(os.path.join(metadata_dir, f"idp_{n}.xml")) as fp:
+                    self.assertEqual(fp.read(), metadata(n, comment))
+            self.assertTrue(os.path.islink(metadata_dir))
+            self.assertEqual(len(os.listdir(parent_dir)), 3)  # link and 2 snapshots
+
+    def test_update_idps_in_place(self):
+        from .management.commands import update_idps
+
+        idps = {
+            "https://idp1.example.org/metadata.xml": IDP_METADATA_TEMPLATE.format(
+                entity_id="https://idp1.example.org", cert=""
+            ),
+        }
+        registry, requested, mock_get = self.mock_idps_registry(idps)
+
+        # A plain directory that cannot be moved is updated file by file
+        parent_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent_dir)
+        metadata_dir = os.path.join(parent_dir, "metadata")
+        os.mkdir(metadata_dir)
+        err = io.StringIO()
+        with override_settings(SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir), \
+                mock_get, patch.object(update_idps.os, "rename", side_effect=OSError("busy")):
+            call_command("update_idps", stdout=io.StringIO(), stderr=err)
+
+        self.assertIn("the metadata files are updated one by one", err.getvalue())
+        self.assertFalse(os.path.islink(metadata_dir))
+        self.assertEqual(os.listdir(parent_dir), ["metadata"])
+        self.assertEqual(
+            sorted(os.listdir(metadata_dir)),
+            [".metadata_snapshot.json", ".update_idps.json", "idp_1.xml"],
+        )
+
+    def test_update_idps_daemon(self):
+        from .management.commands import update_idps
+
+        idps = {
+            "https://idp1.example.org/metadata.xml": IDP_METADATA_TEMPLATE.format(
+                entity_id="https://idp1.example.org", cert=""
+            ).replace("entityID=", 'cacheDuration="PT120S" entityID='),
+        }
+        registry, requested, mock_get = self.mock_idps_registry(idps)
+        registry["data"].append({
+            "ipa_entity_code": "idp_2",
+            "entity_name": "IdP 2",
+            "metadata_url": "https://down.example.org/metadata.xml",
+        })
+
+        parent_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent_dir)
+        metadata_dir = os.path.join(parent_dir, "metadata")
+        stamp_file = os.path.join(parent_dir, "stamp")
+        delays = []
+        stamps = []
+
+        class Event(threading.Event):
+            def wait(self, timeout=None):
+                delays.append(timeout)
+                stamps.append(os.stat(stamp_file).st_ino)
+                del registry["data"][1:]  # the failing IdP is removed
+                if len(delays) == 2:
+                    self.set()
+
+        with override_settings(
+            SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir,
+            SPID_IDENTITY_PROVIDERS_METADATA_STAMP=stamp_file,
+        ), mock_get, patch.object(update_idps, "threading", unittest.mock.Mock(Event=Event)):
+            call_command(
+                "update_idps", "--daemon", "--jitter", "0",
+                stdout=io.StringIO(), stderr=io.StringIO(),
+            )
+
+        # A retry after the failure, then the cacheDuration of the metadata
+        self.assertEqual(delays, [60, 120])
+        # The workers are notified only when the metadata change
+        self.assertEqual(stamps[0], stamps[1])
+        with open(stamp_file) as fp:
+            self.assertEqual(json.load(fp)["identity_providers"], ["IdP 1"])
+
+        with open(os.path.join(metadata_dir, ".update_idps.status.json")) as fp:
+            status = json.load(fp)
+        self.assertEqual(status["failures"], 1)
+        self.assertEqual(status["successes"], 1)
+        self.assertEqual(status["consecutive_failures"], 0)
+        self.assertGreater(status["last_success"], status["last_failure"])
+
+    @unittest.skipIf(xmlsec is None, "python xmlsec package is not installed")
+    def test_update_idps_signature(self):
+        from lxml import etree
+
+        root = etree.fromstring(
+            IDP_METADATA_TEMPLATE.format(entity_id="https://idp1.example.org", cert="").encode()
+        )
+        root.set("ID", "_metadata")
+        signature_node = xmlsec.template.create(
+            root, xmlsec.constants.TransformExclC14N, xmlsec.constants.TransformRsaSha256
+        )
+        root.insert(0, signature_node)
+        ref = xmlsec.template.add_reference(
+            signature_node, xmlsec.constants.TransformSha256, uri="#_metadata"
+        )
+        xmlsec.template.add_transform(ref, xmlsec.constants.TransformEnveloped)
+        xmlsec.template.add_transform(ref, xmlsec.constants.TransformExclC14N)
+        ctx = xmlsec.SignatureContext()
+        ctx.key = xmlsec.Key.from_file(
+            settings.SPID_PRIVATE_KEY, xmlsec.constants.KeyDataFormatPem
+        )
+        xmlsec.tree.add_ids(root, ["ID"])
+        ctx.sign(signature_node)
+        signed = etree.tostring(root).decode()
+
+        # Signature wrapping: the signed document and an unsigned IdP are
+        # moved into a new document, that carries a copy of the signature
+        md = "{urn:oasis:names:tc:SAML:2.0:metadata}"
+        wrapper = etree.Element(f"{md}EntitiesDescriptor", ID="_wrapper")
+        wrapper.append(copy.deepcopy(signature_node))
+        wrapper.append(etree.fromstring(signed))
+        wrapper.append(etree.fromstring(
+            IDP_METADATA_TEMPLATE.format(entity_id="https://idp4.example.org", cert="").encode()
+        ))
+        wrapped = etree.tostring(wrapper).decode()
+
+        idps = {
+            "https://idp1.example.org/metadata.xml": signed,
+            "https://idp2.example.org/metadata.xml": signed.replace("/sso", "/evil"),
+            "https://idp3.example.org/metadata.xml": IDP_METADATA_TEMPLATE.format(
+                entity_id="https://idp3.example.org", cert=""
+            ),
+            "https://idp4.example.org/metadata.xml": wrapped,
+        }
+        registry, requested, mock_get = self.mock_idps_registry(idps)
+
+        parent_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent_dir)
+        metadata_dir = os.path.join(parent_dir, "metadata")
+        err = io.StringIO()
+        with override_settings(
+            SPID_IDENTITY_PROVIDERS_METADATA_DIR=metadata_dir,
+            SPID_IDENTITY_PROVIDERS_METADATA_CERT=settings.SPID_PUBLIC_CERT,
+            SPID_CRYPTO_BACKEND="python-xmlsec",
+        ), mock_get:
+            with self.assertRaisesRegex(CommandError, "IdP 2, IdP 3, IdP 4"):
+                call_command("update_idps", stdout=io.StringIO(), stderr=err)
+
+        self.assertEqual(
+            sorted(os.listdir(metadata_dir)),
+            [".metadata_snapshot.json", ".update_idps.json", "idp_1.xml"],
+        )
+        self.assertIn("IdP IdP 2 from https://idp2.example.org/metadata.xml: "
+                      "invalid signature", err.getvalue())
+        self.assertIn("unsigned metadata", err.getvalue())
+        self.assertIn("IdP IdP 4 from https://idp4.example.org/metadata.xml: "
+                      "invalid signature: The signature reference '#_metadata' "
+                      "doesn't point to the ID of the signed EntitiesDescriptor",
+                      err.getvalue())
+
+    @patch("djangosaml2_spid.management.commands.render_sp_metadata.italian_sp_metadata")
+    def test_render_sp_metadata_command(self, mock_metadata):
+        mock_metadata.side_effect = lambda conf, md_type: f"<{md_type}>{conf.entityid}</{md_type}>"
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+
+        out = io.StringIO()
+        call_command(
+            "render_sp_metadata",
+            base_url=["http://testserver/", "https://sp.example.org:8443/sp/"],
+            output_dir=output_dir,
+            stdout=out,
+        )
+        self.assertIn("Successfully rendered all SP metadata files", out.getvalue())
+        self.assertEqual(mock_metadata.call_count, 4)
+
+        with open(os.path.join(output_dir, "testserver", "spid.xml")) as fp:
+            self.assertEqual(fp.read(), "<spid>http://testserver/spid/metadata/</spid>")
+        self.assertTrue(
+            os.path.isfile(os.path.join(output_dir, "sp.example.org_8443", "sp", "cie.xml"))
+        )
+
+        # The metadata views serve the pre-rendered files
+        with override_settings(SPID_METADATA_STATIC_DIR=output_dir, SPID_BASE_URL=None):
+            with patch("djangosaml2_spid.views.italian_sp_metadata") as mock_view_metadata:
+                res = Client().get(reverse("djangosaml2_spid:cie_metadata"))
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.content, b"<cie>http://testserver/spid/metadata/</cie>")
+
+                res = Client().get(
+                    reverse("djangosaml2_spid:cie_metadata"), HTTP_IF_NONE_MATCH=res["ETag"]
+                )
+                self.assertEqual(res.status_code, 304)
+            mock_view_metadata.assert_not_called()
+
+        with override_settings(SPID_BASE_URL=None), self.assertRaises(CommandError):
+            call_command("render_sp_metadata", output_dir=output_dir, stdout=out)
+        with self.assertRaisesRegex(CommandError, "Invalid host"):
+            call_command(
+                "render_sp_metadata", base_url=["http://../"], output_dir=output_dir
+            )
+
+        # Hosts that are not valid directory names don't escape the directory
+        for base_url in ("http://../", "http://./sp/", "file:///etc/", "http://a\\b/"):
+            with self.assertRaises(ValueError):
+                sp_metadata_static_path(base_url, "spid", output_dir)
+        with open(os.path.join(output_dir, "spid.xml"), "w") as fp:
+            fp.write("<spid/>")
+        with override_settings(
+            SPID_METADATA_STATIC_DIR=os.path.join(output_dir, "testserver"),
+            ALLOWED_HOSTS=["*"],
+        ), patch("djangosaml2_spid.views.italian_sp_metadata") as mock_view_metadata:
+            mock_view_metadata.return_value = "<md:EntityDescriptor/>"
+            res = Client().get(reverse("djangosaml2_spid:spid_metadata"), HTTP_HOST="..")
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.content, b"<md:EntityDescriptor/>")
+
 
 class TestSpid(TestCase):
     def setUp(self):
@@ -391,6 +1776,90 @@ class TestSpid(TestCase):
             metadata_xml.find(".//spid:FiscalCode", namespaces).text, "XYZABCAAMGGJ000W"
         )
 
+    @patch("djangosaml2_spid.views.italian_sp_metadata")
+    def test_metadata_endpoint_cache(self, mock_metadata):
+        mock_metadata.return_value = "<md:EntityDescriptor/>"
+        clear_metadata_cache()
+        self.addCleanup(clear_metadata_cache)
+        url = reverse("djangosaml2_spid:spid_metadata")
+        client = Client()
+
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, b"<md:EntityDescriptor/>")
+        self.assertTrue(res["ETag"].startswith('W/"'))
+        self.assertIn("Last-Modified", res)
+        self.assertIn("max-age=3600", res["Cache-Control"])
+
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(mock_metadata.call_count, 1)
+        etag = res["ETag"]
+
+        # Conditional requests don't build the metadata
+        res = client.get(url, HTTP_IF_MODIFIED_SINCE=res["Last-Modified"])
+        self.assertEqual(res.status_code, 304)
+        mock_metadata.reset_mock()
+        clear_metadata_cache()
+        res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res["ETag"], etag)
+        mock_metadata.assert_not_called()
+
+        # The settings of the document change the validators
+        contacts = [dict(settings.SPID_CONTACTS[0], email_address="new@example.org")]
+        with override_settings(SPID_CONTACTS=contacts):
+            res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res["ETag"], etag)
+        organization = dict(
+            settings.SAML_CONFIG["organization"], url=[("https://example.org", "it")]
+        )
+        saml_config = dict(settings.SAML_CONFIG, organization=organization)
+        with override_settings(SAML_CONFIG=saml_config):
+            res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res["ETag"], etag)
+        mock_metadata.reset_mock()
+
+        # CIE metadata are cached separately
+        res = client.get(reverse("djangosaml2_spid:cie_metadata"))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(mock_metadata.call_args[1]["md_type"], "cie")
+
+        with override_settings(SPID_METADATA_CACHE=False):
+            client.get(url)
+            client.get(url)
+        self.assertEqual(mock_metadata.call_count, 3)
+
+    @patch("djangosaml2_spid.views.italian_sp_metadata")
+    def test_metadata_validators(self, mock_metadata):
+        from . import spid_metadata
+
+        mock_metadata.return_value = "<md:EntityDescriptor/>"
+        clear_metadata_cache()
+        self.addCleanup(clear_metadata_cache)
+        url = reverse("djangosaml2_spid:spid_metadata")
+        client = Client()
+        etag = client.get(url)["ETag"]
+
+        # The key files aren't read and the settings aren't serialized again
+        with patch.object(spid_metadata, "open", create=True) as mock_open, \
+                patch.object(spid_metadata, "json") as mock_json:
+            res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        mock_open.assert_not_called()
+        mock_json.dumps.assert_not_called()
+
+        # A key file is hashed again when it changes
+        key_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, key_dir)
+        path = os.path.join(key_dir, "key.pem")
+        pathlib.Path(path).write_bytes(b"key 1")
+        digest, _ = spid_metadata._file_digest(path)
+        pathlib.Path(path).write_bytes(b"new key")
+        self.assertNotEqual(spid_metadata._file_digest(path)[0], digest)
+
     @override_settings(SAML2_DEFAULT_BINDING=BINDING_HTTP_POST)
     def test_authnreq_post(self):
         url = reverse("djangosaml2_spid:spid_login")
@@ -409,6 +1878,33 @@ class TestSpid(TestCase):
         self.assertTrue(lines[1].startswith("<samlp:AuthnRequest "))
         self.assertEqual(lines[-2], "</samlp:AuthnRequest>")
 
+    @unittest.skipIf(xmlsec is None, "python xmlsec package is not installed")
+    @override_settings(
+        SAML2_DEFAULT_BINDING=BINDING_HTTP_POST, SPID_CRYPTO_BACKEND="python-xmlsec"
+    )
+    def test_authnreq_post_python_xmlsec(self):
+        from lxml import etree
+
+        url = reverse("djangosaml2_spid:spid_login")
+        client = Client()
+        res = client.get(f"{url}?idp=https://localhost:8080")
+        self.assertEqual(res.status_code, 200)
+
+        html_form = res.content.decode()
+        authn_req = base64.b64decode(saml_request_from_html_form(html_form))
+
+        root = etree.fromstring(authn_req)
+        self.assertEqual(root.tag, "{urn:oasis:names:tc:SAML:2.0:protocol}AuthnRequest")
+        xmlsec.tree.add_ids(root, ["ID"])
+        signature_node = xmlsec.tree.find_child(root, "Signature", xmlsec.constants.DSigNs)
+        self.assertIsNotNone(signature_node)
+
+        ctx = xmlsec.SignatureContext()
+        ctx.key = xmlsec.Key.from_file(
+            settings.SPID_PUBLIC_CERT, xmlsec.constants.KeyDataFormatCertPem
+        )
+        ctx.verify(signature_node)  # raises xmlsec.VerificationError if invalid
+
     def test_authnreq_already_logged_user(self):
         url = reverse("djangosaml2_spid:index")
         client = Client()
@@ -461,6 +1957,271 @@ class TestSpid(TestCase):
             b"sure you have logged in via SAML?",
         )
 
+    @override_settings(SPID_SAML_RESPONSE_MAX_SIZE=1000)
+    def test_acs_max_size(self):
+        url = reverse("djangosaml2_spid:saml2_acs")
+        saml_response = base64.b64encode(spid_response_xml().encode())
+        with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+            res = Client().post(url, {"SAMLResponse": saml_response})
+        self.assertEqual(res.status_code, 413)
+        self.assertIn("ACS request body too large", ctx.output[0])
+
+    @override_settings(SPID_VALIDATION_REPORT_SAMPLE_RATE=1.0)
+    def test_acs_validation_report(self):
+        def authn_response(xml):
+            response = saml2.samlp.response_from_string(xml)
+            issuer = response.issuer.text if response.issuer else ""
+            return unittest.mock.Mock(
+                response=response,
+                xmlstr="",
+                return_addrs=["http://testserver/spid/acs/"],
+                assertion=response.assertion[0],
+                issuer=lambda: issuer,
+            )
+
+        view = views.AssertionConsumerServiceView()
+        view.request = RequestFactory().post(reverse("djangosaml2_spid:saml2_acs"))
+        view.request.saml_session = SessionStore()
+        OutstandingQueriesCache(view.request.saml_session).set("_request", "/")
+        caches["default"].clear()
+
+        # A failure of the shadow validation doesn't change the outcome
+        with patch.object(Saml2ResponseValidator, "validate", side_effect=RuntimeError):
+            with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+                response = authn_response(spid_response_xml())
+                self.assertIsNone(view.validate_response(response))
+        self.assertIn("SPID validation report failed", ctx.output[0])
+
+        # A response without Issuer is reported and rejected by the validator
+        xml = spid_response_xml().replace(
+            '<saml:Issuer Format="urn:oasis:names:tc:SAML:2.0:nameid-format:entity">'
+            "https://localhost:8080</saml:Issuer>\n  <samlp:Status>",
+            "<samlp:Status>",
+        )
+        with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+            with self.assertRaises(SpidValidationError) as err:
+                view.validate_response(authn_response(xml))
+        self.assertEqual(err.exception.check, "validate_issuer")
+        self.assertTrue(ctx.output[0].startswith(
+            "WARNING:djangosaml2:SPID validation report for '': "
+        ))
+
+
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        self.user = TestSpid.create_user()
+        self.factory = AsyncRequestFactory()
+
+    def get_request(self, path, method="get", user=None, **kwargs):
+        request = getattr(self.factory, method)(path, **kwargs)
+        request.session = SessionStore()
+        request.saml_session = SessionStore()
+        request.user = user or AnonymousUser()
+        return request
+
+    async def test_executor(self):
+        thread_name = await run_in_executor(lambda: threading.current_thread().name)
+        self.assertTrue(thread_name.startswith("spid-executor"))
+
+        with override_settings(SPID_EXECUTOR_MAX_WORKERS=2):
+            self.assertEqual(get_executor()._max_workers, 2)
+            self.assertEqual(await run_in_executor(max, 1, 2), 2)
+        self.assertNotEqual(get_executor()._max_workers, 2)
+
+        # The database connections of the workers are handled as in a request
+        with patch("djangosaml2_spid.executor.close_old_connections") as mock_close:
+            with self.assertRaises(ZeroDivisionError):
+                await run_in_executor(lambda: 1 / 0)
+        self.assertEqual(mock_close.call_count, 2)
+
+    @unittest.skipIf(xmlsec is None, "python xmlsec package is not installed")
+    @override_settings(
+        SAML2_DEFAULT_BINDING=BINDING_HTTP_POST, SPID_CRYPTO_BACKEND="python-xmlsec"
+    )
+    async def test_login(self):
+        url = reverse("djangosaml2_spid:spid_login")
+        request = self.get_request(f"{url}?idp=https://localhost:8080")
+        res = await views.async_spid_login(request)
+        self.assertEqual(res.status_code, 200)
+
+        authn_req = base64.b64decode(saml_request_from_html_form(res.content.decode()))
+        self.assertIn(b"<samlp:AuthnRequest ", authn_req)
+        outstanding_queries = OutstandingQueriesCache(request.saml_session)
+        self.assertEqual(len(outstanding_queries.outstanding_queries()), 1)
+
+        request = self.get_request(f"{url}?next=/foo/", user=self.user)
+        res = await views.async_spid_login(request)
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res["Location"], "/foo/")
+
+    async def test_logout(self):
+        url = reverse("djangosaml2_spid:spid_logout")
+        res = await views.async_spid_logout(self.get_request(url))
+        self.assertEqual(res.status_code, 302)
+
+        request = self.get_request(url, user=self.user)
+        with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+            res = await views.async_spid_logout(request)
+        self.assertEqual(res.status_code, 400)
+        self.assertIsInstance(request.user, AnonymousUser)
+        self.assertIn(
+            "ERROR:djangosaml2:Looks like the user None is not logged in any IdP/AA",
+            ctx.output,
+        )
+
+    @patch("djangosaml2_spid.views.italian_sp_metadata")
+    async def test_metadata(self, mock_metadata):
+        mock_metadata.return_value = "<md:EntityDescriptor/>"
+        clear_metadata_cache()
+        self.addCleanup(clear_metadata_cache)
+
+        view = views.AsyncMetadataSpidView.as_view()
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+
+        url = reverse("djangosaml2_spid:spid_metadata")
+        res = await view(self.get_request(url))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, b"<md:EntityDescriptor/>")
+
+        request = self.get_request(url)
+        request.META["HTTP_IF_NONE_MATCH"] = res["ETag"]
+        res = await view(request)
+        self.assertEqual(res.status_code, 304)
+
+        res = await view(self.get_request(url, method="post"))
+        self.assertEqual(res.status_code, 405)
+
+    async def test_acs(self):
+        view = views.AsyncAssertionConsumerServiceView.as_view()
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+
+        url = reverse("djangosaml2_spid:saml2_acs")
+        request = self.get_request(
+            url, method="post", content_type="application/x-www-form-urlencoded"
+        )
+        res = await view(request)
+        self.assertEqual(res.status_code, 400)
+
+        request = self.get_request(
+            url,
+            method="post",
+            data="SAMLResponse=foo",
+            content_type="application/x-www-form-urlencoded",
+        )
+        with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+            res = await view(request)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            ctx.output,
+            [
+                "WARNING:djangosaml2:SAMLResponse rejected: "
+                "SAMLResponse is not valid base64: Incorrect padding"
+            ],
+        )
+
+        request = self.get_request(
+            url,
+            method="post",
+            data=urlencode({"SAMLResponse": base64.b64encode(b"<foo/>")}),
+            content_type="application/x-www-form-urlencoded",
+        )
+        phases = []
+
+        def receiver(sender, phase, duration, idp, **kwargs):
+            phases.append((sender, phase))
+
+        phase_timed.connect(receiver)
+        self.addCleanup(phase_timed.disconnect, receiver)
+        with self.assertLogs("djangosaml2", level="WARNING") as ctx:
+            res = await view(request)
+        self.assertEqual(res.status_code, 403)
+        self.assertTrue(ctx.output[0].startswith("ERROR:djangosaml2:SAMLResponse Error"))
+        self.assertIn("Exception: Unknown response type", ctx.output[0])
+        self.assertIsInstance(request.user, AnonymousUser)
+        self.assertEqual(phases, [("acs", "config_load"), ("acs", "total")])
+
+    async def test_acs_exceptions(self):
+        from saml2.response import StatusRequestDenied
+        from saml2.validate import ResponseLifetimeExceed
+
+        view = views.AsyncAssertionConsumerServiceView.as_view()
+        url = reverse("djangosaml2_spid:saml2_acs")
+
+        # The errors of the responses are logged as the sync view does
+        for exception, message in (
+            (ResponseLifetimeExceed("expired"), "INFO:djangosaml2:SAML Assertion is no longer valid"),
+            (StatusRequestDenied("denied"), "ERROR:djangosaml2:Error processing SAML Assertion."),
+            (CryptoPoolBusy("busy"), "WARNING:djangosaml2:SAMLResponse Error: busy"),
+        ):
+            request = self.get_request(
+                url,
+                method="post",
+                data=urlencode({"SAMLResponse": base64.b64encode(b"<foo/>")}),
+                content_type="application/x-www-form-urlencoded",
+            )
+            with patch("saml2.client.Saml2Client.parse_authn_request_response",
+                       side_effect=exception), \
+                    self.assertLogs("djangosaml2", level="INFO") as ctx:
+                res = await view(request)
+            self.assertEqual(res.status_code, 503 if isinstance(exception, CryptoPoolBusy) else 403)
+            self.assertTrue(any(x.startswith(message) for x in ctx.output), ctx.output)
+
+        # Programming errors are not handled as invalid responses
+        request = self.get_request(
+            url,
+            method="post",
+            data=urlencode({"SAMLResponse": base64.b64encode(b"<foo/>")}),
+            content_type="application/x-www-form-urlencoded",
+        )
+        with patch("saml2.client.Saml2Client.parse_authn_request_response",
+                   side_effect=TypeError("bug")):
+            with self.assertRaisesRegex(TypeError, "bug"):
+                await view(request)
+
+    async def test_acs_stats(self):
+        flushed = []
+
+        def receiver(sender, stats, **kwargs):
+            flushed.append(stats)
+
+        idp_stats.flush()
+        idp_stats_flushed.connect(receiver)
+        self.addCleanup(idp_stats_flushed.disconnect, receiver)
+
+        url = reverse("djangosaml2_spid:saml2_acs")
+        saml_response = (
+            '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+            'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_1" '
+            'Version="2.0" IssueInstant="%s" InResponseTo="id-1" '
+            'Destination="http://localhost:8000/spid/acs/">'
+            "<saml:Issuer>https://localhost:8080</saml:Issuer>"
+            '<samlp:Status><samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:'
+            'status:Responder"><samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:'
+            'status:AuthnFailed"/></samlp:StatusCode>'
+            "<samlp:StatusMessage>ErrorCode nr19</samlp:StatusMessage></samlp:Status>"
+            "</samlp:Response>"
+        ) % instant()
+        request = self.get_request(
+            url,
+            method="post",
+            data=urlencode({"SAMLResponse": base64.b64encode(saml_response.encode())}),
+            content_type="application/x-www-form-urlencoded",
+        )
+        OutstandingQueriesCache(request.saml_session).set("id-1", "/")
+        record_authn_request(request.saml_session, "id-1", "https://localhost:8080")
+
+        with self.assertLogs("djangosaml2", level="INFO"):
+            res = await views.AsyncAssertionConsumerServiceView.as_view()(request)
+        # The unsigned response is rejected, the request is matched anyway
+        self.assertEqual(res.status_code, 403)
+        idp_stats.flush()
+        stats = flushed[0]["https://localhost:8080"]
+        self.assertEqual(stats["responses"], 1)
+        self.assertEqual(stats["round_trips"], 1)
+        self.assertGreaterEqual(stats["round_trip_max"], 0.0)
+        self.assertEqual(stats["errors"], {"SignatureError": 1})
+        self.assertEqual(AuthnRequestsCache(request.saml_session), {})
+
 
 class TestSaml2Patches(unittest.TestCase):
 
@@ -497,3 +2258,25 @@ class TestSaml2Patches(unittest.TestCase):
     def test_patch_response_verify(self):
         from saml2.response import StatusResponse
         self.assertEqual(StatusResponse._verify.__module__, 'djangosaml2_spid._saml2')
+
+    def test_patch_issue_instant_ok(self):
+        from saml2.response import StatusResponse
+        self.assertEqual(StatusResponse.issue_instant_ok.__module__, 'djangosaml2_spid._saml2')
+
+        response = unittest.mock.Mock(timeslack=0)
+        now = datetime.datetime.utcnow()
+        response.response.issue_instant = now.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+        self.assertTrue(StatusResponse.issue_instant_ok(response))
+        response.response.issue_instant = (now - datetime.timedelta(days=2)).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+        self.assertFalse(StatusResponse.issue_instant_ok(response))
+
+    def test_add_python_xmlsec_backend(self):
+        import saml2.entity
+        import saml2.response
+        import saml2.sigver
+
+        self.assertEqual(saml2.sigver.security_context.__module__, 'djangosaml2_spid._saml2')
+        self.assertIs(saml2.entity.security_context, saml2.sigver.security_context)
+        self.assertIs(saml2.response.security_context, saml2.sigver.security_context)
@@ -6,6 +6,19 @@ from . import views
 
 SPID_URLS_PREFIX = settings.SPID_URLS_PREFIX
 
+if settings.SPID_ASYNC_VIEWS:
+    spid_login = views.async_spid_login
+    spid_logout = views.async_spid_logout
+    MetadataSpidView = views.AsyncMetadataSpidView
+    MetadataCieView = views.AsyncMetadataCieView
+    AssertionConsumerServiceView = views.AsyncAssertionConsumerServiceView
+else:
+    spid_login = views.spid_login
+    spid_logout = views.spid_logout
+    MetadataSpidView = views.MetadataSpidView
+    MetadataCieView = views.MetadataCieView
+    AssertionConsumerServiceView = views.AssertionConsumerServiceView
+
 urlpatterns = [
     path(f"{SPID_URLS_PREFIX}", views.index, name="index"),
     path(
@@ -13,17 +26,17 @@ urlpatterns = [
         views.EchoAttributesView.as_view(),
         name="spid_echo_attributes",
     ),
-    path(f"{SPID_URLS_PREFIX}/login/", views.spid_login, name="spid_login"),
-    path(f"{SPID_URLS_PREFIX}/logout/", views.spid_logout, name="spid_logout"),
+    path(f"{SPID_URLS_PREFIX}/login/", spid_login, name="spid_login"),
+    path(f"{SPID_URLS_PREFIX}/logout/", spid_logout, name="spid_logout"),
     path(
         settings.SPID_METADATA_URL_PATH,
-        views.MetadataSpidView.as_view(), name="spid_metadata"),
+        MetadataSpidView.as_view(), name="spid_metadata"),
     path(
         settings.CIE_METADATA_URL_PATH,
-        views.MetadataCieView.as_view(), name="cie_metadata"),
+        MetadataCieView.as_view(), name="cie_metadata"),
     path(
         settings.SPID_ACS_URL_PATH,
-        views.AssertionConsumerServiceView.as_view(),
+        AssertionConsumerServiceView.as_view(),
         name="saml2_acs",
     ),
     path(settings.SPID_SLO_URL_PATH, views.LogoutView.as_view(), name="saml2_ls"),
@@ -1,10 +1,79 @@
+import os
 import re
 import base64
+import binascii
+import datetime
+import tempfile
 import xml.dom.minidom
 import zlib
 
+from xml.parsers import expat
 from xml.parsers.expat import ExpatError
 
+from django.core.exceptions import SuspiciousOperation
+
+
+# Size of the base64 chunks decoded by check_saml_response(), a multiple of 4
+SAML_RESPONSE_CHUNK_SIZE = 16384
+
+XS_DATETIME_REGEXP = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?"
+)
+
+
+def parse_xs_datetime(value):
+    """
+    Parses a SAML xs:dateTime value into an aware UTC datetime, with fractional
+    seconds (truncated to microseconds) and timezone offsets. Values without a
+    timezone are assumed to be UTC. Raises `ValueError` if the value is malformed.
+    """
+    match = XS_DATETIME_REGEXP.fullmatch(value.strip()) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError(f"Invalid xs:dateTime value: {value!r}")
+
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    microsecond = int(fraction[:6].ljust(6, "0")) if fraction else 0
+
+    if hour == "24" and minute == second == "00" and not microsecond:
+        # 24:00:00 is the midnight at the end of the day
+        hour, days = 0, 1
+    else:
+        hour, days = int(hour), 0
+
+    try:
+        dt = datetime.datetime(
+            int(year), int(month), int(day), hour, int(minute), int(second),
+            microsecond, tzinfo=datetime.timezone.utc,
+        )
+    except ValueError:
+        raise ValueError(f"Invalid xs:dateTime value: {value!r}") from None
+
+    if days:
+        dt += datetime.timedelta(days=days)
+    if tz and tz != "Z":
+        offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[4:6]))
+        dt = dt - offset if tz[0] == "+" else dt + offset
+    return dt
+
+
+def write_file_atomic(path, content, mode=0o644):
+    """
+    Writes bytes to a temporary file and renames it to *path*, so that
+    a reader never sees a partially written file. The temporary file is
+    hidden, so it's skipped by the scans of the IdPs metadata directory.
+    """
+    dirname, basename = os.path.split(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=f".{basename}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 
 def repr_saml_request(saml_str, b64=False):
     """Decode SAML request from b64 and b64 deflated
@@ -36,3 +105,77 @@ def saml_request_from_html_form(html_str):
         raise ValueError("AuthnRequest not found in htmlform")
 
     return authn_request[0]
+
+
+class UnsafeSamlResponse(SuspiciousOperation):
+    """A SAMLResponse rejected before parsing, with the HTTP status to return."""
+
+    status = 400
+
+
+class SamlResponseTooLarge(UnsafeSamlResponse):
+    status = 413
+
+
+def check_saml_response(
+    saml_response, max_size=None, max_depth=None, max_attributes=None
+):
+    """
+    Pre-scans a base64 encoded SAMLResponse before the object model is built:
+    the base64 is decoded incrementally and fed to a streaming expat parser,
+    that rejects DTDs (and so the entity declarations), the elements nested
+    deeper than *max_depth* and the elements with more than *max_attributes*
+    attributes. Raises `UnsafeSamlResponse` if the SAMLResponse is rejected.
+
+    Returns the Issuer and the InResponseTo of the response, as found by the
+    scan (`None` if missing), that are not verified and are only suitable
+    for the statistics of the failed responses.
+    """
+    if max_size and len(saml_response) > max_size:
+        raise SamlResponseTooLarge(f"SAMLResponse too large: {len(saml_response)} bytes")
+
+    depth = 0
+    in_response_to = None
+    issuer = None  # list of the text chunks of the Issuer of the response
+
+    def start_element(name, attrs):
+        nonlocal depth, in_response_to, issuer
+        depth += 1
+        if max_depth and depth > max_depth:
+            raise UnsafeSamlResponse(f"SAMLResponse nested deeper than {max_depth}")
+        if max_attributes and len(attrs) > max_attributes:
+            raise UnsafeSamlResponse(
+                f"SAMLResponse element {name} with {len(attrs)} attributes"
+            )
+        if depth == 1:
+            in_response_to = attrs.get("InResponseTo")
+        elif depth == 2 and issuer is None and name.rpartition(":")[2] == "Issuer":
+            issuer = []
+            parser.CharacterDataHandler = issuer.append
+
+    def end_element(name):
+        nonlocal depth
+        depth -= 1
+        parser.CharacterDataHandler = None
+
+    def start_doctype(*args):
+        raise UnsafeSamlResponse("SAMLResponse with a DTD")
+
+    parser = expat.ParserCreate()
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.StartDoctypeDeclHandler = start_doctype
+    parser.EntityDeclHandler = start_doctype
+
+    data = re.sub(r"\s+", "", saml_response)
+    try:
+        for start in range(0, len(data), SAML_RESPONSE_CHUNK_SIZE):
+            chunk = data[start:start + SAML_RESPONSE_CHUNK_SIZE]
+            parser.Parse(base64.b64decode(chunk, validate=True), False)
+        parser.Parse(b"", True)
+    except binascii.Error as err:
+        raise UnsafeSamlResponse(f"SAMLResponse is not valid base64: {err}") from None
+    except ExpatError as err:
+        raise UnsafeSamlResponse(f"SAMLResponse is not valid XML: {err}") from None
+    return ("".join(issuer).strip() if issuer else None), in_response_to
@@ -1,6 +1,8 @@
+from asgiref.sync import sync_to_async
 from django.contrib import auth
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
 from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -8,32 +10,71 @@ from django.http import (
     HttpResponseRedirect,
 )
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from djangosaml2.cache import IdentityCache, OutstandingQueriesCache
 from djangosaml2.cache import StateCache
-from djangosaml2.overrides import Saml2Client
 from djangosaml2.utils import (
     available_idps,
+    get_custom_setting,
+    get_fallback_login_redirect_url,
     get_idp_sso_supported_bindings,
     validate_referral_url,
 )
 from saml2 import BINDING_HTTP_REDIRECT, BINDING_HTTP_POST
 from saml2.mdstore import UnknownSystemEntity
+from saml2.response import (
+    RequestVersionTooLow,
+    SignatureError,
+    StatusAuthnFailed,
+    StatusError,
+    StatusNoAuthnContext,
+    StatusRequestDenied,
+    UnsolicitedResponse,
+)
 from saml2.s_utils import UnsupportedBinding
+from saml2.sigver import MissingKey
+from saml2.validate import ResponseLifetimeExceed, ToEarly
 from djangosaml2.conf import get_config
 import djangosaml2.views as djangosaml2_views
+import asyncio
+import functools
 import logging
+import os
+import random
+import time
 
 import saml2
 import saml2.samlp
 import saml2.saml
 import saml2.time_util
 
-from .conf import settings
+from .conf import settings, get_base_url
+from .executor import CryptoPoolBusy, run_in_executor
 from .spid_errors import SpidError
-from .spid_metadata import italian_sp_metadata
-from .spid_request import spid_sp_authn_request, SAML2_DEFAULT_BINDING
-from .spid_validator import Saml2ResponseValidator
-from .utils import repr_saml_request
+from .spid_logging import log_saml_message
+from .spid_metrics import (
+    add_phase,
+    metrics_enabled,
+    record_authn_request,
+    record_error,
+    record_response,
+    record_validation_failure,
+    set_idp,
+    timed,
+    trace_flow,
+)
+from .spid_mdstore import SpidMetadataStore
+from .spid_metadata import (
+    cached_sp_metadata,
+    italian_sp_metadata,
+    sp_metadata_static_path,
+    sp_metadata_validators,
+)
+from .spid_replay import check_assertion_replay
+from .spid_request import get_saml2_client, spid_sp_authn_request, SAML2_DEFAULT_BINDING
+from .spid_validator import Saml2ResponseValidator, SpidValidationError
+from .utils import SamlResponseTooLarge, UnsafeSamlResponse, check_saml_response
 
 logger = logging.getLogger("djangosaml2")
 
@@ -58,20 +99,16 @@ def index(request):
         return HttpResponse(f"LOGGED OUT: <a href={settings.LOGIN_URL}>LOGIN</a>")
 
 
-def spid_login(
-    request,
-    config_loader_path=None,
-    wayf_template="wayf.html",
-    authorization_error_template="djangosaml2/auth_error.html",
-):
-    """SAML Authorization Request initiator
-
-    This view initiates the SAML2 Authorization handshake
-    using the pysaml2 library to create the AuthnRequest.
-    It uses the SAML 2.0 Http POST protocol binding.
+def _load_request_state(request):
     """
-    logger.debug("SPID Login process started")
+    Loads the user and the SAML session of the request, that are lazy
+    and may hit the database. Returns whether the user is authenticated.
+    """
+    request.saml_session.keys()
+    return request.user.is_authenticated
+
 
+def _get_login_next_url(request):
     next_url = request.GET.get("next", settings.LOGIN_REDIRECT_URL)
     if not next_url:
         logger.warning("The next parameter exists but is empty")
@@ -80,29 +117,36 @@ def spid_login(
     # Ensure the user-originating redirection url is safe.
     if not validate_referral_url(request, next_url):
         next_url = settings.LOGIN_REDIRECT_URL
+    return next_url
+
+
+def _login_authenticated_user(request, next_url, authorization_error_template):
+    redirect_authenticated_user = getattr(
+        settings, "SAML_IGNORE_AUTHENTICATED_USERS_ON_LOGIN", True
+    )
+    if redirect_authenticated_user:
+        return HttpResponseRedirect(next_url)
+    else:  # pragma: no cover
+        logger.debug("User is already logged in")
+        return render(request, authorization_error_template, {"came_from": next_url})
 
-    if request.user.is_authenticated:
-        redirect_authenticated_user = getattr(
-            settings, "SAML_IGNORE_AUTHENTICATED_USERS_ON_LOGIN", True
-        )
-        if redirect_authenticated_user:
-            return HttpResponseRedirect(next_url)
-        else:  # pragma: no cover
-            logger.debug("User is already logged in")
-            return render(
-                request, authorization_error_template, {"came_from": next_url}
-            )
 
+def _select_idp(request, conf, next_url, wayf_template):
+    """
+    Returns the entityID of the IdP to use and `None`, or `None`
+    and the response to return if the IdP cannot be selected.
+    """
     # this works only if request came from wayf
     selected_idp = request.GET.get("idp", None)
 
-    conf = get_config(config_loader_path, request)
-
     # is a embedded wayf needed?
-    idps = available_idps(conf)
+    if isinstance(conf.metadata, SpidMetadataStore):
+        idps = conf.metadata.available_idps()
+    else:
+        idps = available_idps(conf)
     if selected_idp is None and len(idps) > 1:
         logger.debug("A discovery process is needed")
-        return render(
+        return None, render(
             request,
             wayf_template,
             {"available_idps": idps.items(), "next_url": next_url},
@@ -114,17 +158,17 @@ def spid_login(
             selected_idp = selected_idp or list(idps.keys())[0]
         except TypeError as e:  # pragma: no cover
             logger.error(f"{_msg}: {e}")
-            return HttpResponseNotFound(_msg)
+            return None, HttpResponseNotFound(_msg)
         except IndexError as e:  # pragma: no cover
             logger.error(f"{_msg}: {e}")
-            return HttpResponseNotFound(_msg)
+            return None, HttpResponseNotFound(_msg)
 
     # ensure our selected binding is supported by the IDP
     logger.debug(f"Trying binding {SAML2_DEFAULT_BINDING} for IDP {selected_idp}")
     supported_bindings = get_idp_sso_supported_bindings(selected_idp, config=conf)
     if not supported_bindings:
         _msg = "IdP Metadata not found or not valid"
-        return HttpResponseNotFound(_msg)
+        return None, HttpResponseNotFound(_msg)
 
     if SAML2_DEFAULT_BINDING not in supported_bindings:
         _msg = (
@@ -136,14 +180,10 @@ def spid_login(
         logger.error(_msg)
         raise UnsupportedBinding(_msg)
 
-    # SPID things here
-    try:
-        login_response = spid_sp_authn_request(conf, selected_idp, next_url)
-    except UnknownSystemEntity as e:  # pragma: no cover
-        _msg = f"Unknown IDP Entity ID: {selected_idp}"
-        logger.error(f"{_msg}: {e}")
-        return HttpResponseNotFound(_msg)
+    return selected_idp, None
+
 
+def _login_response(request, login_response, next_url, idp=None):
     session_id = login_response["session_id"]
     http_response = login_response["http_response"]
 
@@ -151,6 +191,7 @@ def spid_login(
     logger.debug(f"Saving session-id {session_id} in the OutstandingQueries cache")
     oq_cache = OutstandingQueriesCache(request.saml_session)
     oq_cache.set(session_id, next_url)
+    record_authn_request(request.saml_session, session_id, idp)
 
     if SAML2_DEFAULT_BINDING == saml2.BINDING_HTTP_POST:
         return HttpResponse(http_response["data"])
@@ -159,33 +200,118 @@ def spid_login(
         return HttpResponseRedirect(headers["Location"])
 
 
-def spid_logout(request, config_loader_path=None, **kwargs):
-    """SAML Logout Request initiator
+def spid_login(
+    request,
+    config_loader_path=None,
+    wayf_template="wayf.html",
+    authorization_error_template="djangosaml2/auth_error.html",
+):
+    """SAML Authorization Request initiator
 
-    This view initiates the SAML2 Logout request
-    using the pysaml2 library to create the LogoutRequest.
+    This view initiates the SAML2 Authorization handshake
+    using the pysaml2 library to create the AuthnRequest.
+    It uses the SAML 2.0 Http POST protocol binding.
     """
-    if not request.user.is_authenticated:
-        return HttpResponseRedirect(settings.LOGOUT_REDIRECT_URL)
+    logger.debug("SPID Login process started")
+
+    next_url = _get_login_next_url(request)
+    if request.user.is_authenticated:
+        return _login_authenticated_user(
+            request, next_url, authorization_error_template
+        )
+
+    with trace_flow("login"):
+        with timed("config_load"):
+            conf = get_config(config_loader_path, request)
+        with timed("metadata_lookup"):
+            selected_idp, response = _select_idp(request, conf, next_url, wayf_template)
+        if response is not None:
+            return response
+        set_idp(selected_idp)
+
+        # SPID things here
+        try:
+            login_response = spid_sp_authn_request(conf, selected_idp, next_url)
+        except UnknownSystemEntity as e:  # pragma: no cover
+            _msg = f"Unknown IDP Entity ID: {selected_idp}"
+            logger.error(f"{_msg}: {e}")
+            return HttpResponseNotFound(_msg)
+        except CryptoPoolBusy as e:
+            logger.warning(f"SPID Login error: {e}")
+            return HttpResponse(str(e), status=503)
+
+        return _login_response(request, login_response, next_url, selected_idp)
+
+
+async def async_spid_login(
+    request,
+    config_loader_path=None,
+    wayf_template="wayf.html",
+    authorization_error_template="djangosaml2/auth_error.html",
+):
+    """
+    Async variant of spid_login. The sessions and the user are loaded
+    with sync_to_async, the configuration is loaded and the AuthnRequest
+    is signed in the executor of the SPID views.
+    """
+    logger.debug("SPID Login process started")
+
+    next_url = _get_login_next_url(request)
+    if await sync_to_async(_load_request_state)(request):
+        return await sync_to_async(_login_authenticated_user)(
+            request, next_url, authorization_error_template
+        )
 
+    with trace_flow("login"):
+        with timed("config_load"):
+            conf = await run_in_executor(get_config, config_loader_path, request)
+        with timed("metadata_lookup"):
+            selected_idp, response = await sync_to_async(_select_idp)(
+                request, conf, next_url, wayf_template
+            )
+        if response is not None:
+            return response
+        set_idp(selected_idp)
+
+        try:
+            login_response = await run_in_executor(
+                spid_sp_authn_request, conf, selected_idp, next_url
+            )
+        except UnknownSystemEntity as e:  # pragma: no cover
+            _msg = f"Unknown IDP Entity ID: {selected_idp}"
+            logger.error(f"{_msg}: {e}")
+            return HttpResponseNotFound(_msg)
+        except CryptoPoolBusy as e:
+            logger.warning(f"SPID Login error: {e}")
+            return HttpResponse(str(e), status=503)
+
+        return _login_response(request, login_response, next_url, selected_idp)
+
+
+def _logout_client(request, config_loader_path=None):
     state = StateCache(request.saml_session)
-    conf = get_config(config_loader_path, request)
-    client = Saml2Client(
+    with timed("config_load"):
+        conf = get_config(config_loader_path, request)
+    client = get_saml2_client(
         conf, state_cache=state, identity_cache=IdentityCache(request.saml_session)
     )
+    return state, client
 
-    # whatever happens, however, the user will be logged out of this sp
-    auth.logout(request)
-    state.sync()
 
+def _logout_subject_id(request):
     subject_id = djangosaml2_views._get_subject_id(request.saml_session)
     if subject_id is None:
         logger.warning(
             f"The session does not contain the subject id for user {request.user}"
         )
         logger.error(f"Looks like the user {subject_id} is not logged in any IdP/AA")
-        return HttpResponseBadRequest("You are not logged in any IdP/AA")
+    return subject_id
+
 
+def _logout_response(state, client, subject_id):
+    """Builds and signs the LogoutRequest for the IdP of the subject."""
+    set_idp(subject_id.name_qualifier)
+    build_started = time.perf_counter()
     slo_req = saml2.samlp.LogoutRequest()
 
     slo_req.destination = subject_id.name_qualifier
@@ -232,66 +358,189 @@ def spid_logout(request, config_loader_path=None, **kwargs):
         "assertion_consumer_service"
     ][0][0]
     slo_req.assertion_consumer_service_url = assertion_consumer_service_url
-
-    slo_req_signed = client.sign(
-        slo_req,
-        sign_prepare=False,
-        sign_alg=settings.SPID_SIG_ALG,
-        digest_alg=settings.SPID_DIG_ALG,
-    )
+    add_phase("request_build", time.perf_counter() - build_started)
+
+    with timed("signing"):
+        slo_req_signed = client.sign(
+            slo_req,
+            sign_prepare=False,
+            sign_alg=settings.SPID_SIG_ALG,
+            digest_alg=settings.SPID_DIG_ALG,
+        )
 
     _req_str = slo_req_signed
-    logger.debug(
-        f"LogoutRequest to {subject_id.name_qualifier}: {repr_saml_request(_req_str)}"
-    )
+    log_saml_message(logger, "LogoutRequest to", subject_id.name_qualifier, _req_str)
 
-    slo_location = client.metadata.single_logout_service(
-        subject_id.name_qualifier, SAML2_DEFAULT_BINDING, "idpsso"
-    )[0]["location"]
+    with timed("metadata_lookup"):
+        slo_location = client.metadata.single_logout_service(
+            subject_id.name_qualifier, SAML2_DEFAULT_BINDING, "idpsso"
+        )[0]["location"]
 
     if not slo_location:
         error_message = f"Unable to know SLO endpoint in {subject_id.name_qualifier}"
         logger.error(error_message)
         return HttpResponse(error_message)
 
-    http_info = client.apply_binding(
-        SAML2_DEFAULT_BINDING,
-        _req_str,
-        slo_location,
-        sign=True,
-        sigalg=settings.SPID_SIG_ALG,
-    )
+    with timed("binding"):
+        http_info = client.apply_binding(
+            SAML2_DEFAULT_BINDING,
+            _req_str,
+            slo_location,
+            sign=True,
+            sigalg=settings.SPID_SIG_ALG,
+        )
     state.sync()
     return HttpResponse(http_info["data"])
 
 
+def spid_logout(request, config_loader_path=None, **kwargs):
+    """SAML Logout Request initiator
+
+    This view initiates the SAML2 Logout request
+    using the pysaml2 library to create the LogoutRequest.
+    """
+    if not request.user.is_authenticated:
+        return HttpResponseRedirect(settings.LOGOUT_REDIRECT_URL)
+
+    with trace_flow("logout"):
+        state, client = _logout_client(request, config_loader_path)
+
+        # whatever happens, however, the user will be logged out of this sp
+        auth.logout(request)
+        state.sync()
+
+        subject_id = _logout_subject_id(request)
+        if subject_id is None:
+            return HttpResponseBadRequest("You are not logged in any IdP/AA")
+
+        return _logout_response(state, client, subject_id)
+
+
+async def async_spid_logout(request, config_loader_path=None, **kwargs):
+    """
+    Async variant of spid_logout. The user is logged out with sync_to_async,
+    the LogoutRequest is built and signed in the executor of the SPID views.
+    """
+    if not await sync_to_async(_load_request_state)(request):
+        return HttpResponseRedirect(settings.LOGOUT_REDIRECT_URL)
+
+    with trace_flow("logout"):
+        state, client = await run_in_executor(_logout_client, request, config_loader_path)
+
+        # whatever happens, however, the user will be logged out of this sp
+        await sync_to_async(auth.logout)(request)
+        state.sync()
+
+        subject_id = _logout_subject_id(request)
+        if subject_id is None:
+            return HttpResponseBadRequest("You are not logged in any IdP/AA")
+
+        return await run_in_executor(_logout_response, state, client, subject_id)
+
+
+class AsyncViewMixin:
+    """
+    Runs a class-based view with async handlers as a coroutine, Django
+    up to 4.0 supports only the async function-based views.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+
+        return functools.update_wrapper(async_view, view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+
 class MetadataSpidView(djangosaml2_views.View):
     """SPID dynamic Metadata endpoint"""
 
+    md_type = "spid"
+
     def dispatch(self, request, *args, **kwargs):
         self.conf = get_config(getattr(settings, 'SAML_CONFIG_LOADER'), request)
         return super().dispatch(request, *args, **kwargs)
 
     def build_metadata(self):
-        metadata = italian_sp_metadata(self.conf, md_type='spid')
+        metadata = italian_sp_metadata(self.conf, md_type=self.md_type)
         return metadata
 
+    def get_static_metadata(self):
+        """
+        Returns the path and the stat of the pre-rendered metadata file,
+        or `None` if it doesn't exist.
+        """
+        if not settings.SPID_METADATA_STATIC_DIR:
+            return None
+
+        try:
+            path = sp_metadata_static_path(get_base_url(self.request), self.md_type)
+            return path, os.stat(path)
+        except (OSError, ValueError):
+            return None
+
     def get(self, request, *args, **kwargs):
         """Returns an XML with the SAML 2.0 metadata for this
         SP as configured in the settings.py file.
         """
-        xmldoc = self.build_metadata()
-        return HttpResponse(
-            content=str(xmldoc).encode("utf-8"),
-            content_type="text/xml; charset=utf8"
+        static_metadata = self.get_static_metadata()
+        if static_metadata is not None:
+            path, stat = static_metadata
+            etag = f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            last_modified = int(stat.st_mtime)
+        else:
+            etag, last_modified = sp_metadata_validators(self.conf, self.md_type)
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
         )
+        if response is None:
+            if static_metadata is not None:
+                with open(path, "rb") as fp:
+                    content = fp.read()
+            else:
+                content, last_modified = cached_sp_metadata(
+                    self.conf, self.md_type, self.build_metadata
+                )
+            response = HttpResponse(
+                content=content, content_type="text/xml; charset=utf8"
+            )
+
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, max_age=settings.SPID_METADATA_CACHE_MAX_AGE)
+        return response
 
 
 class MetadataCieView(MetadataSpidView):
+    """CIE dynamic Metadata endpoint"""
+
+    md_type = "cie"
+
+
+class AsyncMetadataSpidView(AsyncViewMixin, MetadataSpidView):
+    """SPID dynamic Metadata endpoint, async variant"""
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Loading the configuration and signing the metadata are CPU-bound
+        return await run_in_executor(
+            MetadataSpidView.dispatch, self, request, *args, **kwargs
+        )
 
-    def build_metadata(self):
-        metadata = italian_sp_metadata(self.conf, md_type='cie')
-        return metadata
+
+class AsyncMetadataCieView(AsyncMetadataSpidView):
+    """CIE dynamic Metadata endpoint, async variant"""
+
+    md_type = "cie"
 
 
 class EchoAttributesView(
@@ -317,7 +566,75 @@ class EchoAttributesView(
 
 
 class AssertionConsumerServiceView(djangosaml2_views.AssertionConsumerServiceView):
+    def post(self, request, *args, **kwargs):
+        with trace_flow("acs"):
+            try:
+                self.check_saml_response(request)
+            except UnsafeSamlResponse as e:
+                return self.reject_saml_response(request, e)
+            return super().post(request, *args, **kwargs)
+
+    def check_saml_response(self, request):
+        """
+        Front-line guard of the ACS, before pysaml2 parses the SAMLResponse:
+        the size of the request body is checked before it's read, and the
+        SAMLResponse is pre-scanned by check_saml_response(). The Issuer and
+        InResponseTo found by the scan are kept for the failure statistics.
+        """
+        max_size = settings.SPID_SAML_RESPONSE_MAX_SIZE
+        try:
+            content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            content_length = 0
+        if max_size and content_length > max_size:
+            raise SamlResponseTooLarge(
+                f"ACS request body too large: {content_length} bytes"
+            )
+
+        if "SAMLResponse" in request.POST:
+            self.scanned_response = check_saml_response(
+                request.POST["SAMLResponse"],
+                max_size=max_size,
+                max_depth=settings.SPID_SAML_RESPONSE_MAX_DEPTH,
+                max_attributes=settings.SPID_SAML_RESPONSE_MAX_ATTRIBUTES,
+            )
+
+    def reject_saml_response(self, request, exception):
+        logger.warning(f"SAMLResponse rejected: {exception}")
+        return self.handle_acs_failure(
+            request, status=exception.status, exception=exception
+        )
+
+    def get_sp_config(self, request):
+        with timed("config_load"):
+            conf = super().get_sp_config(request)
+        # The response is parsed and verified between the configuration
+        # loading and the custom validation
+        self.parse_started = time.perf_counter()
+        return conf
+
+    def authenticate_user(self, *args, **kwargs):
+        with timed("user_lookup"):
+            return super().authenticate_user(*args, **kwargs)
+
     def custom_validation(self, response):
+        parse_started = getattr(self, "parse_started", None)
+        if parse_started is not None:
+            add_phase("response_parse", time.perf_counter() - parse_started)
+        self.response_idp = record_response(
+            self.request.saml_session, response.issuer(), response.in_response_to
+        )
+        set_idp(self.response_idp)
+
+        with timed("validation"):
+            try:
+                self.validate_response(response)
+            except SpidValidationError as err:
+                record_validation_failure(self.response_idp, err.check)
+                raise
+
+    def validate_response(self, response):
+        """Validates a parsed and verified response with Saml2ResponseValidator."""
         conf = get_config(None, self.request)
 
         # Spid and SAML2 additional tests
@@ -329,22 +646,63 @@ class AssertionConsumerServiceView(djangosaml2_views.AssertionConsumerServiceVie
         in_response_to = oq_cache.outstanding_queries()
         logger.debug("in_response_to=%r", in_response_to)
 
+        # The response has been already parsed and verified by pysaml2
         validator = Saml2ResponseValidator(
-            authn_response=response.xmlstr,
+            authn_response=response,
             recipient=recipient,
             accepted_time_diff=accepted_time_diff,
             in_response_to=in_response_to,
             authn_context_class_ref=authn_context_classref,
             return_addrs=response.return_addrs,
         )
+
+        # Shadow validation of a sample of the responses, that reports all
+        # the violations of a profile without affecting the login.
+        if random.random() < settings.SPID_VALIDATION_REPORT_SAMPLE_RATE:
+            try:
+                report = validator.validate(
+                    profile=settings.SPID_VALIDATION_REPORT_PROFILE
+                )
+            except Exception as e:
+                logger.warning(f"SPID validation report failed: {e}", exc_info=True)
+                report = None
+            if report:
+                logger.warning(
+                    f"SPID validation report for {response.issuer()!r}: "
+                    f"{[err.as_dict() for err in report]}"
+                )
+
         validator.run()
 
+        # The assertion is recorded once valid, to reject its replays
+        check_assertion_replay(
+            response.issuer(), response.assertion, validator.accepted_time_diff
+        )
+
+    def record_failure(self, request, exception, spid_error):
+        """
+        Records the failure in the ACS statistics of the IdP. For a response
+        that pysaml2 couldn't parse, the Issuer and InResponseTo found by the
+        front-line guard are used, the response isn't parsed again.
+        """
+        if not hasattr(self, "response_idp"):
+            issuer, in_response_to = getattr(self, "scanned_response", (None, None))
+            self.response_idp = record_response(
+                request.saml_session, issuer, in_response_to
+            )
+
+        code = spid_error.code if spid_error else exception.__class__.__name__
+        record_error(self.response_idp, code)
+
     def handle_acs_failure(self, request, exception=None, status=403, **kwargs):
         try:
             spid_error = SpidError.from_saml2_error(exception)
         except (ValueError, TypeError, KeyError):
             spid_error = None
 
+        if metrics_enabled():
+            self.record_failure(request, exception, spid_error)
+
         return render(
             request,
             "spid_login_error.html",
@@ -357,5 +715,182 @@ class AssertionConsumerServiceView(djangosaml2_views.AssertionConsumerServiceVie
         )
 
 
+class AsyncAssertionConsumerServiceView(
+    AsyncViewMixin, AssertionConsumerServiceView
+):
+    """
+    Async variant of the ACS view. The SAMLResponse is parsed, verified
+    and validated in the executor of the SPID views, the user is
+    authenticated and logged in with sync_to_async.
+    """
+
+    def get_client(self, request):
+        conf = self.get_sp_config(request)
+        return get_saml2_client(conf, identity_cache=IdentityCache(request.saml_session))
+
+    async def post(self, request, attribute_mapping=None, create_unknown_user=None):
+        """SAML Authorization Response endpoint"""
+        try:
+            await run_in_executor(self.check_saml_response, request)
+        except UnsafeSamlResponse as e:
+            return await sync_to_async(self.reject_saml_response)(request, e)
+
+        if "SAMLResponse" not in request.POST:
+            logger.warning('Missing "SAMLResponse" parameter in POST data.')
+            return HttpResponseBadRequest(
+                'Missing "SAMLResponse" parameter in POST data.'
+            )
+
+        with trace_flow("acs"):
+            await sync_to_async(_load_request_state)(request)
+            client = await run_in_executor(self.get_client, request)
+            oq_cache = OutstandingQueriesCache(request.saml_session)
+            oq_cache.sync()
+
+            _exception = None
+            try:
+                response = await run_in_executor(
+                    client.parse_authn_request_response,
+                    request.POST["SAMLResponse"],
+                    saml2.BINDING_HTTP_POST,
+                    oq_cache.outstanding_queries(),
+                )
+            except CryptoPoolBusy as e:
+                logger.warning(f"SAMLResponse Error: {e}")
+                return HttpResponse(str(e), status=503)
+            except (StatusError, ToEarly) as e:
+                _exception = e
+                logger.exception("Error processing SAML Assertion.")
+            except ResponseLifetimeExceed as e:
+                _exception = e
+                logger.info(
+                    (
+                        "SAML Assertion is no longer valid. Possibly caused "
+                        "by network delay or replay attack."
+                    ),
+                    exc_info=True,
+                )
+            except SignatureError as e:
+                _exception = e
+                logger.info("Invalid or malformed SAML Assertion.", exc_info=True)
+            except StatusAuthnFailed as e:
+                _exception = e
+                logger.info("Authentication denied for user by IdP.", exc_info=True)
+            except StatusRequestDenied as e:
+                _exception = e
+                logger.warning("Authentication interrupted at IdP.", exc_info=True)
+            except StatusNoAuthnContext as e:
+                _exception = e
+                logger.warning("Missing Authentication Context from IdP.", exc_info=True)
+            except MissingKey as e:
+                _exception = e
+                logger.exception(
+                    "SAML Identity Provider is not configured correctly: certificate key is missing!"
+                )
+            except UnsolicitedResponse as e:
+                _exception = e
+                logger.exception("Received SAMLResponse when no request has been made.")
+            except RequestVersionTooLow as e:
+                _exception = e
+                logger.exception("Received SAMLResponse have a deprecated SAML2 VERSION.")
+            except (AttributeError, ImportError, NameError, TypeError):
+                raise  # programming errors, not invalid responses
+            except Exception as e:
+                # pysaml2 raises bare exceptions too, eg. for unknown responses
+                _exception = e
+                logger.exception("SAMLResponse Error")
+
+            if _exception:
+                return await sync_to_async(self.handle_acs_failure)(
+                    request, exception=_exception
+                )
+            elif response is None:
+                logger.warning("Invalid SAML Assertion received (unknown error).")
+                return await sync_to_async(self.handle_acs_failure)(
+                    request,
+                    status=400,
+                    exception=SuspiciousOperation("Unknown SAML2 error"),
+                )
+
+            try:
+                await run_in_executor(self.custom_validation, response)
+            except Exception as e:
+                logger.warning(f"SAML Response validation error: {e}", exc_info=True)
+                return await sync_to_async(self.handle_acs_failure)(
+                    request,
+                    status=400,
+                    exception=SuspiciousOperation("SAML2 validation error"),
+                )
+
+            oq_cache.delete(response.session_id())
+            return await sync_to_async(self.login_user)(
+                request, response, attribute_mapping, create_unknown_user
+            )
+
+    def login_user(
+        self, request, response, attribute_mapping=None, create_unknown_user=None
+    ):
+        """
+        Authenticates the user of a verified response and redirects
+        to the RelayState, as the sync view of djangosaml2 1.9 does.
+        """
+        attribute_mapping = attribute_mapping or get_custom_setting(
+            "SAML_ATTRIBUTE_MAPPING", {"uid": ("username",)}
+        )
+        create_unknown_user = create_unknown_user or get_custom_setting(
+            "SAML_CREATE_UNKNOWN_USER", True
+        )
+        if callable(attribute_mapping):
+            attribute_mapping = attribute_mapping()
+        if callable(create_unknown_user):
+            create_unknown_user = create_unknown_user()
+
+        session_info = response.session_info()
+
+        assertion = response.assertion
+        assertion_info = {}
+        for sc in assertion.subject.subject_confirmation:
+            if sc.method == saml2.saml.SCM_BEARER:
+                assertion_info = {
+                    "assertion_id": assertion.id,
+                    "not_on_or_after": sc.subject_confirmation_data.not_on_or_after,
+                }
+                break
+
+        try:
+            user = self.authenticate_user(
+                request,
+                session_info,
+                attribute_mapping,
+                create_unknown_user,
+                assertion_info,
+            )
+        except PermissionDenied as e:
+            return self.handle_acs_failure(
+                request, exception=e, session_info=session_info
+            )
+
+        relay_state = self.build_relay_state()
+        custom_redirect_url = self.custom_redirect(user, relay_state, session_info)
+        if custom_redirect_url:
+            return HttpResponseRedirect(custom_redirect_url)
+
+        relay_state = validate_referral_url(request, relay_state)
+        if not relay_state:
+            logger.debug(
+                f"RelayState is not a valid URL, redirecting to fallback: {relay_state}"
+            )
+            return HttpResponseRedirect(get_fallback_login_redirect_url())
+
+        logger.debug(f"Redirecting to the RelayState: {relay_state}")
+        return HttpResponseRedirect(relay_state)
+
+
 class LogoutView(djangosaml2_views.LogoutView):
-    pass
+    def get_state_client(self, request):
+        conf = self.get_sp_config(request)
+        state = StateCache(request.saml_session)
+        client = get_saml2_client(
+            conf, state_cache=state, identity_cache=IdentityCache(request.saml_session)
+        )
+        return state, client